@@ -0,0 +1,115 @@
+"""
+Capacity / load ของ container นี้ — GET /capacity ให้ Worker เลือก instance ที่ว่างที่สุดเมื่อรันหลาย container
+- job ที่รัน / รอเทียบกับขีดจำกัดจริง: PIPELINE_CONCURRENCY ของ scheduler + คิวที่ยอมให้รอ, CPU budget ของ governor
+- job ที่รันอยู่แยกตามประเภทงาน (cpu = encode / ffmpeg, net = download / Gemini / TTS / upload)
+- เวลาต่อ stage ของ job ล่าสุด, disk ว่างของ workspace
+- instance id: ตั้งด้วย INSTANCE_ID หรือ Worker ประกาศมากับ request (header X-Instance-Id / "instance_id")
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+import checkpoint
+import governor
+import jobs
+import scheduler
+import sourcecache
+import workspace
+
+CPU_COUNT = os.cpu_count() or 1
+
+# stage ของ job (jobs.STAGE_NAMES) → ประเภทงาน
+STAGE_CLASSES = {
+    "download": "net",
+    "analyze": "net",
+    "tts": "net",
+    "merge": "cpu",
+    "upload": "net",
+}
+
+# job ที่ยอมให้รอคิวใน container ได้ (นอกจากที่รันอยู่) ก่อนบอก Worker ว่าไม่รับงานแล้ว
+QUEUE_ALLOWANCE = max(0, int(os.environ.get("CAPACITY_QUEUE_ALLOWANCE", str(scheduler.CONCURRENCY))))
+# งานทั้งหมด (รัน + รอ) ที่ container นี้รับ — รันจริงพร้อมกันได้แค่ scheduler.CONCURRENCY
+MAX_JOBS = max(1, int(os.environ.get("MAX_JOBS", str(scheduler.CONCURRENCY + QUEUE_ALLOWANCE))))
+
+_instance = {"id": os.environ.get("INSTANCE_ID", ""), "declared_by": "env" if os.environ.get("INSTANCE_ID") else None}
+_instance_lock = threading.Lock()
+_started_at = time.time()
+
+
+def declare(instance_id):
+    """Worker บอกว่า container นี้คือ instance ไหน (ชื่อของ Durable Object) — INSTANCE_ID ใน env มาก่อนเสมอ"""
+    if not instance_id:
+        return
+    with _instance_lock:
+        if _instance["declared_by"] == "env" or _instance["id"] == instance_id:
+            return
+        if _instance["id"]:
+            print(f"[CAPACITY] Instance id changed: {_instance['id']} → {instance_id}")
+        _instance["id"] = instance_id
+        _instance["declared_by"] = "request"
+
+
+def instance_id():
+    with _instance_lock:
+        return _instance["id"]
+
+
+def _disk(path):
+    """disk usage ของ filesystem ที่ path อยู่ (path ยังไม่ถูกสร้างก็ดูจาก parent)"""
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    try:
+        usage = shutil.disk_usage(path or "/")
+    except OSError:
+        return None
+    return {"path": path, "free_bytes": usage.free, "total_bytes": usage.total,
+            "free_ratio": round(usage.free / usage.total, 3) if usage.total else None}
+
+
+def report():
+    active = jobs.active_jobs()
+    running = scheduler.running_count()
+    queued = scheduler.queue_depth()
+    by_class = {"cpu": 0, "net": 0}
+    for job in active:
+        cls = STAGE_CLASSES.get(job.stage)
+        if cls:
+            by_class[cls] += 1
+    cpu = governor.status()
+
+    free_jobs = max(0, MAX_JOBS - running - queued)
+    return {
+        "instance_id": instance_id(),
+        "uptime": round(time.time() - _started_at, 1),
+        "cpus": CPU_COUNT,
+        "load_avg": list(os.getloadavg()) if hasattr(os, "getloadavg") else None,
+        "active_jobs": running,
+        "queue_depth": queued,
+        "max_jobs": MAX_JOBS,
+        "free_jobs": free_jobs,
+        "load": round((running + queued) / MAX_JOBS, 3),
+        "accepting": free_jobs > 0,
+        # ขีดจำกัดที่บังคับใช้จริง — scheduler (job พร้อมกัน) และ governor (thread ของ ffmpeg / Whisper)
+        "limits": {
+            "concurrency": {"total": scheduler.CONCURRENCY, "busy": running,
+                            "free": max(0, scheduler.CONCURRENCY - running)},
+            "queue": {"allowance": QUEUE_ALLOWANCE, "depth": queued},
+            "cpu_threads": {"budget": cpu["budget"], "allocated": cpu.get("threads_allocated", 0)},
+        },
+        "running_by_class": by_class,
+        "cpu": cpu,
+        "stage_latency": jobs.stage_latencies(),
+        "disk": {
+            "workspace": _disk(checkpoint.STATE_DIR),
+            "tmp": _disk(tempfile.gettempdir()),
+            "source_cache": _disk(sourcecache.CACHE_DIR),
+            "reservations": workspace.status(),
+        },
+        "stages": {j.video_id: j.stage or "queued" for j in active},
+    }
@@ -0,0 +1,135 @@
+"""
+Stage checkpoint ของ pipeline — เก็บผลของแต่ละ step ลง job directory + manifest.json
+container restart / Worker redispatch video_id เดิม → ทำต่อจาก step ล่าสุดที่เสร็จแล้ว
+ไม่ต้องดาวน์โหลด / อัปโหลด Gemini / สร้าง script / TTS ใหม่ทั้งหมด
+"""
+import os
+import json
+import time
+import shutil
+import threading
+
+# ต้องอยู่บน disk ที่รอด process restart (ไม่ใช่ /tmp ที่ถูกล้าง)
+STATE_DIR = os.environ.get("JOB_STATE_DIR", "/app/jobs")
+
+# job directory ที่ไม่มีใครแตะนานเกินนี้จะถูกลบตอน startup
+STATE_TTL = int(os.environ.get("JOB_STATE_TTL", str(24 * 3600)))
+
+MANIFEST = "manifest.json"
+
+# ลำดับ stage ของ run_pipeline_bg
+STAGES = ("download", "preflight", "gemini", "script", "tts", "subtitles", "upload")
+
+
+class JobState:
+    """manifest ของ job หนึ่งตัว — เขียนแบบ atomic ทุกครั้งที่ stage เสร็จ"""
+
+    def __init__(self, video_id, root=None):
+        self.video_id = video_id
+        self.dir = os.path.join(root or STATE_DIR, video_id)
+        self._lock = threading.Lock()
+        self.data = {"video_id": video_id, "status": "running", "stages": {}}
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.dir, MANIFEST)
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def load(self):
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            self.data = json.load(f)
+        return self
+
+    def begin(self, payload):
+        """เปิด job — ถ้ามี manifest เดิมจะโหลดมาทำต่อ คืน stage สุดท้ายที่เสร็จ (หรือ None)"""
+        os.makedirs(self.dir, exist_ok=True)
+        if self.exists():
+            try:
+                self.load()
+            except (OSError, ValueError) as e:
+                print(f"[CHECKPOINT] Broken manifest for {self.video_id}, starting over: {e}")
+        self.data["payload"] = payload
+        self.data["status"] = "running"
+        self.data["resumes"] = self.data.get("resumes", -1) + 1
+        self._save()
+        return self.last_stage()
+
+    def done(self, stage):
+        return stage in self.data.get("stages", {})
+
+    def last_stage(self):
+        finished = [s for s in STAGES if self.done(s)]
+        return finished[-1] if finished else None
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def mark(self, stage, **values):
+        """บันทึกว่า stage เสร็จแล้ว พร้อมค่าที่ stage ถัดไปต้องใช้"""
+        with self._lock:
+            self.data.update(values)
+            self.data.setdefault("stages", {})[stage] = time.time()
+            self._save()
+        print(f"[CHECKPOINT] {self.video_id}: {stage} ✓")
+
+    def set_status(self, status, error=""):
+        with self._lock:
+            self.data["status"] = status
+            if error:
+                self.data["error"] = error[:200]
+            self._save()
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def has_file(self, name):
+        p = self.path(name)
+        return os.path.exists(p) and os.path.getsize(p) > 0
+
+    def write_file(self, name, data):
+        """เขียนไฟล์ผลลัพธ์ของ stage แบบ atomic (tmp → rename)"""
+        p = self.path(name)
+        tmp = p + ".tmp"
+        mode = "w" if isinstance(data, str) else "wb"
+        with open(tmp, mode, **({"encoding": "utf-8"} if mode == "w" else {})) as f:
+            f.write(data)
+        os.replace(tmp, p)
+        return p
+
+    def clear(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        # manifest มี token/api_key ของ payload → อ่านได้เฉพาะเจ้าของ
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp, self.manifest_path)
+
+
+def pending_jobs(root=None):
+    """job ที่ค้างกลางทาง (status=running) — ใช้ resume ตอน container start
+    job ที่ failed เก็บไว้รอ Worker redispatch, ที่เก่าเกิน STATE_TTL จะถูกลบทิ้ง"""
+    root = root or STATE_DIR
+    if not os.path.isdir(root):
+        return []
+    now = time.time()
+    result = []
+    for name in sorted(os.listdir(root)):
+        state = JobState(name, root)
+        try:
+            age = now - os.path.getmtime(state.manifest_path)
+            state.load()
+        except (OSError, ValueError):
+            state.clear()
+            continue
+        if age > STATE_TTL or state.get("status") in ("done", "cancelled"):
+            state.clear()
+            continue
+        if state.get("status") == "running" and state.get("payload"):
+            result.append(state)
+    return result
@@ -0,0 +1,296 @@
+"""
+ดาวน์โหลดวิดีโอต้นฉบับแบบแบ่งช่วง (HTTP Range) หลาย connection พร้อมกัน
+probe Accept-Ranges / Content-Length ก่อน → จองไฟล์ขนาดเต็ม แล้วแต่ละ range เขียนลง offset ของตัวเอง
+connection ไหนค้าง / หลุด → ต่อจาก byte ที่ได้แล้วของ range นั้น (ไม่เริ่มทั้งไฟล์ใหม่)
+ความคืบหน้าของ range เก็บใน <dest>.part.json — job ที่ถูก redispatch ดาวน์โหลดต่อจากเดิมได้
+server ไม่รองรับ Range / ไฟล์เล็ก → stream เดียวแบบเดิม
+"""
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests as http_requests
+
+import metrics
+
+# จำนวน connection ต่อไฟล์
+SEGMENTS = max(1, int(os.environ.get("DOWNLOAD_SEGMENTS", "4")))
+# ไฟล์เล็กกว่านี้ (หรือ range เล็กกว่านี้) ไม่คุ้มแบ่ง
+MIN_SEGMENT = int(os.environ.get("DOWNLOAD_MIN_SEGMENT", str(2 * 1024 * 1024)))
+RETRIES = max(1, int(os.environ.get("DOWNLOAD_RETRIES", "4")))
+# (connect, read) — read timeout สั้นพอให้ connection ที่ค้างถูกตัดแล้วต่อใหม่
+TIMEOUT = (10, float(os.environ.get("DOWNLOAD_READ_TIMEOUT", "30")))
+CHUNK = 256 * 1024
+
+
+class DownloadError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class _Progress:
+    """รวม byte ที่ได้จากทุก range → on_progress(pct, done) ทุก ~10%"""
+
+    def __init__(self, total, done=0, on_progress=None):
+        self.total = total
+        self.done = done
+        self.on_progress = on_progress
+        self._last = done / total if total else 0
+        self._lock = threading.Lock()
+
+    def add(self, n):
+        with self._lock:
+            self.done += n
+            if not (self.total and self.on_progress):
+                return
+            pct = self.done / self.total
+            if pct - self._last > 0.1 or (pct >= 1.0 and self._last < 1.0):
+                self._last = pct
+                call = True
+            else:
+                call = False
+        if call:
+            self.on_progress(min(pct, 1.0), self.done)
+
+
+def download(url, dest, cancel=None, on_progress=None, headers=None, segments=None):
+    """ดาวน์โหลด url ลง dest (atomic: .part → rename) — คืนจำนวน byte
+    on_progress(pct, done): เรียกทุก ~10% ถ้ารู้ขนาดไฟล์"""
+    headers = dict(headers or {})
+    segments = segments or SEGMENTS
+    tmp = dest + ".part"
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    t0 = time.monotonic()
+
+    probe = _get(url, headers, "bytes=0-0")
+    total = _total_size(probe)
+    if probe.status_code == 206 and total and total >= 2 * MIN_SEGMENT and segments > 1:
+        probe.close()
+        stats = _download_ranged(url, tmp, total, headers, segments, cancel, on_progress)
+        mode = "ranged"
+    else:
+        if probe.status_code == 206:
+            # รองรับ Range แต่ไฟล์เล็ก — ขอใหม่ทั้งไฟล์
+            probe.close()
+            probe = _get(url, headers)
+        stats = _download_single(url, tmp, probe, headers, cancel, on_progress)
+        mode = "single"
+        total = stats["bytes"]
+
+    os.replace(tmp, dest)
+    _clear_state(tmp)
+    elapsed = max(time.monotonic() - t0, 1e-6)
+    mbps = total / 1024 / 1024 / elapsed
+    metrics.bytes_moved(url, stats["fetched"], "down")
+    metrics.DOWNLOAD_MBPS.observe(mbps, mode=mode)
+    print(f"[DL] {total/1024/1024:.1f} MB in {elapsed:.1f}s ({mbps:.1f} MB/s, {mode}"
+          + (f", {stats['ranges']} ranges" if mode == "ranged" else "")
+          + (f", {stats['retries']} retries" if stats["retries"] else "")
+          + (f", resumed {stats['resumed']/1024/1024:.1f} MB" if stats.get("resumed") else "") + ")")
+    return total
+
+
+def remote_size(url, headers=None):
+    """ขนาดไฟล์ที่ url (ขอแค่ byte แรก) — None ถ้า server ไม่บอก / เข้าไม่ได้"""
+    try:
+        resp = _get(url, dict(headers or {}), "bytes=0-0")
+    except DownloadError:
+        return None
+    try:
+        return _total_size(resp)
+    finally:
+        resp.close()
+
+
+def _get(url, headers, byte_range=None):
+    h = dict(headers)
+    if byte_range:
+        h["Range"] = byte_range
+    try:
+        resp = http_requests.get(url, headers=h, stream=True, timeout=TIMEOUT)
+    except http_requests.RequestException as e:
+        raise DownloadError(f"Download failed: {e}")
+    if resp.status_code not in (200, 206):
+        resp.close()
+        raise DownloadError(f"Download failed: {resp.status_code}", resp.status_code)
+    return resp
+
+
+def _total_size(resp):
+    """ขนาดไฟล์เต็มจาก Content-Range (206) หรือ Content-Length (200)"""
+    if resp.status_code == 206:
+        total = (resp.headers.get("Content-Range") or "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = resp.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+# ==================== single stream ====================
+
+def _download_single(url, tmp, resp, headers, cancel, on_progress):
+    """stream เดียว — หลุดกลางทางเริ่มใหม่ทั้งไฟล์ (server ไม่รองรับ Range)"""
+    retries = fetched = 0
+    while True:
+        progress = _Progress(_total_size(resp), 0, on_progress)
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in resp.iter_content(chunk_size=CHUNK):
+                    if cancel:
+                        cancel.check()
+                    if chunk:
+                        f.write(chunk)
+                        fetched += len(chunk)
+                        progress.add(len(chunk))
+            if progress.total and progress.done != progress.total:
+                raise DownloadError(f"Download truncated: {progress.done}/{progress.total} bytes")
+            return {"bytes": progress.done, "fetched": fetched, "retries": retries}
+        except (http_requests.RequestException, DownloadError) as e:
+            resp.close()
+            retries += 1
+            if retries >= RETRIES:
+                raise DownloadError(f"Download failed after {retries} attempts: {e}")
+            metrics.RETRIES.inc(op="download")
+            print(f"[DL] Stream broke ({str(e)[:100]}), restarting ({retries}/{RETRIES - 1})")
+            _backoff(retries, cancel)
+            resp = _get(url, headers)
+
+
+# ==================== ranged ====================
+
+def _state_path(tmp):
+    return tmp + ".json"
+
+
+def _load_state(tmp, url, total):
+    """range ที่ดาวน์โหลดไปแล้วจากรอบก่อน — {start: done_bytes} (ใช้ได้เฉพาะ url + ขนาดเดิม)"""
+    try:
+        with open(_state_path(tmp), encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if data.get("url") != url or data.get("total") != total or not os.path.exists(tmp):
+        return {}
+    return {int(k): v for k, v in (data.get("done") or {}).items()}
+
+
+def _save_state(tmp, url, total, done):
+    path = _state_path(tmp)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"url": url, "total": total, "done": {str(k): v for k, v in done.items()}}, f)
+    os.replace(path + ".tmp", path)
+
+
+def _clear_state(tmp):
+    try:
+        os.remove(_state_path(tmp))
+    except OSError:
+        pass
+
+
+def _preallocate(tmp, total):
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        current = os.fstat(fd).st_size
+        if current > total:
+            os.ftruncate(fd, total)
+        elif current < total:
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, 0, total)
+                except OSError:
+                    os.ftruncate(fd, total)
+            else:
+                os.ftruncate(fd, total)
+    finally:
+        os.close(fd)
+
+
+def _download_ranged(url, tmp, total, headers, segments, cancel, on_progress):
+    n = max(1, min(segments, total // MIN_SEGMENT))
+    size = -(-total // n)
+    ranges = [(start, min(start + size, total) - 1) for start in range(0, total, size)]
+
+    done = _load_state(tmp, url, total)   # start → byte ที่เขียนแล้วของ range นั้น
+    done = {start: min(done.get(start, 0), end - start + 1) for start, end in ranges}
+    resumed = sum(done.values())
+    _preallocate(tmp, total)
+    progress = _Progress(total, resumed, on_progress)
+    lock = threading.Lock()
+    stats = {"retries": 0, "fetched": 0}
+    failed = threading.Event()
+
+    def fetch(rng):
+        start, end = rng
+        fd = os.open(tmp, os.O_WRONLY)
+        try:
+            attempt = 0
+            while done[start] < end - start + 1:
+                if failed.is_set():
+                    return
+                if cancel:
+                    cancel.check()
+                pos = before = start + done[start]
+                try:
+                    resp = _get(url, headers, f"bytes={pos}-{end}")
+                    if resp.status_code != 206:
+                        resp.close()
+                        raise DownloadError(f"Range not honoured: {resp.status_code}")
+                    for chunk in resp.iter_content(chunk_size=CHUNK):
+                        if cancel:
+                            cancel.check()
+                        if failed.is_set():
+                            resp.close()
+                            return
+                        if not chunk:
+                            continue
+                        chunk = chunk[:end - pos + 1]
+                        os.pwrite(fd, chunk, pos)
+                        pos += len(chunk)
+                        with lock:
+                            done[start] = pos - start
+                            stats["fetched"] += len(chunk)
+                        progress.add(len(chunk))
+                        if pos > end:
+                            break
+                    resp.close()
+                    if pos <= end:
+                        raise DownloadError(f"Range {start}-{end} ended early at {pos}")
+                except (http_requests.RequestException, DownloadError) as e:
+                    # นับเฉพาะครั้งที่ล้มติดกันโดยไม่ได้ byte เพิ่ม — connection ที่หลุดแต่ยังคืบหน้าต่อได้เรื่อยๆ
+                    attempt = 1 if pos > before else attempt + 1
+                    with lock:
+                        stats["retries"] += 1
+                        _save_state(tmp, url, total, done)
+                    if attempt >= RETRIES:
+                        failed.set()
+                        raise DownloadError(f"Range {start}-{end} failed after {attempt} attempts: {e}")
+                    metrics.RETRIES.inc(op="download_range")
+                    print(f"[DL] Range {start}-{end} broke at {pos} ({str(e)[:80]}), resuming ({attempt}/{RETRIES - 1})")
+                    _backoff(attempt, cancel)
+        finally:
+            os.close(fd)
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            for f in [pool.submit(fetch, r) for r in ranges]:
+                f.result()
+    except BaseException:
+        # เก็บ .part + ความคืบหน้าไว้ — เรียกซ้ำด้วย url เดิมจะต่อจากตรงนี้
+        failed.set()
+        with lock:
+            _save_state(tmp, url, total, done)
+        raise
+    return {"bytes": total, "fetched": stats["fetched"], "retries": stats["retries"],
+            "ranges": len(ranges), "resumed": resumed}
+
+
+def _backoff(attempt, cancel=None):
+    delay = min(2 ** (attempt - 1), 10)
+    if cancel:
+        if cancel.wait(delay):
+            cancel.check()
+    else:
+        time.sleep(delay)
@@ -0,0 +1,180 @@
+"""
+แบ่ง CPU ให้ ffmpeg / Whisper ที่รันพร้อมกันหลาย job — ไม่ให้ทุกตัวเปิด thread เท่าจำนวน core จนแย่ง cache กัน
+- stage ที่กิน CPU (normalize / burn / whisper) ต้องขอ lease ก่อนรัน → ได้ thread = CPU_BUDGET / จำนวน lease ที่รันอยู่
+  ffmpeg: -threads (encoder) + -filter_threads, whisper-ctranslate2: --threads (cpu_threads ของ CTranslate2)
+- pin แต่ละ process ไว้กับชุด core ของตัวเอง และจัดใหม่ทุกครั้งที่มี process เริ่ม / จบ (ปิดด้วย CPU_AFFINITY=0)
+  จำนวน thread กำหนดได้ตอนเริ่มเท่านั้น — encode ที่รันอยู่ใช้ thread เท่าส่วนแบ่งตอนเริ่มไปจนจบ
+  แต่ core ที่มันวิ่งได้ขยาย / หดตามจำนวนงานได้ระหว่างรัน (งานใหม่เข้ามาไม่แย่ง core ซ้อนกัน)
+lease เป็นไฟล์ใน CPU_LEASE_DIR ใต้ flock — runner process ทุกตัว (runner.py) เห็นกันหมด
+"""
+import os
+import json
+import time
+import fcntl
+import itertools
+import threading
+from contextlib import contextmanager
+
+ENABLED = os.environ.get("CPU_GOVERNOR", "1") == "1"
+AFFINITY = os.environ.get("CPU_AFFINITY", "1") == "1" and hasattr(os, "sched_setaffinity")
+LEASE_DIR = os.environ.get("CPU_LEASE_DIR", "/tmp/dubbing-cpu")
+
+_CPUS = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+CPU_BUDGET = max(1, int(os.environ.get("CPU_BUDGET", str(len(_CPUS)))))
+
+# stage ของ mediaproc.run_media ที่ต้องขอ lease → น้ำหนัก (ส่วนแบ่ง core)
+GOVERNED = {
+    "normalize": 1.0,
+    "burn": 1.0,
+    "whisper": 1.0,
+}
+
+_seq = itertools.count(1)
+_lock = threading.Lock()
+
+
+@contextmanager
+def _locked():
+    with _lock:
+        os.makedirs(LEASE_DIR, exist_ok=True)
+        with open(os.path.join(LEASE_DIR, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _read_leases():
+    """lease ที่ยังมีเจ้าของอยู่ (ลบของ process ที่ตายไปแล้ว) — เรียงตามเวลาเริ่ม"""
+    leases = []
+    for name in os.listdir(LEASE_DIR):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(LEASE_DIR, name)
+        try:
+            with open(path, encoding="utf-8") as f:
+                lease = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not _alive(lease["owner"]):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        leases.append(lease)
+    return sorted(leases, key=lambda l: (l["started"], l["id"]))
+
+
+def _write_lease(lease):
+    path = os.path.join(LEASE_DIR, lease["id"] + ".json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(lease, f)
+    os.replace(path + ".tmp", path)
+
+
+def _share(weight, leases):
+    total = sum(l["weight"] for l in leases) or weight
+    return max(1, int(round(CPU_BUDGET * weight / total)))
+
+
+def _rebalance(leases):
+    """แบ่ง core เป็นช่วงติดกันตามน้ำหนักของแต่ละ lease แล้ว pin ทุก thread ของ process นั้น"""
+    cpus = _CPUS[:CPU_BUDGET]
+    total = sum(l["weight"] for l in leases) or 1.0
+    start = 0.0
+    for lease in leases:
+        width = len(cpus) * lease["weight"] / total
+        lo, hi = int(start), max(int(start) + 1, int(round(start + width)))
+        start += width
+        cores = set(cpus[lo:min(hi, len(cpus))] or cpus[-1:])
+        pid = lease.get("pid")
+        if not pid:
+            continue
+        try:
+            tids = [int(t) for t in os.listdir(f"/proc/{pid}/task")]
+        except OSError:
+            tids = [pid]
+        for tid in tids:
+            try:
+                os.sched_setaffinity(tid, cores)
+            except OSError:
+                pass
+
+
+class Lease:
+    def __init__(self, stage, weight, threads):
+        self.id = f"{os.getpid()}-{next(_seq)}"
+        self.stage = stage
+        self.weight = weight
+        self.threads = threads
+        self._record = {"id": self.id, "owner": os.getpid(), "stage": stage, "weight": weight,
+                        "threads": threads, "started": time.time(), "pid": None}
+
+    def attach(self, pid):
+        """process ของ lease นี้เริ่มแล้ว — จด pid ไว้ให้ rebalance pin ได้"""
+        self._record["pid"] = pid
+        with _locked():
+            _write_lease(self._record)
+            if AFFINITY:
+                _rebalance(_read_leases())
+
+    def release(self):
+        with _locked():
+            try:
+                os.remove(os.path.join(LEASE_DIR, self.id + ".json"))
+            except OSError:
+                pass
+            if AFFINITY:
+                _rebalance(_read_leases())
+
+
+def _with_threads(cmd, threads):
+    name = os.path.basename(cmd[0])
+    if name == "ffmpeg":
+        # -filter_threads เป็น global option, -threads ก่อนชื่อไฟล์ output = thread ของ encoder
+        return [cmd[0], "-filter_threads", str(threads)] + list(cmd[1:-1]) + ["-threads", str(threads), cmd[-1]]
+    if name == "whisper-ctranslate2":
+        return list(cmd) + ["--threads", str(threads)]
+    return cmd
+
+
+def acquire(stage, cmd):
+    """ขอ lease สำหรับ stage นี้ — คืน (cmd ที่ใส่จำนวน thread แล้ว, Lease หรือ None ถ้าไม่ต้องคุม)"""
+    weight = GOVERNED.get(stage)
+    if not ENABLED or weight is None or not cmd:
+        return cmd, None
+    with _locked():
+        leases = _read_leases()
+        threads = _share(weight, leases + [{"weight": weight}])
+        lease = Lease(stage, weight, threads)
+        _write_lease(lease._record)
+    print(f"[CPU] {stage}: {threads}/{CPU_BUDGET} threads ({len(leases) + 1} running)")
+    return _with_threads(cmd, threads), lease
+
+
+def status():
+    """lease ที่รันอยู่ทั้ง container (ทุก process) — สำหรับ /capacity, metrics"""
+    if not ENABLED:
+        return {"enabled": False, "budget": CPU_BUDGET, "leases": []}
+    with _locked():
+        leases = _read_leases()
+    return {
+        "enabled": True,
+        "budget": CPU_BUDGET,
+        "affinity": AFFINITY,
+        "threads_allocated": sum(l["threads"] for l in leases),
+        "leases": [{"stage": l["stage"], "threads": l["threads"], "pid": l["pid"],
+                    "seconds": round(time.time() - l["started"], 1)} for l in leases],
+    }
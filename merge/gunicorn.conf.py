@@ -0,0 +1,28 @@
+"""
+gunicorn config สำหรับ production (Dockerfile CMD)
+- worker เดียว: job registry / SSE / metrics อยู่ใน memory ของ process นี้ (control plane)
+  งาน pipeline ไปรันใน process แยกต่อ job (runner.py) — ไม่แย่ง GIL กับ /health, /xhs/resolve
+- gthread: request แต่ละตัวได้ thread ของตัวเอง — SSE ที่เปิดค้าง / /merge ที่รันนานไม่บล็อก request อื่น
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "32"))
+# /merge (legacy) และ SSE เปิด connection นาน — ไม่ให้ gunicorn ฆ่า worker
+timeout = 0
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+accesslog = None
+errorlog = "-"
+capture_output = True
+
+
+def post_worker_init(worker):
+    import server
+    import warmup
+    print(f"[CONTAINER] Starting dubbing container on {bind} ({threads} threads)")
+    warmup.start()
+    if os.environ.get("RESUME_ON_STARTUP", "1") == "1":
+        server.resume_pending_jobs()
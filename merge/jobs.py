@@ -0,0 +1,301 @@
+"""
+Job registry ของ container — เก็บ job ที่กำลังรัน (และที่เพิ่งจบ) ไว้ใน memory
+ใช้สำหรับยกเลิกงาน / ดูสถานะ / SSE progress โดยไม่ต้องวนถาม R2
+"""
+import json
+import time
+import queue
+import threading
+from collections import OrderedDict, deque
+
+import metrics
+from mediaproc import CancelToken
+
+# จำนวน job ที่จบแล้วที่ยังเก็บไว้ให้ดูสถานะได้
+MAX_FINISHED = 100
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# ชนิดงาน: pipeline เต็ม (run_pipeline_bg) / พากย์เสียงใหม่ (run_redub_bg)
+PIPELINE = "pipeline"
+REDUB = "redub"
+
+# step ของ run_pipeline_bg → ชื่อ stage (run_redub_bg ใช้เลข step เดียวกัน)
+STAGE_NAMES = {1: "download", 2: "analyze", 3: "tts", 4: "merge", 5: "upload"}
+TOTAL_STEPS = 5
+
+# subscriber ที่อ่านไม่ทัน — queue เต็มแล้วจะทิ้ง event เก่า
+_SUBSCRIBER_QUEUE = 64
+
+# เวลาที่ใช้ต่อ stage ของ job ล่าสุด N ตัว (/capacity)
+RECENT_STAGES = 50
+
+
+class Job:
+    def __init__(self, video_id, chat_id, dedup_key=None, kind=PIPELINE):
+        self.video_id = video_id
+        self.chat_id = chat_id
+        self.dedup_key = dedup_key
+        self.kind = kind
+        self.cancel = CancelToken()
+        self.status = RUNNING
+        self.error = ""
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.finished_at = None
+        self.step = 0
+        self.step_name = ""
+        self.stage = ""
+        self.percent = 0.0
+        self.encode_time = None       # วินาทีที่ ffmpeg encode ไปแล้ว (จาก out_time_us)
+        self.encode_duration = None
+        self.stage_started = None
+        self.seq = 0
+        self._subscribers = []
+        self._sub_lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.status == RUNNING
+
+    def update(self, step=None, step_name=None, encode_time=None, encode_duration=None):
+        """อัปเดต progress แล้ว push ให้ทุก SSE subscriber"""
+        if step is not None:
+            self.step = step
+            self._enter_stage(STAGE_NAMES.get(int(step), self.stage))
+            self.percent = round(max(0.0, min(1.0, (step - 1) / TOTAL_STEPS)) * 100, 1)
+        if step_name is not None:
+            self.step_name = step_name
+        if encode_time is not None:
+            self.encode_time = encode_time
+            self.encode_duration = encode_duration
+        self.updated_at = time.time()
+        self._publish()
+
+    def apply(self, event):
+        """อัปเดตจาก to_dict() ของ Job ตัวเดียวกันใน process อื่น (runner.py) แล้ว push ต่อให้ SSE"""
+        if "stage" in event:
+            self._enter_stage(event["stage"])
+        for key in ("step", "step_name", "percent", "encode_time", "encode_duration"):
+            if key in event:
+                setattr(self, key, event[key])
+        self.updated_at = time.time()
+        self._publish()
+
+    def _enter_stage(self, stage):
+        """เปลี่ยน stage → บันทึกเวลาที่ใช้ใน stage ก่อนหน้า"""
+        if stage == self.stage:
+            return
+        now = time.time()
+        if self.stage and self.stage_started:
+            _record_stage(self.stage, now - self.stage_started)
+        self.stage = stage
+        self.stage_started = now
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=_SUBSCRIBER_QUEUE)
+        with self._sub_lock:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._sub_lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def _publish(self):
+        self.seq += 1
+        event = self.to_dict()
+        with self._sub_lock:
+            subs = list(self._subscribers)
+        for q in subs:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    q.put_nowait(event)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def to_dict(self):
+        return {
+            "video_id": self.video_id,
+            "chat_id": self.chat_id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "cancelling": self.active and self.cancel.cancelled,
+            "step": self.step,
+            "step_name": self.step_name,
+            "stage": self.stage,
+            "percent": self.percent,
+            "encode_time": self.encode_time,
+            "encode_duration": self.encode_duration,
+            "encode_percent": round(min(1.0, self.encode_time / self.encode_duration) * 100, 1)
+            if self.encode_time is not None and self.encode_duration else None,
+            "seq": self.seq,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "finished_at": self.finished_at,
+        }
+
+
+_lock = threading.Lock()
+_active = {}                 # video_id → Job
+_finished = OrderedDict()    # video_id → Job (ใหม่สุดอยู่ท้าย)
+_recent = {}                 # stage → deque ของวินาที
+_recent_lock = threading.Lock()
+_finish_listeners = []       # callback(job) หลัง finish (scheduler คืน slot)
+
+
+def on_finish(fn):
+    _finish_listeners.append(fn)
+
+
+def _record_stage(stage, seconds):
+    with _recent_lock:
+        _recent.setdefault(stage, deque(maxlen=RECENT_STAGES)).append(seconds)
+
+
+def stage_latencies():
+    """เวลาต่อ stage ของ job ล่าสุด — {stage: {"count", "p50", "p90", "last"}}"""
+    with _recent_lock:
+        recent = {stage: list(d) for stage, d in _recent.items()}
+    out = {}
+    for stage, values in recent.items():
+        ordered = sorted(values)
+        out[stage] = {
+            "count": len(values),
+            "p50": round(ordered[len(ordered) // 2], 2),
+            "p90": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))], 2),
+            "last": round(values[-1], 2),
+        }
+    return out
+
+
+def register(video_id, chat_id, dedup_key=None, kind=PIPELINE):
+    job = Job(video_id, chat_id, dedup_key, kind)
+    with _lock:
+        _finished.pop(video_id, None)
+        _active[video_id] = job
+    return job
+
+
+def register_if_idle(video_id, chat_id, kind=PIPELINE):
+    """สร้าง job ใหม่เมื่อ video_id นี้ไม่มีงานรันอยู่ — คืน (job, created); มีอยู่แล้วคืน job เดิม"""
+    with _lock:
+        existing = _active.get(video_id)
+        if existing:
+            return existing, False
+        job = Job(video_id, chat_id, kind=kind)
+        _finished.pop(video_id, None)
+        _active[video_id] = job
+        return job, True
+
+
+def register_or_attach(video_id, chat_id, dedup_key=None):
+    """idempotent register — คืน (job, created)
+
+    ไม่สร้าง job ใหม่ (created=False) ถ้า:
+    - video_id นี้กำลังรันอยู่
+    - chat เดียวกันกำลังรัน video_url เดียวกัน (dedup_key ตรงกัน)
+    - video_id นี้เพิ่งทำเสร็จ (Worker retry หลังงานจบไปแล้ว)
+    job ที่ failed / cancelled ส่งซ้ำได้ → สร้างใหม่แล้วทำต่อจาก checkpoint
+    """
+    with _lock:
+        existing = _active.get(video_id)
+        if existing:
+            return existing, False
+        if dedup_key:
+            for j in _active.values():
+                if j.dedup_key == dedup_key and str(j.chat_id) == str(chat_id):
+                    return j, False
+        finished = _finished.get(video_id)
+        if finished and finished.status == DONE:
+            return finished, False
+
+        job = Job(video_id, chat_id, dedup_key)
+        _finished.pop(video_id, None)
+        _active[video_id] = job
+        return job, True
+
+
+def get(video_id):
+    with _lock:
+        return _active.get(video_id) or _finished.get(video_id)
+
+
+def active_jobs():
+    with _lock:
+        return list(_active.values())
+
+
+def all_jobs():
+    """job ที่กำลังรัน + ที่จบไปไม่นาน (ใหม่สุดก่อน)"""
+    with _lock:
+        finished = list(reversed(_finished.values()))
+        return list(_active.values()) + finished
+
+
+def active_for_chat(chat_id):
+    with _lock:
+        return [j for j in _active.values() if str(j.chat_id) == str(chat_id)]
+
+
+def finish(job, status, error=""):
+    """ย้าย job ไปกอง finished — เรียกจาก thread ของ job ตอนจบ (ไม่ว่าผลจะเป็นอะไร)"""
+    with _lock:
+        job.status = status
+        job.error = error[:200]
+        job.finished_at = time.time()
+        if status == DONE:
+            job.percent = 100.0
+            if job.stage and job.stage_started:
+                _record_stage(job.stage, job.finished_at - job.stage_started)
+        if _active.get(job.video_id) is job:
+            del _active[job.video_id]
+        _finished[job.video_id] = job
+        _finished.move_to_end(job.video_id)
+        while len(_finished) > MAX_FINISHED:
+            _finished.popitem(last=False)
+    metrics.JOBS_FINISHED.inc(status=status)
+    job._publish()
+    for fn in _finish_listeners:
+        try:
+            fn(job)
+        except Exception as e:
+            print(f"[JOBS] finish listener error: {e}")
+
+
+def events(job, keepalive=15):
+    """generator ของ Server-Sent Events — snapshot แรกทันที แล้วตามด้วยทุก update จนกว่า job จะจบ"""
+    q = job.subscribe()
+    try:
+        event = job.to_dict()
+        while True:
+            yield f"id: {event['seq']}\nevent: progress\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            if event["status"] != RUNNING:
+                return
+            while True:
+                try:
+                    event = q.get(timeout=keepalive)
+                    break
+                except queue.Empty:
+                    if not job.active:
+                        event = job.to_dict()
+                        break
+                    yield ": keepalive\n\n"
+    finally:
+        job.unsubscribe(q)
+
+
+def cancel(video_id, reason="cancelled"):
+    """ยกเลิก job ที่กำลังรัน — คืน Job (หรือ None ถ้าไม่เจอ)"""
+    job = get(video_id)
+    if job and job.active:
+        job.cancel.cancel(reason)
+    return job
@@ -0,0 +1,185 @@
+"""
+ข้อมูลไฟล์สื่อจาก ffprobe ครั้งเดียว (-show_streams -show_format -of json)
+codec / duration / ขนาด / rotation / audio stream อ่านจาก object เดียวแทนการ probe ทีละค่า
+ผล probe memoize ตาม path + mtime + size — ไฟล์เดิมที่ยังไม่ถูกแก้ไม่ต้อง ffprobe ซ้ำ
+"""
+import os
+import json
+import threading
+from collections import OrderedDict
+
+import metrics
+from mediaproc import run_media, ProcessTimeout
+
+# จำนวนไฟล์ที่จำผล probe ไว้
+CACHE_SIZE = int(os.environ.get("PROBE_CACHE_SIZE", "256"))
+
+_cache = OrderedDict()   # abspath → (mtime_ns, size, MediaInfo)
+_cache_lock = threading.Lock()
+
+
+class ProbeError(Exception):
+    """ffprobe อ่านไฟล์ไม่ได้ (ไฟล์เสีย / ไม่ใช่ไฟล์สื่อ)"""
+
+
+def _float(v, default=None):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return default
+
+
+class MediaInfo:
+    def __init__(self, data, path=None):
+        self.path = path
+        self.data = data
+        self.format = data.get("format") or {}
+        self.streams = data.get("streams") or []
+
+    @classmethod
+    def from_dict(cls, data, path=None):
+        """โหลดจากผล probe ที่เก็บไว้ (เช่นใน checkpoint manifest)"""
+        return cls(data, path)
+
+    def to_dict(self):
+        return self.data
+
+    @property
+    def video(self):
+        for s in self.streams:
+            if s.get("codec_type") == "video" and not (s.get("disposition") or {}).get("attached_pic"):
+                return s
+        return None
+
+    @property
+    def audio_streams(self):
+        return [s for s in self.streams if s.get("codec_type") == "audio"]
+
+    @property
+    def has_audio(self):
+        return bool(self.audio_streams)
+
+    @property
+    def duration(self):
+        """วินาที — format ก่อน แล้วค่อย stream ที่ยาวสุด (None ถ้าไม่รู้)"""
+        d = _float(self.format.get("duration"))
+        if d is None:
+            ds = [_float(s.get("duration")) for s in self.streams]
+            ds = [x for x in ds if x]
+            d = max(ds) if ds else None
+        return d
+
+    @property
+    def video_codec(self):
+        return (self.video or {}).get("codec_name")
+
+    @property
+    def pix_fmt(self):
+        return (self.video or {}).get("pix_fmt")
+
+    @property
+    def width(self):
+        return (self.video or {}).get("width")
+
+    @property
+    def height(self):
+        return (self.video or {}).get("height")
+
+    @property
+    def rotation(self):
+        """องศาที่ player จะหมุนตอนแสดง (0/90/180/270) — จาก display matrix หรือ tag rotate"""
+        v = self.video or {}
+        rot = None
+        for sd in v.get("side_data_list") or []:
+            if "rotation" in sd:
+                rot = _float(sd.get("rotation"))
+        if rot is None:
+            rot = _float((v.get("tags") or {}).get("rotate"), 0)
+        return int(round(rot)) % 360
+
+    @property
+    def display_size(self):
+        """(กว้าง, สูง) หลังหมุนตาม rotation — ขนาดที่คนดูเห็นจริง"""
+        w, h = self.width, self.height
+        if w and h and self.rotation in (90, 270):
+            return h, w
+        return w, h
+
+    @property
+    def fps(self):
+        rate = (self.video or {}).get("avg_frame_rate") or ""
+        num, _, den = rate.partition("/")
+        num, den = _float(num), _float(den or 1)
+        return num / den if num and den else None
+
+    def summary(self):
+        w, h = self.display_size
+        return {
+            "duration": self.duration, "width": w, "height": h,
+            "video_codec": self.video_codec, "pix_fmt": self.pix_fmt,
+            "rotation": self.rotation, "fps": round(self.fps, 3) if self.fps else None,
+            "audio_streams": len(self.audio_streams),
+            "format": self.format.get("format_name"),
+        }
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+
+def probe(path, cancel=None):
+    """MediaInfo ของไฟล์ — ใช้ผลเดิมถ้าไฟล์ไม่เปลี่ยน (path + mtime + size), ไม่งั้น ffprobe ใหม่"""
+    key, mtime, size = _stat_key(path)
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit and hit[0] == mtime and hit[1] == size:
+            _cache.move_to_end(key)
+            metrics.PROBE_CACHE.inc(result="hit")
+            return hit[2]
+    metrics.PROBE_CACHE.inc(result="miss")
+    info = _probe(path, cancel)
+    _store(key, mtime, size, info)
+    return info
+
+
+def remember(path, info):
+    """ใส่ผล probe ที่รู้อยู่แล้ว (เช่นจาก checkpoint) ลง cache ของ path นี้"""
+    try:
+        key, mtime, size = _stat_key(path)
+    except OSError:
+        return
+    info.path = path
+    _store(key, mtime, size, info)
+
+
+def forget(path):
+    with _cache_lock:
+        _cache.pop(os.path.abspath(path), None)
+
+
+def _store(key, mtime, size, info):
+    with _cache_lock:
+        _cache[key] = (mtime, size, info)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _probe(path, cancel=None):
+    """ffprobe JSON ครั้งเดียว → MediaInfo (raise ProbeError ถ้าอ่านไม่ได้)"""
+    try:
+        r = run_media([
+            "ffprobe", "-v", "error", "-show_streams", "-show_format", "-of", "json", path
+        ], "probe", cancel=cancel, check=False)
+    except ProcessTimeout as e:
+        raise ProbeError(f"ffprobe error: {e}")
+    if r.returncode != 0:
+        raise ProbeError(f"ffprobe failed: {(r.stderr or '').strip()[-200:]}")
+    try:
+        data = json.loads(r.stdout or "{}")
+    except ValueError as e:
+        raise ProbeError(f"ffprobe output is not JSON: {e}")
+    if not data.get("format") and not data.get("streams"):
+        raise ProbeError("ffprobe returned no format/streams")
+    return MediaInfo(data, path)
@@ -0,0 +1,320 @@
+"""
+Media process runner — ใช้รัน ffmpeg / ffprobe / whisper ทุกตัวผ่านที่เดียว
+- timeout ต่อ stage แล้ว kill ทั้ง process group (ffmpeg/whisper ไม่ค้างจน thread ตาย)
+- เก็บ stderr แค่ท้าย N KB (ring buffer) ไม่กิน memory ไม่จำกัด
+- วัด wall time + CPU time ของทุก invocation
+- ยกเลิกได้ผ่าน CancelToken ของ job เจ้าของ process
+"""
+import os
+import time
+import signal
+import threading
+import subprocess
+from collections import deque
+
+import governor
+import profiling
+
+# timeout (วินาที) ต่อ stage — override ได้ด้วย env PROC_TIMEOUT_<STAGE> เช่น PROC_TIMEOUT_BURN=1800
+STAGE_TIMEOUTS = {
+    "version": 10,
+    "probe": 30,
+    "normalize": 900,
+    "audio": 60,
+    "mux": 300,
+    "whisper": 300,
+    "burn": 900,
+    "thumb": 60,
+    # warmup ตอน boot — ครั้งแรกอาจต้องดาวน์โหลด Whisper weights
+    "warmup": 900,
+}
+DEFAULT_TIMEOUT = 300
+
+# ขนาด ring buffer ของ stderr ต่อ process
+STDERR_TAIL_BYTES = int(os.environ.get("PROC_STDERR_KB", "64")) * 1024
+
+# เวลารอหลัง SIGTERM ก่อนจะ SIGKILL
+KILL_GRACE = 3.0
+
+_POLL_INTERVAL = 0.2
+
+# callback(ProcResult) หลังทุก invocation — ใช้เก็บ metrics / trace
+_observers = []
+
+
+def add_observer(fn):
+    _observers.append(fn)
+
+
+class JobCancelled(Exception):
+    """job ถูกยกเลิก — raise จาก CancelToken.check() หรือจาก run_media"""
+
+
+class ProcessTimeout(Exception):
+    def __init__(self, stage, timeout, stderr_tail=""):
+        super().__init__(f"{stage} timed out (>{timeout:g}s)")
+        self.stage = stage
+        self.timeout = timeout
+        self.stderr_tail = stderr_tail
+
+
+class ProcessFailed(Exception):
+    def __init__(self, stage, returncode, stderr_tail=""):
+        super().__init__(f"{stage} failed (exit {returncode}): {stderr_tail[-300:]}")
+        self.stage = stage
+        self.returncode = returncode
+        self.stderr_tail = stderr_tail
+
+
+class CancelToken:
+    """Token ยกเลิกงานของ job หนึ่งตัว — ส่งต่อให้ทุก process ที่ job สร้าง"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._procs = set()
+        self.reason = ""
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled"):
+        """ยกเลิก job — kill process ที่กำลังรันอยู่ทันที"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            procs = list(self._procs)
+        for p in procs:
+            _kill_group(p)
+
+    def check(self):
+        """checkpoint — เรียกระหว่าง step ที่ไม่ใช่ subprocess (เช่นก่อนเรียก Gemini)"""
+        if self._event.is_set():
+            raise JobCancelled(self.reason or "cancelled")
+
+    def wait(self, seconds):
+        """sleep แบบยกเลิกได้ — คืน True ถ้าถูกยกเลิกระหว่างรอ"""
+        return self._event.wait(seconds)
+
+    def _attach(self, proc):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._procs.add(proc)
+            return True
+
+    def _detach(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+
+class ProcResult:
+    def __init__(self, cmd, stage, returncode, stdout, stderr_tail, wall, cpu):
+        self.cmd = cmd
+        self.stage = stage
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr_tail
+        self.wall = wall
+        self.cpu = cpu
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+class _TailBuffer:
+    """เก็บเฉพาะ N bytes สุดท้าย"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._chunks = deque()
+        self._size = 0
+
+    def write(self, chunk):
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        while self._size > self.limit and len(self._chunks) > 1:
+            self._size -= len(self._chunks.popleft())
+        if self._size > self.limit:
+            only = self._chunks.pop()[-self.limit:]
+            self._chunks.append(only)
+            self._size = len(only)
+
+    def text(self):
+        return b"".join(self._chunks).decode("utf-8", errors="replace")
+
+
+def stage_timeout(stage):
+    env = os.environ.get(f"PROC_TIMEOUT_{stage.upper()}")
+    if env:
+        return float(env)
+    return STAGE_TIMEOUTS.get(stage, DEFAULT_TIMEOUT)
+
+
+def _kill_group(proc):
+    """SIGTERM ทั้ง process group → รอ grace → SIGKILL"""
+    try:
+        pgid = os.getpgid(proc.pid)
+    except (ProcessLookupError, OSError):
+        return
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except (ProcessLookupError, OSError):
+        return
+
+    def _force():
+        deadline = time.monotonic() + KILL_GRACE
+        while time.monotonic() < deadline:
+            if proc.returncode is not None:
+                return
+            time.sleep(0.1)
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except (ProcessLookupError, OSError):
+            pass
+
+    threading.Thread(target=_force, daemon=True).start()
+
+
+def _drain(stream, sink):
+    try:
+        for chunk in iter(lambda: stream.read(4096), b""):
+            sink(chunk)
+    except (OSError, ValueError):
+        pass
+    finally:
+        try:
+            stream.close()
+        except Exception:
+            pass
+
+
+def _drain_lines(stream, on_line):
+    try:
+        for raw in stream:
+            try:
+                on_line(raw.decode("utf-8", errors="replace").rstrip("\r\n"))
+            except Exception:
+                pass
+    except (OSError, ValueError):
+        pass
+    finally:
+        try:
+            stream.close()
+        except Exception:
+            pass
+
+
+def run_media(cmd, stage, timeout=None, cancel=None, check=True,
+              capture_stdout=True, on_stdout_line=None, text=True):
+    """
+    รัน media process หนึ่งตัว
+
+    - stage: ชื่อ stage (probe/audio/mux/whisper/burn/thumb/...) ใช้เลือก timeout + log
+    - capture_stdout: เก็บ stdout ทั้งหมด (ใช้กับ ffprobe) — ถ้า False จะส่งต่อไป log ของ container
+    - on_stdout_line: callback ต่อบรรทัด (ใช้กับ ffmpeg -progress -) แทนการเก็บ stdout
+    - check: raise ProcessFailed เมื่อ exit code != 0
+
+    Raise ProcessTimeout / JobCancelled / ProcessFailed, คืน ProcResult
+    """
+    if timeout is None:
+        timeout = stage_timeout(stage)
+    if cancel is not None:
+        cancel.check()
+
+    if on_stdout_line is not None:
+        stdout_mode = subprocess.PIPE
+    elif capture_stdout:
+        stdout_mode = subprocess.PIPE
+    else:
+        stdout_mode = None
+
+    cmd = profiling.ffmpeg_args(cmd)
+    # stage ที่กิน CPU ได้ส่วนแบ่ง thread จาก governor (ใส่ -threads / --threads ให้)
+    cmd, lease = governor.acquire(stage, cmd)
+    start = time.monotonic()
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=stdout_mode,
+            stderr=subprocess.PIPE,
+            start_new_session=True,  # process group ของตัวเอง → killpg ได้ทั้งต้นไม้
+        )
+    except BaseException:
+        if lease:
+            lease.release()
+        raise
+    if lease:
+        lease.attach(proc.pid)
+    if cancel is not None and not cancel._attach(proc):
+        _kill_group(proc)
+
+    err_tail = _TailBuffer(STDERR_TAIL_BYTES)
+    out_chunks = []
+    readers = [threading.Thread(target=profiling.bind(_drain), args=(proc.stderr, err_tail.write), daemon=True)]
+    if on_stdout_line is not None:
+        readers.append(threading.Thread(target=profiling.bind(_drain_lines),
+                                        args=(proc.stdout, on_stdout_line), daemon=True))
+    elif capture_stdout:
+        readers.append(threading.Thread(target=profiling.bind(_drain),
+                                        args=(proc.stdout, out_chunks.append), daemon=True))
+    for t in readers:
+        t.start()
+
+    timed_out = False
+    cpu = 0.0
+    poll = 0.01  # เริ่ม poll ถี่ๆ ให้ ffprobe สั้นๆ ไม่เสียเวลารอ แล้วค่อยๆ ห่างขึ้น
+    try:
+        while True:
+            # reap เองด้วย wait4 เพื่อได้ rusage (CPU time) ของ process นี้โดยเฉพาะ
+            pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                cpu = usage.ru_utime + usage.ru_stime
+                break
+            if not timed_out and time.monotonic() - start > timeout:
+                timed_out = True
+                _kill_group(proc)
+            time.sleep(poll)
+            poll = min(poll * 2, _POLL_INTERVAL)
+    except ChildProcessError:
+        # มีคนอื่น reap ไปแล้ว — ไม่มี rusage
+        proc.wait()
+    finally:
+        if cancel is not None:
+            cancel._detach(proc)
+        if lease:
+            lease.release()
+
+    for t in readers:
+        t.join(timeout=5)
+    wall = time.monotonic() - start
+
+    stderr_text = err_tail.text()
+    stdout = None
+    if capture_stdout and on_stdout_line is None:
+        stdout = b"".join(out_chunks)
+        if text:
+            stdout = stdout.decode("utf-8", errors="replace")
+
+    print(f"[PROC] {stage}: exit={proc.returncode} wall={wall:.2f}s cpu={cpu:.2f}s")
+    result = ProcResult(cmd, stage, proc.returncode, stdout, stderr_text, wall, cpu)
+    for fn in _observers:
+        try:
+            fn(result)
+        except Exception as e:
+            print(f"[PROC] observer error: {e}")
+
+    if cancel is not None and cancel.cancelled:
+        raise JobCancelled(cancel.reason or "cancelled")
+    if timed_out:
+        raise ProcessTimeout(stage, timeout, stderr_text)
+    if check and proc.returncode != 0:
+        raise ProcessFailed(stage, proc.returncode, stderr_text)
+    return result
+
@@ -0,0 +1,328 @@
+"""
+Prometheus metrics ของ container — render เป็น text exposition format ที่ /metrics
+เขียนเองแบบเล็กๆ ไม่ต้องพึ่ง prometheus_client
+"""
+import time
+import resource
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# bucket (วินาที) สำหรับ stage ของ pipeline — ตั้งแต่ R2 PUT สั้นๆ ไปจนถึง encode หลายนาที
+STAGE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+FPS_BUCKETS = (5, 10, 20, 30, 45, 60, 90, 120, 180, 240)
+MBPS_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _fmt_labels(names, values):
+    if not names:
+        return ""
+    parts = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{n}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _fmt_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name}: expected labels {self.labels}, got {tuple(labels)}")
+        return tuple(labels[n] for n in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Gauge — set ค่าเอง หรือให้ callback คำนวณตอน scrape (set_function)"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+        self._fn = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, fn):
+        """fn() → ค่าเดียว (ไม่มี label) หรือ dict {label tuple: ค่า}"""
+        self._fn = fn
+
+    def _samples(self):
+        if self._fn is not None:
+            try:
+                v = self._fn()
+            except Exception:
+                return []
+            items = sorted(v.items()) if isinstance(v, dict) else [((), v)]
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series = {}  # key → [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        out = []
+        for key, s in items:
+            for i, b in enumerate(self.buckets):
+                names = self.labels + ("le",)
+                out.append(f"{self.name}_bucket{_fmt_labels(names, key + (_fmt_value(b),))} {s[i]}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {_fmt_value(s[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {s[-1]}")
+        return out
+
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry)
+    return "\n".join(m.render() for m in metrics) + "\n"
+
+
+# ==================== ส่งค่าข้าม process (runner.py) ====================
+
+def snapshot(exclude=()):
+    """ค่าปัจจุบันของ counter / histogram ทุกตัว (gauge ไม่รวม — คำนวณใน process ที่ scrape)
+    → {name: [[label values, value], ...]} ส่งเป็น JSON ได้"""
+    with _registry_lock:
+        metrics = [m for m in _registry if m.name not in exclude]
+    out = {}
+    for m in metrics:
+        with m._lock:
+            if isinstance(m, Counter):
+                out[m.name] = [[list(k), v] for k, v in m._values.items()]
+            elif isinstance(m, Histogram):
+                out[m.name] = [[list(k), list(v)] for k, v in m._series.items()]
+    return out
+
+
+def diff(new, old):
+    """snapshot ใหม่ − snapshot เก่า (ส่วนที่เพิ่มขึ้นระหว่างสอง snapshot)"""
+    out = {}
+    for name, items in new.items():
+        before = {tuple(k): v for k, v in old.get(name, [])}
+        delta = []
+        for k, v in items:
+            prev = before.get(tuple(k))
+            if isinstance(v, list):
+                d = [a - b for a, b in zip(v, prev)] if prev else v
+                if d[-1]:
+                    delta.append([k, d])
+            else:
+                d = v - (prev or 0)
+                if d:
+                    delta.append([k, d])
+        if delta:
+            out[name] = delta
+    return out
+
+
+def merge(delta):
+    """บวก delta (จาก diff / snapshot ของ process อื่น) เข้า metric ของ process นี้"""
+    with _registry_lock:
+        by_name = {m.name: m for m in _registry}
+    for name, items in delta.items():
+        m = by_name.get(name)
+        if m is None:
+            continue
+        with m._lock:
+            for k, v in items:
+                key = tuple(k)
+                if isinstance(m, Counter):
+                    m._values[key] = m._values.get(key, 0) + v
+                elif isinstance(m, Histogram):
+                    s = m._series.setdefault(key, [0] * len(m.buckets) + [0.0, 0])
+                    for i, x in enumerate(v):
+                        s[i] += x
+
+
+# ==================== Pipeline metrics ====================
+
+STAGE_SECONDS = Histogram(
+    "dubbing_stage_seconds",
+    "Wall time of each pipeline stage",
+    labels=("stage",),
+)
+PROCESS_SECONDS = Histogram(
+    "dubbing_process_seconds",
+    "Wall/CPU time of ffmpeg, ffprobe and whisper invocations",
+    labels=("stage", "kind"),
+)
+RETRIES = Counter(
+    "dubbing_retries_total",
+    "Retried remote calls",
+    labels=("op",),
+)
+MODEL_FALLBACKS = Counter(
+    "dubbing_model_fallbacks_total",
+    "Gemini model fallbacks after high-demand errors",
+    labels=("op", "to_model"),
+)
+BYTES = Counter(
+    "dubbing_bytes_total",
+    "Bytes transferred per remote host",
+    labels=("host", "direction"),
+)
+JOBS_FINISHED = Counter(
+    "dubbing_jobs_total",
+    "Finished pipeline jobs by outcome",
+    labels=("status",),
+)
+JOBS_ACTIVE = Gauge("dubbing_jobs_active", "Pipeline jobs currently running")
+JOBS_QUEUED = Gauge("dubbing_jobs_queued", "Pipeline jobs accepted but not started yet")
+ENCODE_FPS = Histogram(
+    "dubbing_encode_fps",
+    "ffmpeg libx264 encode speed (frames per second) reported by -progress",
+    buckets=FPS_BUCKETS,
+)
+PROBE_CACHE = Counter(
+    "dubbing_probe_cache_total",
+    "MediaInfo lookups served from the probe cache (hit) or by running ffprobe (miss)",
+    labels=("result",),
+)
+DOWNLOAD_MBPS = Histogram(
+    "dubbing_download_mbps",
+    "Source download throughput (MB/s) by mode (ranged / single stream)",
+    labels=("mode",),
+    buckets=MBPS_BUCKETS,
+)
+SOURCE_CACHE = Counter(
+    "dubbing_source_cache_total",
+    "Source video cache lookups (hit / miss) and removals (expired / evicted)",
+    labels=("result",),
+)
+SOURCE_CACHE_BYTES = Gauge("dubbing_source_cache_bytes", "Bytes of source videos held in the on-disk cache")
+XHS_CACHE = Counter(
+    "dubbing_xhs_cache_total",
+    "XHS link resolutions served from the resolver cache (hit) or fetched (miss)",
+    labels=("result",),
+)
+R2_UPLOADS = Counter(
+    "dubbing_r2_uploads_total",
+    "R2 uploads by backend (s3 direct / worker proxy) and outcome",
+    labels=("backend", "result"),
+)
+QUEUE_WAIT = Histogram(
+    "dubbing_queue_wait_seconds",
+    "Time pipeline jobs spent in the container's fair queue before starting",
+    buckets=STAGE_BUCKETS + (1200, 1800, 3600),
+)
+CPU_THREADS = Gauge("dubbing_cpu_threads_allocated", "Threads handed to running ffmpeg / Whisper processes by the CPU governor")
+PROCESS_RSS = Gauge("process_resident_memory_bytes", "Resident memory of the container server process")
+PEAK_RSS = Gauge(
+    "dubbing_peak_rss_bytes",
+    "Peak resident memory: the server itself and its largest child (ffmpeg / whisper)",
+    labels=("process",),
+)
+
+
+def _rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _peak_rss():
+    # ru_maxrss เป็น KiB บน Linux
+    return {
+        ("self",): resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        ("children",): resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+
+
+PROCESS_RSS.set_function(_rss_bytes)
+PEAK_RSS.set_function(_peak_rss)
+
+
+def stage(name):
+    """with metrics.stage("tts"): ... — จับเวลา stage ลง dubbing_stage_seconds"""
+    return STAGE_SECONDS.time(stage=name)
+
+
+def bytes_moved(url, n, direction):
+    if not n:
+        return
+    host = urlparse(url).hostname or "unknown"
+    BYTES.inc(n, host=host, direction=direction)
+
+
+def observe_process(result):
+    """observer ของ mediaproc.run_media"""
+    PROCESS_SECONDS.observe(result.wall, stage=result.stage, kind="wall")
+    PROCESS_SECONDS.observe(result.cpu, stage=result.stage, kind="cpu")
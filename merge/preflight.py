@@ -0,0 +1,88 @@
+"""
+Preflight ของไฟล์ต้นฉบับ — ตรวจหลังดาวน์โหลด ก่อนจ่ายค่า Gemini upload / script / TTS
+ไฟล์เสีย / ไม่มีภาพ / สั้นหรือยาวเกิน → ปฏิเสธทันที
+pix_fmt / rotation / ขนาด ที่ merge ไม่ถนัด → แปลงเป็น H.264 yuv420p MP4 ก่อน
+codec ที่ ffmpeg decode ได้ (HEVC / VP9 / AV1 จาก XHS) ไม่ต้องแปลง — ตอนฝังซับ encode เป็น H.264 อยู่แล้ว
+container ผิด (webm / mkv) → remux เป็น MP4 อย่างเดียว ไม่ encode ภาพใหม่
+"""
+import os
+
+from mediaproc import run_media
+
+MIN_DURATION = float(os.environ.get("PREFLIGHT_MIN_DURATION", "1"))
+MAX_DURATION = float(os.environ.get("PREFLIGHT_MAX_DURATION", "300"))
+# ด้านยาวของภาพเกินนี้จะถูกย่อ (encode + ฝังซับ 4K ช้าเกินจำเป็นสำหรับ Reels)
+MAX_DIMENSION = int(os.environ.get("PREFLIGHT_MAX_DIMENSION", "1920"))
+# 0 = ไม่แปลงไฟล์ให้ — input ที่ต้องแปลงจะถูกปฏิเสธแทน
+NORMALIZE = os.environ.get("PREFLIGHT_NORMALIZE", "1") == "1"
+
+# codec ที่ merge (mux -c:v copy → ฝังซับ libx264) ใช้ได้ตรงๆ
+OK_CODECS = tuple(c.strip() for c in os.environ.get("PREFLIGHT_OK_CODECS", "h264,hevc,vp9,av1").split(",") if c.strip())
+OK_PIX_FMTS = ("yuv420p", "yuvj420p")
+OK_FORMATS = ("mov", "mp4")
+
+
+class PreflightRejected(Exception):
+    """input ใช้ไม่ได้ — ข้อความนี้ส่งถึงผู้ใช้ใน Telegram"""
+
+
+def check(info):
+    """คืน (reasons, remux_only) — reasons ว่าง = ใช้ไฟล์เดิมได้เลย
+    raise PreflightRejected ถ้าไฟล์ใช้ไม่ได้"""
+    if info.video is None:
+        raise PreflightRejected("ไฟล์นี้ไม่มีภาพวิดีโอ")
+    duration = info.duration
+    if not duration:
+        raise PreflightRejected("อ่านความยาววิดีโอไม่ได้ (ไฟล์อาจเสีย)")
+    if duration < MIN_DURATION:
+        raise PreflightRejected(f"วิดีโอสั้นเกินไป ({duration:.1f}s)")
+    if duration > MAX_DURATION:
+        raise PreflightRejected(f"วิดีโอยาวเกินไป ({duration:.0f}s, สูงสุด {MAX_DURATION:.0f}s)")
+    if not info.width or not info.height:
+        raise PreflightRejected("อ่านขนาดวิดีโอไม่ได้ (ไฟล์อาจเสีย)")
+
+    reasons = []
+    if info.video_codec not in OK_CODECS:
+        reasons.append(f"codec={info.video_codec}")
+    if info.pix_fmt not in OK_PIX_FMTS:
+        reasons.append(f"pix_fmt={info.pix_fmt}")
+    if info.rotation:
+        reasons.append(f"rotation={info.rotation}")
+    if max(info.width, info.height) > MAX_DIMENSION:
+        reasons.append(f"size={info.width}x{info.height}")
+    if info.width % 2 or info.height % 2:
+        reasons.append(f"odd size={info.width}x{info.height}")
+    remux_only = not reasons
+    fmt = info.format.get("format_name") or ""
+    if not any(f in fmt.split(",") for f in OK_FORMATS):
+        reasons.append(f"format={fmt}")
+
+    if reasons and not NORMALIZE:
+        raise PreflightRejected(f"รูปแบบวิดีโอไม่รองรับ ({', '.join(reasons)})")
+    return reasons, remux_only and bool(reasons)
+
+
+def hvc1_tag(codec):
+    """HEVC ใน MP4 ต้อง tag hvc1 — ไม่งั้น QuickTime / iOS เล่นไม่ได้"""
+    return ["-tag:v", "hvc1"] if codec == "hevc" else []
+
+
+def normalize(src, dst, info, remux_only=False, cancel=None):
+    """แปลงเป็น H.264 yuv420p MP4 (หมุนภาพตาม rotation, ย่อถ้าใหญ่เกิน) — หรือแค่เปลี่ยน container"""
+    cmd = ["ffmpeg", "-y", "-i", src, "-map", "0:v:0", "-map", "0:a:0?"]
+    if remux_only:
+        # ภาพ copy ตามเดิม; เสียง (Vorbis / Opus ของ webm) → AAC ให้ MP4 รับได้แน่ๆ — ถูกแทนด้วยเสียงพากย์อยู่ดี
+        cmd += ["-c:v", "copy"] + hvc1_tag(info.video_codec) + ["-c:a", "aac", "-b:a", "128k"]
+    else:
+        w, h = info.display_size
+        vf = []
+        if max(w, h) > MAX_DIMENSION:
+            # ย่อด้านยาวลงเหลือ MAX_DIMENSION — อีกด้านตามสัดส่วน (เลขคู่)
+            vf.append(f"scale={MAX_DIMENSION}:-2" if w >= h else f"scale=-2:{MAX_DIMENSION}")
+        else:
+            vf.append("scale=trunc(iw/2)*2:trunc(ih/2)*2")
+        # ffmpeg หมุนภาพตาม display matrix ให้เองตอน decode (autorotate)
+        cmd += ["-vf", ",".join(vf), "-c:v", "libx264", "-preset", "veryfast", "-crf", "20",
+                "-pix_fmt", "yuv420p", "-c:a", "aac", "-b:a", "128k"]
+    cmd += ["-movflags", "+faststart", dst]
+    run_media(cmd, "normalize", cancel=cancel, capture_stdout=False)
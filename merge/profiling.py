@@ -0,0 +1,165 @@
+"""
+Opt-in profiling ของ pipeline — ดูว่า CPU หมดไปกับ Python เองแค่ไหน
+(base64 ของวิดีโอทั้งไฟล์, JSON, loop อ่าน ffmpeg progress, regex ของ xhs_resolve)
+
+- cProfile บน thread ของ job + thread ที่ job สร้างผ่าน bind() (เช่น reader ของ ffmpeg -progress)
+- ffmpeg ที่รันระหว่าง profile จะถูกใส่ -benchmark แล้วเก็บ utime/stime/rtime/maxrss
+- ปิดอยู่ (ค่า default) = ไม่มี hook อะไรทำงานเลย: current() เป็น None แล้วทุก helper คืนค่าเดิมทันที
+
+เปิดด้วย env PROFILE_JOBS=1 (ทุก job), payload {"profile": true} (job เดียว)
+หรือ ?profile=1 บน /merge, /xhs/resolve
+"""
+import os
+import re
+import cProfile
+import pstats
+import threading
+from contextlib import contextmanager
+
+ENABLED_DEFAULT = os.environ.get("PROFILE_JOBS", "0") == "1"
+TOP_N = int(os.environ.get("PROFILE_TOP", "25"))
+
+_local = threading.local()
+
+_BENCH_TIME_RE = re.compile(r"bench:\s+utime=([\d.]+)s\s+stime=([\d.]+)s\s+rtime=([\d.]+)s")
+_BENCH_RSS_RE = re.compile(r"bench:\s+maxrss=(\d+)\s*(KiB|kB)")
+
+
+class Session:
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._profiles = []
+        self.benchmarks = []
+
+    def add_profile(self, prof):
+        with self._lock:
+            self._profiles.append(prof)
+
+    def add_benchmark(self, entry):
+        with self._lock:
+            self.benchmarks.append(entry)
+
+    def report(self, top=TOP_N):
+        """สรุป top-N function ตาม cumulative และ self time + ผล ffmpeg -benchmark"""
+        with self._lock:
+            profiles = list(self._profiles)
+            benchmarks = list(self.benchmarks)
+        result = {"name": self.name, "threads": len(profiles), "ffmpeg_benchmark": benchmarks}
+        if not profiles:
+            return result
+        stats = pstats.Stats(profiles[0])
+        for p in profiles[1:]:
+            stats.add(p)
+
+        rows = []
+        for (filename, line, func), (cc, nc, tt, ct, _callers) in stats.stats.items():
+            rows.append({
+                "func": f"{os.path.basename(filename)}:{line}({func})",
+                "ncalls": nc,
+                "tottime": round(tt, 4),
+                "cumtime": round(ct, 4),
+            })
+        result["total_time"] = round(stats.total_tt, 4)
+        result["top_cumulative"] = sorted(rows, key=lambda r: r["cumtime"], reverse=True)[:top]
+        result["top_self"] = sorted(rows, key=lambda r: r["tottime"], reverse=True)[:top]
+        return result
+
+
+def current():
+    return getattr(_local, "session", None)
+
+
+def start(name, enabled):
+    """เริ่ม profile thread ปัจจุบัน — enabled=False คืน None และไม่ทำอะไรเลย"""
+    if not enabled:
+        return None
+    session = Session(name)
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError as e:
+        # Python 3.12+ ให้มี profiler ได้ทีละตัวทั้ง process
+        print(f"[PROFILE] {name}: skipped ({e})")
+        return None
+    _local.session = session
+    _local.profile = prof
+    return session
+
+
+def stop():
+    """หยุด profile ของ thread ปัจจุบัน แล้วคืน report (หรือ None ถ้าไม่ได้ profile)"""
+    session = getattr(_local, "session", None)
+    if session is None:
+        return None
+    prof = _local.profile
+    prof.disable()
+    session.add_profile(prof)
+    _local.session = None
+    _local.profile = None
+    report = session.report()
+    _print_summary(report)
+    return report
+
+
+@contextmanager
+def session(name, enabled=True):
+    s = start(name, enabled)
+    box = {"report": None}
+    try:
+        yield box
+    finally:
+        if s is not None:
+            box["report"] = stop()
+
+
+def bind(fn):
+    """ให้ thread ลูกที่ job สร้างถูก profile ด้วย — ถ้าไม่ได้ profile อยู่คืน fn เดิม"""
+    s = current()
+    if s is None:
+        return fn
+
+    def run(*args, **kwargs):
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            return fn(*args, **kwargs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            prof.disable()
+            s.add_profile(prof)
+    return run
+
+
+def ffmpeg_args(cmd):
+    """ใส่ -benchmark ให้ ffmpeg เมื่อกำลัง profile"""
+    if current() is None or not cmd or os.path.basename(cmd[0]) != "ffmpeg" or "-benchmark" in cmd:
+        return cmd
+    return [cmd[0], "-benchmark"] + list(cmd[1:])
+
+
+def observe_process(result):
+    """observer ของ mediaproc.run_media — เก็บ bench: ของ ffmpeg"""
+    s = current()
+    if s is None or "-benchmark" not in result.cmd:
+        return
+    entry = {"stage": result.stage, "wall": round(result.wall, 3), "cpu": round(result.cpu, 3)}
+    m = _BENCH_TIME_RE.search(result.stderr or "")
+    if m:
+        entry.update(utime=float(m.group(1)), stime=float(m.group(2)), rtime=float(m.group(3)))
+    m = _BENCH_RSS_RE.search(result.stderr or "")
+    if m:
+        entry["maxrss_kb"] = int(m.group(1))
+    s.add_benchmark(entry)
+
+
+def _print_summary(report, n=10):
+    print(f"[PROFILE] {report['name']}: python total={report.get('total_time', 0):.2f}s "
+          f"threads={report['threads']}")
+    for row in report.get("top_self", [])[:n]:
+        print(f"[PROFILE]   self={row['tottime']:.3f}s cum={row['cumtime']:.3f}s "
+              f"calls={row['ncalls']} {row['func']}")
+    for b in report.get("ffmpeg_benchmark", []):
+        print(f"[PROFILE]   ffmpeg {b}")
@@ -0,0 +1,195 @@
+"""
+รัน pipeline job ใน process แยก — process ของ HTTP server เหลือแค่ control plane
+(/health, /xhs/resolve, /jobs, /metrics) ไม่ต้องแย่ง GIL กับงาน base64 / JSON / Whisper ของ job
+
+parent (server.py):  runner.spawn(payload, job) → python runner.py <event fd> <control fd>
+child  (runner.py):  run_pipeline_bg(payload) (หรือ run_redub_bg ถ้า payload "kind" = "redub")
+                     แล้วส่ง event กลับเป็น JSON ทีละบรรทัด
+  {"type": "update", "job": {...}}      progress ของ job (Job.to_dict)
+  {"type": "metrics", "delta": {...}}   counter / histogram ที่เพิ่มขึ้น (metrics.diff)
+  {"type": "trace", "chrome": {...}}    Chrome trace ล่าสุดของ job
+  {"type": "finish", "status", "error"}
+parent → child:  {"type": "start", "payload": {...}}, {"type": "cancel", "reason": "..."}
+
+PIPELINE_PROCESSES=0 → รันเป็น thread ใน process เดียวแบบเดิม
+"""
+import os
+import sys
+import json
+import queue
+import threading
+import subprocess
+
+import jobs
+import metrics
+import tracing
+import warmup
+
+ENABLED = os.environ.get("PIPELINE_PROCESSES", "1") == "1"
+
+# นับใน parent ตอน jobs.finish อยู่แล้ว — ไม่ส่งซ้ำจาก child
+_LOCAL_ONLY = ("dubbing_jobs_total",)
+
+
+# ==================== parent ====================
+
+def spawn(payload, job):
+    """เริ่ม runner process ของ job — thread เล็กๆ ใน parent คอยรับ event และส่งคำสั่ง cancel"""
+    ev_r, ev_w = os.pipe()
+    ctl_r, ctl_w = os.pipe()
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), str(ev_w), str(ctl_r)],
+        pass_fds=(ev_w, ctl_r), cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    )
+    os.close(ev_w)
+    os.close(ctl_r)
+    events = os.fdopen(ev_r, "r", encoding="utf-8")
+    control = os.fdopen(ctl_w, "w", encoding="utf-8")
+    _send(control, {"type": "start", "payload": payload, "capabilities": warmup.capabilities()})
+    print(f"[RUNNER] videoId={job.video_id} → pid {proc.pid}")
+
+    threading.Thread(target=_pump, args=(proc, job, events), daemon=True,
+                     name=f"runner-{job.video_id}").start()
+    threading.Thread(target=_forward_cancel, args=(proc, job, control), daemon=True).start()
+    return proc
+
+
+def _pump(proc, job, events):
+    finished = False
+    with events:
+        for line in events:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            kind = msg.get("type")
+            if kind == "update":
+                job.apply(msg["job"])
+            elif kind == "metrics":
+                metrics.merge(msg["delta"])
+            elif kind == "trace":
+                tracing.store(job.video_id, msg["chrome"])
+            elif kind == "finish":
+                jobs.finish(job, msg["status"], msg.get("error", ""))
+                finished = True
+    code = proc.wait()
+    if not finished:
+        # process ตาย (OOM kill / crash) ก่อนรายงานผล — job ยังทำต่อจาก checkpoint ได้เมื่อ redispatch
+        print(f"[RUNNER] videoId={job.video_id} process exited with {code} before finishing")
+        jobs.finish(job, jobs.FAILED, f"pipeline process exited with code {code}")
+
+
+def _forward_cancel(proc, job, control):
+    """job.cancel ของ parent ถูกตั้ง (/jobs/<id>/cancel, cancel_previous) → บอก child"""
+    with control:
+        while proc.poll() is None:
+            if job.cancel.wait(1):
+                try:
+                    _send(control, {"type": "cancel", "reason": job.cancel.reason})
+                except (BrokenPipeError, OSError):
+                    pass
+                return
+
+
+def _send(f, msg):
+    f.write(json.dumps(msg, ensure_ascii=False) + "\n")
+    f.flush()
+
+
+# ==================== child ====================
+
+class _Channel:
+    """เขียน event กลับ parent — หลาย thread ใช้ร่วมกัน; parent ตายแล้วก็ทำงานต่อได้ (ทิ้ง event)"""
+
+    def __init__(self, fd):
+        self._f = os.fdopen(fd, "w", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self.closed = False
+
+    def send(self, msg):
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                _send(self._f, msg)
+            except (BrokenPipeError, OSError):
+                self.closed = True
+
+    def flush_metrics(self):
+        snap = metrics.snapshot(exclude=_LOCAL_ONLY)
+        delta = metrics.diff(snap, self._metrics)
+        self._metrics = snap
+        if delta:
+            self.send({"type": "metrics", "delta": delta})
+
+    def send_trace(self, video_id):
+        trace = tracing.get(video_id)
+        if trace:
+            self.send({"type": "trace", "chrome": trace.to_chrome()})
+
+
+def _child_main(ev_fd, ctl_fd):
+    import server
+
+    chan = _Channel(ev_fd)
+    control = os.fdopen(ctl_fd, "r", encoding="utf-8")
+    start = json.loads(control.readline() or "{}")
+    warmup.load(start.get("capabilities"))
+    payload = start.get("payload") or {}
+    video_id = payload.get("video_id")
+    kind = payload.get("kind") or jobs.PIPELINE
+    job = jobs.register(video_id, payload.get("chat_id"), kind=kind)
+
+    def listen():
+        for line in control:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if msg.get("type") == "cancel":
+                job.cancel.cancel(msg.get("reason") or "cancelled")
+
+    threading.Thread(target=listen, daemon=True).start()
+
+    q = job.subscribe()
+    stop = threading.Event()
+
+    def forward():
+        last_step = None
+        while not stop.is_set() or not q.empty():
+            try:
+                event = q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if event["status"] != jobs.RUNNING:
+                continue   # ผลสุดท้ายส่งเป็น "finish" หลัง flush metrics / trace
+            chan.send({"type": "update", "job": event})
+            # ทุกครั้งที่ขึ้น step ใหม่ → ส่ง metrics + trace ให้ /metrics, /jobs/<id>/trace ของ parent ทันสมัย
+            if int(event["step"] or 0) != last_step:
+                last_step = int(event["step"] or 0)
+                chan.flush_metrics()
+                chan.send_trace(video_id)
+
+    forwarder = threading.Thread(target=forward, daemon=True)
+    forwarder.start()
+    error = ""
+    try:
+        (server.run_redub_bg if kind == jobs.REDUB else server.run_pipeline_bg)(payload, job)
+    except Exception as e:
+        # payload ไม่ครบ ฯลฯ — พังก่อน run_pipeline_bg จะจัดการสถานะเอง
+        import traceback
+        print(f"[RUNNER] videoId={video_id} crashed: {e}\n{traceback.format_exc()}")
+        error = str(e)
+    finally:
+        stop.set()
+        forwarder.join(timeout=5)
+        chan.flush_metrics()
+        chan.send_trace(video_id)
+        status = job.status if job.status != jobs.RUNNING else jobs.FAILED
+        chan.send({"type": "finish", "status": status, "error": job.error or error})
+
+
+if __name__ == "__main__":
+    _child_main(int(sys.argv[1]), int(sys.argv[2]))
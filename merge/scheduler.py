@@ -0,0 +1,285 @@
+"""
+คิว pipeline ใน container แบบ weighted fair ต่อ chat_id
+- แต่ละ chat มีคิวย่อยของตัวเอง; job ถัดไปมาจาก chat ที่ได้รับบริการน้อยที่สุด (เทียบตามน้ำหนัก)
+  → คนที่ส่ง 20 คลิปรวดไม่ทำให้คนที่ส่ง 1 คลิปต้องรอทั้งหมด
+- start-time fair queuing: chat มี virtual time (จำนวน job ที่ได้เริ่ม / น้ำหนัก)
+  chat ที่เพิ่งกลับมามีงาน เริ่มที่ virtual clock ปัจจุบัน (ไม่สะสมเครดิตตอนว่าง)
+- รันพร้อมกันได้ PIPELINE_CONCURRENCY job, น้ำหนักต่อ chat: TENANT_WEIGHTS="<chat_id>:2,<chat_id>:0.5" หรือ "weight" ใน payload
+- เก็บเวลารอคิวต่อ chat (GET /scheduler)
+- ลำดับคิวเปลี่ยน → on_waiting (SSE, ใน memory); งานที่ต้องเรียก network (ต่ออายุ R2 _processing ทุก
+  QUEUE_HEARTBEAT, ปิดงานที่ถูกยกเลิกระหว่างรอ) ไปทำใน notifier thread — Worker ช้า / ล่มไม่ทำให้คิวค้าง
+job ที่ถูกยกเลิกระหว่างรอ → จบเป็น cancelled ทันทีโดยไม่เริ่ม (ไม่ spawn runner / จอง disk)
+"""
+import os
+import time
+import queue
+import threading
+from collections import deque
+
+import jobs
+import metrics
+
+CONCURRENCY = max(1, int(os.environ.get("PIPELINE_CONCURRENCY", "2")))
+# job ที่รอคิวอยู่ต่ออายุสถานะใน R2 (on_heartbeat) ทุกกี่วินาที — กัน watchdog ของ Worker ถือว่าค้าง
+HEARTBEAT = float(os.environ.get("QUEUE_HEARTBEAT", "300"))
+# จำนวนเวลารอล่าสุดที่เก็บต่อ chat
+WAIT_SAMPLES = 100
+
+
+def _parse_weights(spec):
+    weights = {}
+    for item in (spec or "").split(","):
+        key, _, value = item.strip().partition(":")
+        if key and value:
+            try:
+                weights[key] = max(0.01, float(value))
+            except ValueError:
+                pass
+    return weights
+
+
+WEIGHTS = _parse_weights(os.environ.get("TENANT_WEIGHTS", ""))
+
+
+class _Tenant:
+    def __init__(self, key, weight):
+        self.key = key
+        self.weight = weight
+        self.queue = deque()        # (job, payload, enqueued_at)
+        self.vtime = 0.0
+        self.started = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+
+_cond = threading.Condition()
+_tenants = {}        # chat_id (str) → _Tenant
+_running = set()     # video_id
+_vclock = 0.0
+_start_fn = None
+_on_waiting = None     # callback(job, position) — ลำดับคิวเปลี่ยน (SSE) เรียกจาก dispatcher, ต้องไม่ block
+_on_heartbeat = None   # callback(job, payload, position) — ต่ออายุ R2 _processing (notifier thread)
+_on_withdrawn = None   # callback(job, payload) — เก็บกวาดหลังยกเลิกระหว่างรอ (notifier thread)
+_notified = {}         # video_id → (position ที่แจ้งล่าสุด, monotonic time ที่ heartbeat ล่าสุด)
+_thread = None
+_notifier = None
+_outbox = queue.Queue()   # งาน network ของ notifier — heartbeat ของ job เดียวกันรวมเหลืออันล่าสุด
+_heartbeats = {}          # video_id → (job, payload, position) ที่รอส่ง
+_heartbeats_lock = threading.Lock()
+
+
+def _tenant(chat_id, weight=None):
+    key = str(chat_id)
+    t = _tenants.get(key)
+    if t is None:
+        t = _tenants[key] = _Tenant(key, WEIGHTS.get(key, 1.0))
+    if weight and key not in WEIGHTS:
+        t.weight = max(0.01, float(weight))
+    return t
+
+
+def _order():
+    """ลำดับ video_id ที่จะได้เริ่ม (จำลองการเลือกตาม virtual time ปัจจุบัน)"""
+    sim = {k: [t.vtime, t.weight, list(t.queue)] for k, t in _tenants.items() if t.queue}
+    order = []
+    while sim:
+        key = min(sim, key=lambda k: (sim[k][0], sim[k][2][0][2]))
+        vtime, weight, queue = sim[key]
+        order.append(queue.pop(0)[0].video_id)
+        if queue:
+            sim[key][0] = vtime + 1.0 / weight
+        else:
+            del sim[key]
+    return order
+
+
+def _pick():
+    """เลือก job ถัดไป: chat ที่ virtual time ต่ำสุด (เท่ากัน → job ที่รอนานกว่า)"""
+    global _vclock
+    tenant = min((t for t in _tenants.values() if t.queue), key=lambda t: (t.vtime, t.queue[0][2]))
+    job, payload, enqueued_at = tenant.queue.popleft()
+    _vclock = tenant.vtime
+    tenant.vtime += 1.0 / tenant.weight
+    tenant.started += 1
+    tenant.waits.append(time.time() - enqueued_at)
+    return tenant, job, payload, enqueued_at
+
+
+def configure(start_fn, on_waiting=None, on_heartbeat=None, on_withdrawn=None):
+    """start_fn(payload, job): เริ่ม job จริง (thread / runner process) — เรียกครั้งเดียวตอน import server"""
+    global _start_fn, _on_waiting, _on_heartbeat, _on_withdrawn
+    _start_fn = start_fn
+    _on_waiting = on_waiting
+    _on_heartbeat = on_heartbeat
+    _on_withdrawn = on_withdrawn
+    jobs.on_finish(_finished)
+
+
+def submit(payload, job):
+    """เข้าคิวของ chat เจ้าของ job — dispatcher เริ่มให้เมื่อมี slot ว่างและถึงตา"""
+    global _thread
+    with _cond:
+        tenant = _tenant(job.chat_id, payload.get("weight"))
+        if not tenant.queue:
+            # เพิ่งกลับมามีงาน → เริ่มที่ virtual clock ปัจจุบัน ไม่ได้เปรียบจากช่วงที่ว่าง
+            tenant.vtime = max(tenant.vtime, _vclock)
+        tenant.queue.append((job, payload, time.time()))
+        # heartbeat แรกหลังเข้าคิว HEARTBEAT วินาที (Worker เพิ่งเขียน _processing ตอนส่งงาน)
+        _notified[job.video_id] = (None, time.monotonic())
+        if _thread is None:
+            _thread = threading.Thread(target=_dispatch_loop, daemon=True, name="scheduler")
+            _thread.start()
+        _cond.notify_all()
+
+
+def _finished(job):
+    with _cond:
+        if job.video_id in _running:
+            _running.discard(job.video_id)
+            _cond.notify_all()
+
+
+def _withdraw_cancelled():
+    """job ที่ถูกยกเลิกระหว่างรอ — เอาออกจากคิว (ไม่กิน slot, ไม่นับเป็นบริการของ chat)"""
+    out = []
+    for t in _tenants.values():
+        keep = deque()
+        for entry in t.queue:
+            (out if entry[0].cancel.cancelled else keep).append(entry)
+        t.queue = keep
+    return out
+
+
+def _dispatch_loop():
+    while True:
+        to_start, withdrawn, moved = [], [], []
+        with _cond:
+            if len(_running) >= CONCURRENCY or not any(t.queue for t in _tenants.values()):
+                # ตื่นทุกวินาทีเพื่อปล่อย job ที่ถูกยกเลิกระหว่างรอ + heartbeat
+                _cond.wait(timeout=1.0)
+            for job, payload, _ in _withdraw_cancelled():
+                _notified.pop(job.video_id, None)
+                withdrawn.append((job, payload))
+            while len(_running) < CONCURRENCY and any(t.queue for t in _tenants.values()):
+                tenant, job, payload, enqueued_at = _pick()
+                _running.add(job.video_id)
+                _notified.pop(job.video_id, None)
+                metrics.QUEUE_WAIT.observe(time.time() - enqueued_at)
+                to_start.append((job, payload, tenant))
+            now = time.monotonic()
+            entries = {e[0].video_id: e for t in _tenants.values() for e in t.queue}
+            for position, video_id in enumerate(_order(), 1):
+                last_position, last_beat = _notified.get(video_id, (None, now))
+                job, payload = entries[video_id][:2]
+                if last_position != position:
+                    moved.append((job, position))
+                if now - last_beat > HEARTBEAT:
+                    last_beat = now
+                    _post_heartbeat(job, payload, position)
+                _notified[video_id] = (position, last_beat)
+
+        for job, payload in withdrawn:
+            # ไม่เริ่ม job ที่ผู้ใช้ยกเลิกแล้ว — จบตรงนี้ (คืน slot ผ่าน _finished ไม่ได้เพราะไม่เคยอยู่ใน _running)
+            print(f"[SCHED] Withdrawn {job.video_id} before start ({job.cancel.reason})")
+            jobs.finish(job, jobs.CANCELLED, job.cancel.reason or "cancelled")
+            if _on_withdrawn:
+                _outbox.put(("withdrawn", job, payload))
+                _ensure_notifier()
+        for job, payload, tenant in to_start:
+            print(f"[SCHED] Start {job.video_id} (chat {tenant.key}, waited {tenant.waits[-1]:.1f}s, "
+                  f"{len(_running)}/{CONCURRENCY} running)")
+            try:
+                _start_fn(payload, job)
+            except Exception as e:
+                print(f"[SCHED] Failed to start {job.video_id}: {e}")
+                jobs.finish(job, jobs.FAILED, str(e))
+        if _on_waiting:
+            for job, position in moved:
+                try:
+                    _on_waiting(job, position)
+                except Exception as e:
+                    print(f"[SCHED] on_waiting error: {e}")
+
+
+def _post_heartbeat(job, payload, position):
+    """ส่ง heartbeat ให้ notifier — ยังไม่ได้ส่งของ job นี้ก็แค่แทนที่ด้วยลำดับล่าสุด"""
+    if not _on_heartbeat:
+        return
+    with _heartbeats_lock:
+        pending = job.video_id in _heartbeats
+        _heartbeats[job.video_id] = (job, payload, position)
+    if not pending:
+        _outbox.put(("heartbeat", job.video_id))
+    _ensure_notifier()
+
+
+def _ensure_notifier():
+    global _notifier
+    with _heartbeats_lock:
+        if _notifier is None:
+            _notifier = threading.Thread(target=_notify_loop, daemon=True, name="scheduler-notify")
+            _notifier.start()
+
+
+def _is_queued(job):
+    with _cond:
+        return any(e[0] is job for t in _tenants.values() for e in t.queue)
+
+
+def _notify_loop():
+    """งานที่เรียก Worker / R2 — ช้าหรือ error ไม่กระทบ dispatcher"""
+    while True:
+        item = _outbox.get()
+        try:
+            if item[0] == "heartbeat":
+                with _heartbeats_lock:
+                    entry = _heartbeats.pop(item[1], None)
+                # เริ่มไปแล้ว / ถูกยกเลิกระหว่างรอส่ง → ไม่ต้องต่ออายุ
+                if entry and not entry[0].cancel.cancelled and _is_queued(entry[0]):
+                    _on_heartbeat(*entry)
+            else:
+                _on_withdrawn(item[1], item[2])
+        except Exception as e:
+            print(f"[SCHED] {item[0]} notify error: {e}")
+
+
+def queue_depth():
+    with _cond:
+        return sum(len(t.queue) for t in _tenants.values())
+
+
+def running_count():
+    with _cond:
+        return len(_running)
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 2)
+
+
+def stats():
+    """สถานะคิว + เวลารอต่อ chat (เฉพาะ chat ที่เคยมีงานใน container นี้)"""
+    with _cond:
+        order = _order()
+        tenants = {}
+        for key, t in _tenants.items():
+            waits = list(t.waits)
+            tenants[key] = {
+                "weight": t.weight,
+                "queued": len(t.queue),
+                "started": t.started,
+                "vtime": round(t.vtime, 3),
+                "oldest_wait": round(time.time() - t.queue[0][2], 1) if t.queue else None,
+                "wait_p50": _percentile(waits, 0.5) if waits else None,
+                "wait_p90": _percentile(waits, 0.9) if waits else None,
+                "wait_max": round(max(waits), 2) if waits else None,
+            }
+        all_waits = [w for t in _tenants.values() for w in t.waits]
+        return {
+            "concurrency": CONCURRENCY,
+            "running": sorted(_running),
+            "queued": order,
+            "wait_p50": _percentile(all_waits, 0.5) if all_waits else None,
+            "wait_p90": _percentile(all_waits, 0.9) if all_waits else None,
+            "tenants": tenants,
+        }
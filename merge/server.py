@@ -7,36 +7,113 @@ Dubbing Container Service — Cloudflare Container
 import os
 import base64
 import tempfile
-import subprocess
 import json
 import re
+import shutil
+import time
 import threading
 import requests as http_requests
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
+from contextlib import contextmanager
+from functools import wraps
+import capacity
+import checkpoint
+import downloader
+import governor
+import jobs
+import mediaproc
+import metrics
+import profiling
+import runner
+import scheduler
+import sourcecache
+import storage
+import tracing
+import warmup
+import workspace
+import xhs
+from mediaproc import run_media, JobCancelled, ProcessFailed, ProcessTimeout
 
 app = Flask(__name__)
 CORS(app)
 
+mediaproc.add_observer(metrics.observe_process)
+mediaproc.add_observer(tracing.observe_process)
+mediaproc.add_observer(profiling.observe_process)
+metrics.JOBS_ACTIVE.set_function(lambda: len(jobs.active_jobs()))
+metrics.JOBS_QUEUED.set_function(lambda: sum(1 for j in jobs.active_jobs() if j.step == 0))
+metrics.CPU_THREADS.set_function(lambda: governor.status().get("threads_allocated", 0))
+metrics.SOURCE_CACHE_BYTES.set_function(lambda: sourcecache.stats()["bytes"])
+
+# /pipeline: ยกเลิกงานเก่าของ chat_id เดียวกันอัตโนมัติ (payload "cancel_previous" override ได้)
+CANCEL_PREVIOUS_DEFAULT = os.environ.get("CANCEL_PREVIOUS_ON_DUPLICATE", "0") == "1"
+
+# /pipeline: submission ซ้ำของ video_url เดิมจาก chat เดียวกัน (คนละ video_id) → ผูกกับ job ที่รันอยู่
+DEDUP_BY_URL = os.environ.get("DEDUP_BY_URL", "1") == "1"
+
+# เขียน trace ของ job ที่จบแล้วลง R2 videos/{id}_trace.json (ข้าง metadata, อ้างใน "traceKey") ด้วย
+TRACE_UPLOAD = os.environ.get("TRACE_UPLOAD", "0") == "1"
+
+# base URL ของ API ภายนอก — ชี้ไป mock server (scripts/mock_services.py) ตอน load test แบบ offline
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+
+# เสียงพากย์ของ Gemini TTS (prebuilt voice) — payload "voice" ของ /pipeline, /redub override ได้
+TTS_VOICE = os.environ.get("TTS_VOICE", "Puck")
+
+# โฟลเดอร์ที่มี font.ttf ให้ libass (Dockerfile copy ไว้ที่ /app)
+FONTS_DIR = os.environ.get("FONTS_DIR", "/app")
+
+# step ย่อยระหว่าง step หลัก (ดาวน์โหลด %, ฝังซับ %) เขียนลง R2 _processing ห่างกันอย่างน้อยกี่วินาที
+R2_PROGRESS_INTERVAL = float(os.environ.get("R2_PROGRESS_INTERVAL", "5"))
+
+
+def _profiled(view):
+    """?profile=1 → profile request นี้ แล้วแนบ report เป็น "profile" ใน JSON response"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.args.get("profile") != "1":
+            return view(*args, **kwargs)
+        with profiling.session(f"{request.path}") as box:
+            resp = app.make_response(view(*args, **kwargs))
+        if box["report"] and resp.is_json:
+            body = resp.get_json()
+            if isinstance(body, dict):
+                body["profile"] = box["report"]
+                resp.set_data(json.dumps(body, ensure_ascii=False))
+        return resp
+    return wrapper
+
 
 @app.route("/health", methods=["GET"])
 def health():
-    """Health check — Container class ใช้เช็คว่า container พร้อมรับงาน"""
-    # ตรวจว่า ffmpeg ใช้งานได้
-    try:
-        result = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True)
-        ffmpeg_ok = result.returncode == 0
-    except Exception:
-        ffmpeg_ok = False
-
+    """Health check — Container class ใช้เช็คว่า container พร้อมรับงาน
+    ใช้ผล probe ffmpeg ที่ cache ไว้ (warmup.py) ไม่ spawn process และไม่รอ probe
+    ยัง probe ไม่เสร็จ (ช่วง boot) → 200 พร้อม "ffmpeg": "probing" — job ที่ส่งมาจะเข้าคิวรอตามปกติ"""
+    caps = warmup.cached_capabilities()
+    if caps is None:
+        warmup.start()   # dev server ที่ไม่ได้เรียก warmup ตอน boot — เริ่ม probe ใน background
+    ready, _ = warmup.status()
+    ffmpeg_ok = caps["ffmpeg"] if caps else "probing"
     return jsonify({
-        "status": "ok" if ffmpeg_ok else "error",
+        "status": "error" if ffmpeg_ok is False else "ok",
         "service": "dubbing-merge-container",
         "ffmpeg": ffmpeg_ok,
+        "ready": ready,
     })
 
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness — 200 เมื่อ warmup เสร็จ (font cache, Whisper weights, connection pool) และ ffmpeg ใช้ได้
+    ยังไม่พร้อม → 503 พร้อมรายละเอียดของแต่ละ check"""
+    is_ready, detail = warmup.status()
+    return jsonify({"ready": is_ready, **detail}), 200 if is_ready else 503
+
+
 @app.route("/merge", methods=["POST"])
+@_profiled
 def merge():
     """
     รับ video URL + audio base64 → ffmpeg merge → ส่ง merged video กลับ
@@ -48,6 +125,7 @@ def merge():
 
     Response JSON: { video_base64, thumb_base64, duration, ... }
     """
+    import mediainfo
     try:
         data = request.get_json()
         if not data:
@@ -63,84 +141,34 @@ def merge():
         with tempfile.TemporaryDirectory() as tmpdir:
             # ดาวน์โหลด video จาก URL
             print(f"[MERGE] Downloading video from: {video_url[:80]}...")
-            video_resp = http_requests.get(video_url, timeout=60)
-            if video_resp.status_code != 200:
-                return jsonify({"error": f"Failed to download video: {video_resp.status_code}"}), 400
-
             video_path = os.path.join(tmpdir, "video.mp4")
-            with open(video_path, "wb") as f:
-                f.write(video_resp.content)
-            print(f"[MERGE] Downloaded video: {len(video_resp.content) / 1024 / 1024:.1f} MB")
-
-            # ดึง video duration ด้วย ffprobe
-            probe = subprocess.run([
-                "ffprobe", "-v", "error", "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1", video_path
-            ], capture_output=True, text=True)
-            duration = float(probe.stdout.strip()) if probe.stdout.strip() else 10.0
-
-            # Decode audio base64 → raw PCM
-            raw_audio = os.path.join(tmpdir, "audio.raw")
-            wav_audio = os.path.join(tmpdir, "audio.wav")
-            with open(raw_audio, "wb") as f:
-                f.write(base64.b64decode(audio_base64))
-
-            # แปลง raw PCM → WAV
-            subprocess.run([
-                "ffmpeg", "-y", "-f", "s16le", "-ar", str(sample_rate), "-ac", "1",
-                "-i", raw_audio, wav_audio
-            ], check=True, capture_output=True)
-
-            # ดึง audio duration
-            ap = subprocess.run([
-                "ffprobe", "-v", "error", "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1", wav_audio
-            ], capture_output=True, text=True)
-            audio_dur = float(ap.stdout.strip()) if ap.stdout.strip() else 0
-
-            # ปรับ audio ให้ตรงกับ video duration
-            adjusted = os.path.join(tmpdir, "audio_adj.wav")
-            diff = duration - audio_dur
-            if abs(diff) < 0.5:
-                adjusted = wav_audio
-            elif diff > 0:
-                # Audio สั้นกว่า video → pad silence
-                subprocess.run([
-                    "ffmpeg", "-y", "-i", wav_audio,
-                    "-af", f"apad=pad_dur={diff}", adjusted
-                ], capture_output=True)
-            else:
-                # Audio ยาวกว่า video → trim
-                subprocess.run([
-                    "ffmpeg", "-y", "-i", wav_audio,
-                    "-t", str(duration), adjusted
-                ], capture_output=True)
+            try:
+                size = sourcecache.fetch(video_url, video_path)
+            except downloader.DownloadError as e:
+                return jsonify({"error": f"Failed to download video: {e.status or e}"}), 400
+            print(f"[MERGE] Downloaded video: {size / 1024 / 1024:.1f} MB")
+
+            try:
+                duration = mediainfo.probe(video_path).duration or 10.0
+            except mediainfo.ProbeError as e:
+                return jsonify({"error": f"Unreadable video: {e}"}), 400
+
+            # raw PCM → WAV แล้ว pad / ตัดให้ยาวเท่า video
+            adjusted = _prepare_audio(base64.b64decode(audio_base64), duration, tmpdir, sample_rate=sample_rate)
 
             # Merge video + audio
             output_path = os.path.join(tmpdir, "output.mp4")
-            mr = subprocess.run([
-                "ffmpeg", "-y", "-i", video_path, "-i", adjusted,
-                "-c:v", "copy", "-c:a", "aac",
-                "-map", "0:v:0", "-map", "1:a:0",
-                "-t", str(duration), output_path
-            ], capture_output=True, text=True)
-            if mr.returncode != 0:
-                return jsonify({"error": f"FFmpeg merge failed: {mr.stderr[:300]}"}), 500
-
-            # ดึง output duration
-            op = subprocess.run([
-                "ffprobe", "-v", "error", "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1", output_path
-            ], capture_output=True, text=True)
-            out_dur = float(op.stdout.strip()) if op.stdout.strip() else duration
+            try:
+                _mux_audio(video_path, adjusted, duration, output_path)
+            except Exception as e:
+                return jsonify({"error": f"FFmpeg merge failed: {str(e)[-300:]}"}), 500
+
+            # mux ใช้ -t duration → output ยาวเท่า video ไม่ต้อง probe ซ้ำ
+            out_dur = duration
 
             # สร้าง thumbnail
             thumb_path = os.path.join(tmpdir, "thumb.webp")
-            subprocess.run([
-                "ffmpeg", "-y", "-i", output_path, "-vframes", "1", "-ss", "0.1",
-                "-vf", "scale=270:480:force_original_aspect_ratio=increase,crop=270:480",
-                "-q:v", "80", thumb_path
-            ], capture_output=True)
+            _make_thumbnail(output_path, thumb_path)
 
             # อ่าน output video
             with open(output_path, "rb") as f:
@@ -173,25 +201,14 @@ def merge():
 
 # ==================== XHS Video Resolver ====================
 
-XHS_HEADERS = {
-    # Desktop UA เพื่อให้ได้ clean URL เหมือน Playwright
-    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
-    "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-    "Cache-Control": "max-age=0",
-    "Sec-Ch-Ua": '"Not_A Brand";v="8", "Chromium";v="120", "Google Chrome";v="120"',
-    "Sec-Ch-Ua-Mobile": "?0",
-    "Sec-Ch-Ua-Platform": '"macOS"',
-}
-
-
 @app.route("/xhs/resolve", methods=["POST"])
+@_profiled
 def xhs_resolve():
     """
     รับ XHS URL → resolve เป็น direct video URL
 
     Request JSON: {"url": "https://xhslink.com/..."}
-    Response JSON: {"video_url": "https://..."} or {"error": "..."}
+    Response JSON: {"video_url": "https://...", "cached": bool} or {"error": "..."}
     """
     try:
         data = request.get_json()
@@ -199,61 +216,47 @@ def xhs_resolve():
         if not url:
             return jsonify({"error": "url required"}), 400
 
-        print(f"[XHS] Resolving: {url}")
-
-        # Follow redirects เพื่อได้ URL จริง
-        session = http_requests.Session()
-        resp = session.get(url, headers=XHS_HEADERS, allow_redirects=True, timeout=15)
-        final_url = resp.url
-        html = resp.text
-        print(f"[XHS] Final URL: {final_url}")
-
-        # หา video URL จาก HTML
-        video_url = None
-
-        # Pattern 1: masterUrl (H264 stream - usually clean)
-        # มองหา "masterUrl":"http..." ใน JSON
-        master_matches = re.finditer(r'"masterUrl"\s*:\s*"([^"]+)"', html)
-        for m in master_matches:
-            url_cand = m.group(1).replace("\\u002F", "/")
-            if "sns-video" in url_cand:
-                video_url = url_cand
-                print(f"[XHS] Found via masterUrl (Priority): {video_url}")
-                break
-
-        # Pattern 2: originVideoKey (Backup)
-        if not video_url:
-            json_match = re.search(r'"originVideoKey"\s*:\s*"([^"]+)"', html)
-            if json_match:
-                key = json_match.group(1)
-                video_url = f"https://sns-video-bd.xhscdn.com/{key}"
-                print(f"[XHS] Found via originVideoKey: {video_url}")
-
-        # Pattern 3: video src / url
-        if not video_url:
-            video_match = re.search(r'"url"\s*:\s*"(https?://sns-video[^"]+)"', html)
-            if video_match:
-                video_url = video_match.group(1).replace("\\u002F", "/")
-                print(f"[XHS] Found via url pattern: {video_url}")
-
-        if not video_url:
-            print(f"[XHS] No video found in HTML (length={len(html)})")
-            return jsonify({"error": "ไม่พบวิดีโอใน XHS link นี้"}), 404
-
-        return jsonify({"video_url": video_url})
+        video_url, cached = xhs.resolve(url)
+        return jsonify({"video_url": video_url, "cached": cached})
 
+    except xhs.VideoNotFound as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         import traceback
         print(f"[XHS] Error: {e}\n{traceback.format_exc()}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/xhs/resolve/batch", methods=["POST"])
+@_profiled
+def xhs_resolve_batch():
+    """
+    resolve หลาย XHS link พร้อมกัน
+
+    Request JSON: {"urls": ["https://xhslink.com/...", ...]}
+    Response JSON: {"results": [{"url", "video_url", "cached"} | {"url", "error"}, ...]} (ลำดับเดียวกับ urls)
+    """
+    data = request.get_json(silent=True) or {}
+    urls = data.get("urls")
+    if not isinstance(urls, list) or not urls or not all(isinstance(u, str) and u.strip() for u in urls):
+        return jsonify({"error": "urls (non-empty list of strings) required"}), 400
+    if len(urls) > xhs.BATCH_MAX:
+        return jsonify({"error": f"too many urls (max {xhs.BATCH_MAX})"}), 400
+    return jsonify({"results": xhs.resolve_many(urls)})
+
+
 
 
 # ==================== Full Pipeline (async background) ====================
 
+@contextmanager
+def _stage(name, **args):
+    """จับเวลา stage → dubbing_stage_seconds + span ใน trace ของ job"""
+    with metrics.stage(name), tracing.span(name, cat="stage", **args):
+        yield
+
 def send_telegram(token, method, payload):
-    url = f"https://api.telegram.org/bot{token}/{method}"
+    url = f"{TELEGRAM_API_BASE}/bot{token}/{method}"
     resp = http_requests.post(url, json=payload, timeout=30)
     return resp.json()
 
@@ -304,8 +307,11 @@ class DotAnimator:
             self._stop.set()
             self._thread.join(timeout=3)
 
-def run_pipeline_bg(payload):
+def run_pipeline_bg(payload, job=None):
     """รัน full pipeline ใน background thread — ไม่มี time limit"""
+    # import ตอนใช้ครั้งแรก — process ของ control plane (/health, /xhs/resolve) ไม่ต้องโหลด
+    import mediainfo
+    import preflight
     token = payload["token"]
     video_url = payload["video_url"]
     chat_id = payload["chat_id"]
@@ -314,12 +320,32 @@ def run_pipeline_bg(payload):
     model = payload.get("model", "gemini-2.0-flash")
     r2_public_url = payload["r2_public_url"]
     worker_url = payload["worker_url"]
+    voice = payload.get("voice")
 
     import uuid, time
     video_id = payload.get("video_id") or uuid.uuid4().hex[:8]
+    if job is None:
+        job = jobs.register(video_id, chat_id)
+    cancel = job.cancel
+    tracing.start(video_id)
+    # PROFILE_JOBS=1 หรือ payload "profile": true → cProfile + ffmpeg -benchmark ติดไปกับ trace
+    profiling.start(video_id, payload.get("profile", profiling.ENABLED_DEFAULT))
+
+    last_r2_status = [0.0]
+
+    def _r2_status_due(step):
+        """step ย่อย (ทศนิยม) เขียนลง R2 ไม่ถี่กว่า R2_PROGRESS_INTERVAL — ดูละเอียดได้ที่ /jobs/<id>/events"""
+        now = time.monotonic()
+        if step is not None and step != int(step) and now - last_r2_status[0] < R2_PROGRESS_INTERVAL:
+            return False
+        last_r2_status[0] = now
+        return True
 
     def _update_step(step, step_name):
         """อัปเดตสถานะ step ใน R2 _processing queue"""
+        job.update(step=step, step_name=step_name)
+        if not _r2_status_due(step):
+            return
         try:
             url = f"{worker_url}/api/r2-proxy/_processing/{video_id}.json"
             get_req = http_requests.get(url, headers={'x-auth-token': token}, timeout=10)
@@ -334,112 +360,170 @@ def run_pipeline_bg(payload):
         except Exception as e:
             print(f"[PIPELINE] Step update error: {e}")
 
+    last_touch = [0.0]
+
+    def _waiting_for_disk(need, available):
+        """รอ disk ได้นานถึง WORKSPACE_ADMIT_TIMEOUT — ต่ออายุ _processing ทุก QUEUE_HEARTBEAT
+        (watchdog ของ Worker ถือว่าค้างหลัง 15 นาทีแล้วส่งงานซ้ำ ทั้งที่ container ยังถืออยู่)"""
+        step_name = f"⏳ รอพื้นที่ดิสก์ ({need/1024/1024:.0f} MB)"
+        job.update(step_name=step_name)
+        now = time.monotonic()
+        if now - last_touch[0] < scheduler.HEARTBEAT:
+            return
+        last_touch[0] = now
+        try:
+            _touch_processing(payload, video_id, step_name)
+        except Exception as e:
+            print(f"[PIPELINE] Disk wait heartbeat error: {e}")
+
     anim = DotAnimator(token, chat_id, msg_id)
+    state = None
+    ws = None
 
     try:
+        state = checkpoint.JobState(video_id)
+        resumed_from = state.begin(payload)
+        if resumed_from:
+            print(f"[PIPELINE] Resuming videoId={video_id} after stage '{resumed_from}'")
+        original_path = state.path("original.mp4")
+
+        # ── จองพื้นที่ disk ตามขนาดต้นฉบับ — disk ไม่พอจะรอจน job อื่นคืนพื้นที่ ──
+        if state.has_file("original.mp4"):
+            source_bytes = os.path.getsize(original_path)
+        else:
+            source_bytes = downloader.remote_size(video_url)
+        ws = workspace.admit(video_id, state.dir, source_bytes, cancel, on_wait=_waiting_for_disk)
+
         # ── Step 1: ดาวน์โหลดวิดีโอ ──
         _update_step(1, "📥 ดาวน์โหลดวิดีโอ")
         anim.start("📥 กำลังดาวน์โหลดวิดีโอ")
 
-        print(f"[PIPELINE] Downloading: {video_url[:80]}")
-        vr = http_requests.get(video_url, stream=True, timeout=120)
-        if vr.status_code != 200:
-            raise Exception(f"Download failed: {vr.status_code}")
-        
-        total_size = int(vr.headers.get('content-length', 0))
-        video_bytes = bytearray()
-        last_pct = 0
-        for chunk in vr.iter_content(chunk_size=1024*1024):
-            if chunk:
-                video_bytes.extend(chunk)
-                if total_size > 0:
-                    pct = len(video_bytes) / total_size
-                    # Only update every 10% or strictly to reduce R2 spam
-                    if pct - last_pct > 0.1 or pct == 1.0:
-                        _update_step(1.0 + (pct * 0.9), f"📥 กำลังดาวน์โหลดวิดีโอ... ({len(video_bytes)/1024/1024:.1f}MB)")
-                        last_pct = pct
-
-        video_bytes = bytes(video_bytes)
-        print(f"[PIPELINE] Downloaded: {len(video_bytes)/1024/1024:.1f} MB")
-
-        # อัพโหลด original ไป R2 ผ่าน Worker proxy
-        _r2_put(worker_url, token,
-                f"videos/{video_id}_original.mp4", video_bytes, "video/mp4")
+        if state.done("download") and state.has_file("original.mp4"):
+            print(f"[PIPELINE] Using checkpointed original: {os.path.getsize(original_path)/1024/1024:.1f} MB")
+        else:
+            print(f"[PIPELINE] Downloading: {video_url[:80]}")
+            with _stage("download", url=video_url[:120]):
+                size = sourcecache.fetch(video_url, original_path, cancel,
+                                           on_progress=lambda pct, done: _update_step(
+                                               1.0 + (pct * 0.9), f"📥 กำลังดาวน์โหลดวิดีโอ... ({done/1024/1024:.1f}MB)"))
+            print(f"[PIPELINE] Downloaded: {size/1024/1024:.1f} MB")
+            state.mark("download", original_path=original_path)
+
+        # ── Preflight: ตรวจ / แปลงไฟล์ก่อนจ่ายค่า Gemini + TTS ──
+        if state.done("preflight"):
+            media = mediainfo.MediaInfo.from_dict(state.get("media"), original_path)
+            mediainfo.remember(original_path, media)
+        else:
+            with _stage("preflight"):
+                media, normalized = _preflight(original_path, cancel)
+            # อัพโหลด original ไป R2 (stream จาก disk)
+            _r2_put(worker_url, token,
+                    f"videos/{video_id}_original.mp4", original_path, "video/mp4")
+            # /redub ใช้ไฟล์นี้ต่อจาก cache ไม่ต้องโหลดกลับจาก R2
+            sourcecache.store(f"{r2_public_url}/videos/{video_id}_original.mp4", original_path)
+            state.mark("preflight", media=media.to_dict(),
+                       original_key=f"videos/{video_id}_original.mp4")
 
         # ── Step 2: Gemini upload + analyze ──
+        cancel.check()
         _update_step(2, "🔍 อัปโหลดวิดีโอไป Gemini...")
         anim.start("📥 ดาวน์โหลดวิดีโอ ✅\n🔍 กำลังวิเคราะห์วิดีโอ")
 
-        gemini_uri = _gemini_upload(video_bytes, api_key)
-        _update_step(2.3, "🔍 รอ Gemini ประมวลผลวิดีโอ...")
-        gemini_uri = _gemini_wait(gemini_uri, api_key)
-
-        import tempfile
-        import os
-        with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as tf:
-            tf.write(video_bytes)
-            tmp_video_path = tf.name
-            
-        try:
-            probe = subprocess.run([
-                "ffprobe", "-v", "error", "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1", tmp_video_path
-            ], capture_output=True, text=True)
-            duration = float(probe.stdout.strip()) if probe.stdout.strip() else 15.0
-        except Exception as e:
-            print(f"[PIPELINE] Error getting duration: {e}")
-            duration = 15.0
-        finally:
-            os.remove(tmp_video_path)
+        if state.done("gemini"):
+            gemini_uri = state.get("gemini_uri")
+        else:
+            with _stage("gemini_upload"):
+                gemini_uri = _gemini_upload(original_path, api_key)
+            _update_step(2.3, "🔍 รอ Gemini ประมวลผลวิดีโอ...")
+            with _stage("gemini_wait"):
+                gemini_uri = _gemini_wait(gemini_uri, api_key, cancel=cancel)
+            state.mark("gemini", gemini_uri=gemini_uri)
+
+        if state.done("script"):
+            script, title, category = state.get("script"), state.get("title"), state.get("category")
+            duration = state.get("duration", 15.0)
+        else:
+            duration = media.duration
 
-        _update_step(2.7, "🔍 สร้างบทพากย์จาก AI...")
-        script, title, category = _gemini_script(gemini_uri, api_key, model, duration)
+            _update_step(2.7, "🔍 สร้างบทพากย์จาก AI...")
+            with _stage("script"):
+                script, title, category = _gemini_script(gemini_uri, api_key, model, duration, cancel=cancel)
+            state.mark("script", script=script, title=title, category=category, duration=duration)
         print(f"[PIPELINE] Script ({len(script)} chars): {script[:60]}")
 
         # ── Step 3: TTS ──
+        cancel.check()
         _update_step(3, "🎙 กำลังสร้างเสียงพากย์ไทย...")
         anim.start("📥 ดาวน์โหลดวิดีโอ ✅\n🔍 วิเคราะห์วิดีโอ ✅\n🎙 กำลังสร้างเสียงพากย์")
 
-        audio_b64 = _gemini_tts(script, api_key)
+        if state.done("tts") and state.has_file("tts.pcm"):
+            with open(state.path("tts.pcm"), "rb") as f:
+                audio_b64 = base64.b64encode(f.read()).decode("ascii")
+        else:
+            with _stage("tts"):
+                audio_b64 = _gemini_tts(script, api_key, cancel=cancel, voice=voice)
+            state.write_file("tts.pcm", base64.b64decode(audio_b64))
+            state.mark("tts")
         _update_step(3.5, "🎙 ได้เสียงพากย์แล้ว กำลังเตรียมรวม...")
         print(f"[PIPELINE] TTS: {len(audio_b64)//1024} KB base64")
 
-        # ── Step 4: FFmpeg merge ──
-        _update_step(4, "🎬 กำลังรวมเสียง+วิดีโอ...")
-        anim.start("📥 ดาวน์โหลดวิดีโอ ✅\n🔍 วิเคราะห์วิดีโอ ✅\n🎙 สร้างเสียงพากย์ ✅\n🎬 กำลังรวมวิดีโอ")
-
-        original_url = f"{r2_public_url}/videos/{video_id}_original.mp4"
-
-        def update_progress(text, step_num=None):
-            try:
-                import datetime
-                url_get = f"{worker_url}/api/r2-proxy/_processing/{video_id}.json"
-                req = http_requests.get(url_get, headers={'x-auth-token': token}, timeout=5)
-                if req.status_code == 200:
-                    data = req.json()
-                    data["stepName"] = text
-                    if step_num:
-                        data["step"] = step_num
-                    data["updatedAt"] = datetime.datetime.utcnow().isoformat() + "Z"
-                    _r2_put(worker_url, token, f"_processing/{video_id}.json", json.dumps(data).encode(), "application/json")
-            except:
-                pass
-
-        merged_bytes, thumb_bytes, duration = _ffmpeg_merge(original_url, audio_b64, script, api_key, progress_cb=update_progress)
-        print(f"[PIPELINE] Merged: {len(merged_bytes)/1024/1024:.1f} MB, {duration:.1f}s")
+        if state.done("upload"):
+            public_url = state.get("public_url")
+            thumb_url = state.get("thumb_url", "")
+            duration = state.get("out_duration", duration)
+        else:
+            # ── Step 4: FFmpeg merge ──
+            cancel.check()
+            _update_step(4, "🎬 กำลังรวมเสียง+วิดีโอ...")
+            anim.start("📥 ดาวน์โหลดวิดีโอ ✅\n🔍 วิเคราะห์วิดีโอ ✅\n🎙 สร้างเสียงพากย์ ✅\n🎬 กำลังรวมวิดีโอ")
 
-        # ── Step 5: อัพโหลด ──
-        _update_step(5, "📤 อัพโหลดผลลัพธ์")
+            original_url = f"{r2_public_url}/videos/{video_id}_original.mp4"
 
-        _r2_put(worker_url, token,
-                f"videos/{video_id}.mp4", merged_bytes, "video/mp4")
-        public_url = f"{r2_public_url}/videos/{video_id}.mp4"
+            def update_progress(text, step_num=None):
+                job.update(step=step_num, step_name=text)
+                if not _r2_status_due(step_num):
+                    return
+                try:
+                    import datetime
+                    url_get = f"{worker_url}/api/r2-proxy/_processing/{video_id}.json"
+                    req = http_requests.get(url_get, headers={'x-auth-token': token}, timeout=5)
+                    if req.status_code == 200:
+                        data = req.json()
+                        data["stepName"] = text
+                        if step_num:
+                            data["step"] = step_num
+                        data["updatedAt"] = datetime.datetime.utcnow().isoformat() + "Z"
+                        _r2_put(worker_url, token, f"_processing/{video_id}.json", json.dumps(data).encode(), "application/json")
+                except:
+                    pass
+
+            # workspace ของ merge อยู่ใน job directory — output ไม่ต้องผ่าน memory, ลบทิ้งหลังอัปโหลดเสร็จ
+            merge_dir = state.path("merge")
+            merged_path, thumb_path, duration = _ffmpeg_merge(original_url, audio_b64, script, api_key,
+                                                              progress_cb=update_progress, cancel=cancel,
+                                                              on_encode_time=lambda t, d: job.update(encode_time=t, encode_duration=d),
+                                                              srt_cache=state.path("subtitles.srt"),
+                                                              source_info=media, source_path=original_path,
+                                                              workdir=merge_dir, scratch_dir=ws.hot_dir(merge_dir))
+            if state.has_file("subtitles.srt") and not state.done("subtitles"):
+                state.mark("subtitles")
+            print(f"[PIPELINE] Merged: {os.path.getsize(merged_path)/1024/1024:.1f} MB, {duration:.1f}s")
+
+            # ── Step 5: อัพโหลด ──
+            cancel.check()
+            _update_step(5, "📤 อัพโหลดผลลัพธ์")
 
-        thumb_url = ""
-        if thumb_bytes:
             _r2_put(worker_url, token,
-                    f"videos/{video_id}_thumb.webp", thumb_bytes, "image/webp")
-            thumb_url = f"{r2_public_url}/videos/{video_id}_thumb.webp"
+                    f"videos/{video_id}.mp4", merged_path, "video/mp4")
+            public_url = f"{r2_public_url}/videos/{video_id}.mp4"
+
+            thumb_url = ""
+            if thumb_path:
+                _r2_put(worker_url, token,
+                        f"videos/{video_id}_thumb.webp", thumb_path, "image/webp")
+                thumb_url = f"{r2_public_url}/videos/{video_id}_thumb.webp"
+            state.mark("upload", public_url=public_url, thumb_url=thumb_url, out_duration=duration)
+            shutil.rmtree(merge_dir, ignore_errors=True)
 
         # ── Step 6: เช็คลิงก์ Shopee ที่รออยู่ และบันทึก metadata ──
         import datetime
@@ -463,11 +547,26 @@ def run_pipeline_bg(payload):
         }
         if shopee_link_data:
             metadata["shopeeLink"] = shopee_link_data
+        if voice:
+            metadata["voice"] = voice
+        if TRACE_UPLOAD:
+            metadata["traceKey"] = _trace_key(video_id)
 
         _r2_put(worker_url, token,
                 f"videos/{video_id}.json",
                 json.dumps(metadata, ensure_ascii=False).encode(), "application/json")
 
+        # ผล probe / วิเคราะห์ของต้นฉบับ — /redub ใช้ต่อโดยไม่ต้อง ffprobe / ถาม Gemini ซ้ำ
+        # (แยกจาก metadata เพราะ Worker copy metadata ทั้งก้อนเข้า gallery cache)
+        try:
+            analysis = {"media": media.to_dict(), "title": title, "category": category,
+                        "sourceDuration": media.duration,
+                        "originalKey": f"videos/{video_id}_original.mp4"}
+            _r2_put(worker_url, token, f"videos/{video_id}_analysis.json",
+                    json.dumps(analysis, ensure_ascii=False).encode(), "application/json")
+        except Exception as e:
+            print(f"[PIPELINE] Analysis upload error: {e}")
+
         pending = {"videoId": video_id, "publicUrl": public_url, "msgId": msg_id}
         _r2_put(worker_url, token,
                 f"_pending_shopee/{chat_id}.json",
@@ -505,8 +604,48 @@ def run_pipeline_bg(payload):
             print(f"[PIPELINE] Gallery refresh error: {e}")
 
         print(f"[PIPELINE] Done! videoId={video_id}")
+        state.clear()
+        jobs.finish(job, jobs.DONE)
+        _finish_trace(video_id, jobs.DONE, worker_url, token)
+
+    except JobCancelled as e:
+        anim.stop()
+        print(f"[PIPELINE] Cancelled: videoId={video_id} ({e})")
+        if state:
+            state.clear()
+        jobs.finish(job, jobs.CANCELLED, str(e))
+        _finish_trace(video_id, jobs.CANCELLED, worker_url, token)
+        try:
+            edit_status(token, chat_id, msg_id, f"🛑 ยกเลิกงานแล้ว ({video_id})")
+        except Exception:
+            pass
+
+        # ทำเครื่องหมาย cancelled ใน _processing → Worker ปล่อยคิวถัดไปได้ทันที
+        try:
+            url = f"{worker_url}/api/r2-proxy/_processing/{video_id}.json"
+            get_req = http_requests.get(url, headers={'x-auth-token': token}, timeout=15)
+            data = get_req.json() if get_req.status_code == 200 else {"id": video_id, "chatId": chat_id}
+            data["status"] = "cancelled"
+            data["error"] = str(e)[:200]
+            data["updatedAt"] = time.strftime("%Y-%m-%dT%H:%M:%SZ")
+            _r2_put(worker_url, token, f"_processing/{video_id}.json", json.dumps(data).encode(), "application/json")
+        except Exception as e2:
+            print(f"[PIPELINE] Error updating cancelled status: {e2}")
+
+        try:
+            http_requests.post(f"{worker_url}/api/queue/next", headers={'x-auth-token': token}, timeout=15)
+        except Exception as e3:
+            print(f"[PIPELINE] Queue next error: {e3}")
 
     except Exception as e:
+        # เก็บ checkpoint ไว้ — Worker redispatch video_id นี้จะทำต่อจาก stage ล่าสุด
+        # (ยกเว้นไฟล์ที่ preflight ปฏิเสธ ส่งซ้ำก็ไม่ผ่าน)
+        if state and isinstance(e, preflight.PreflightRejected):
+            state.clear()
+        elif state:
+            state.set_status("failed", str(e))
+        jobs.finish(job, jobs.FAILED, str(e))
+        _finish_trace(video_id, jobs.FAILED, worker_url, token)
         if anim:
             anim.stop()
         import traceback
@@ -541,47 +680,276 @@ def run_pipeline_bg(payload):
         except Exception as e3:
             print(f"[PIPELINE] Queue next error: {e3}")
 
+    finally:
+        if ws:
+            ws.release()
+
+
+def run_redub_bg(payload, job=None):
+    """พากย์เสียงใหม่ให้วิดีโอที่ทำเสร็จแล้ว — script ใหม่ (+ voice) → TTS → จับเวลาซับ → encode → อัปโหลดทับ
+    ใช้ต้นฉบับใน R2 (ผ่าน source cache), ผล probe และ title / category เดิม — ไม่ดาวน์โหลด XHS / ถาม Gemini วิเคราะห์ซ้ำ"""
+    import mediainfo
+    import datetime
+    token = payload["token"]
+    video_id = payload["video_id"]
+    script = payload["script"]
+    voice = payload.get("voice")
+    chat_id = payload.get("chat_id")
+    api_key = payload["api_key"]
+    r2_public_url = payload["r2_public_url"]
+    worker_url = payload["worker_url"]
+
+    if job is None:
+        job = jobs.register(video_id, chat_id, kind=jobs.REDUB)
+    cancel = job.cancel
+    tracing.start(video_id)
+    profiling.start(video_id, payload.get("profile", profiling.ENABLED_DEFAULT))
+    # แยกจาก checkpoint ของ pipeline (video_id เดียวกัน) — ค้างไว้จะถูกลบตอน container start
+    workdir = os.path.join(checkpoint.STATE_DIR, f"{video_id}.redub")
+    ws = None
+
+    try:
+        metadata = payload.get("metadata") or _r2_get_json(worker_url, token, f"videos/{video_id}.json")
+        if not metadata:
+            raise Exception(f"ไม่พบวิดีโอ {video_id}")
+        analysis = _r2_get_json(worker_url, token, f"videos/{video_id}_analysis.json") or {}
+        original_url = f"{r2_public_url}/{analysis.get('originalKey') or f'videos/{video_id}_original.mp4'}"
+        original_path = os.path.join(workdir, "original.mp4")
+
+        ws = workspace.admit(video_id, workdir, downloader.remote_size(original_url), cancel,
+                             on_wait=lambda need, avail: job.update(
+                                 step_name=f"⏳ รอพื้นที่ดิสก์ ({need/1024/1024:.0f} MB)"))
+
+        # ── ต้นฉบับ: hit จาก source cache เมื่อเคยทำใน container นี้ ──
+        job.update(step=1, step_name="📥 เตรียมวิดีโอต้นฉบับ")
+        with _stage("download", url=original_url[:120]):
+            sourcecache.fetch(original_url, original_path, cancel,
+                              on_progress=lambda pct, done: job.update(
+                                  step=1.0 + pct * 0.9, step_name=f"📥 เตรียมวิดีโอต้นฉบับ... ({done/1024/1024:.1f}MB)"))
+        if analysis.get("media"):
+            media = mediainfo.MediaInfo.from_dict(analysis["media"], original_path)
+            mediainfo.remember(original_path, media)
+        else:
+            # วิดีโอที่ทำก่อนมี _analysis.json — probe ครั้งเดียว (original ใน R2 ผ่าน preflight มาแล้ว)
+            media = mediainfo.probe(original_path, cancel)
+
+        # ── TTS ──
+        cancel.check()
+        job.update(step=3, step_name="🎙 กำลังสร้างเสียงพากย์ใหม่...")
+        with _stage("tts"):
+            audio_b64 = _gemini_tts(script, api_key, cancel=cancel, voice=voice)
+        print(f"[REDUB] {video_id}: TTS {len(audio_b64)//1024} KB base64 (voice {voice or TTS_VOICE})")
+
+        # ── จับเวลาซับจากเสียงใหม่ (Whisper + Gemini) + encode ──
+        cancel.check()
+        job.update(step=4, step_name="🎬 กำลังรวมเสียง+วิดีโอ...")
+        merge_dir = os.path.join(workdir, "merge")
+        merged_path, thumb_path, duration = _ffmpeg_merge(
+            original_url, audio_b64, script, api_key,
+            progress_cb=lambda text, step_num=None: job.update(step=step_num, step_name=text),
+            cancel=cancel, on_encode_time=lambda t, d: job.update(encode_time=t, encode_duration=d),
+            source_info=media, source_path=original_path,
+            workdir=merge_dir, scratch_dir=ws.hot_dir(merge_dir))
+
+        # ── อัปโหลดทับไฟล์เดิม ──
+        cancel.check()
+        job.update(step=5, step_name="📤 อัพโหลดผลลัพธ์")
+        _r2_put(worker_url, token, f"videos/{video_id}.mp4", merged_path, "video/mp4")
+        if thumb_path:
+            _r2_put(worker_url, token, f"videos/{video_id}_thumb.webp", thumb_path, "image/webp")
+            metadata["thumbnailUrl"] = f"{r2_public_url}/videos/{video_id}_thumb.webp"
+
+        metadata.update({
+            "script": script,
+            "duration": duration,
+            "publicUrl": f"{r2_public_url}/videos/{video_id}.mp4",
+            "redubbedAt": datetime.datetime.utcnow().isoformat() + "Z",
+        })
+        for key in ("title", "category"):
+            if not metadata.get(key) and analysis.get(key):
+                metadata[key] = analysis[key]
+        if voice:
+            metadata["voice"] = voice
+        if TRACE_UPLOAD:
+            metadata["traceKey"] = _trace_key(video_id)
+        _r2_put(worker_url, token, f"videos/{video_id}.json",
+                json.dumps(metadata, ensure_ascii=False).encode(), "application/json")
+
+        try:
+            http_requests.post(f"{worker_url}/api/gallery/refresh/{video_id}", headers={'x-auth-token': token}, timeout=15)
+        except Exception as e:
+            print(f"[REDUB] Gallery refresh error: {e}")
+        if chat_id:
+            send_telegram(token, "sendMessage", {"chat_id": chat_id, "text": f"✅ พากย์เสียงใหม่สำเร็จ ({video_id})"})
+
+        print(f"[REDUB] Done! videoId={video_id} ({duration:.1f}s)")
+        jobs.finish(job, jobs.DONE)
+        _finish_trace(video_id, jobs.DONE, worker_url, token)
+
+    except JobCancelled as e:
+        print(f"[REDUB] Cancelled: videoId={video_id} ({e})")
+        jobs.finish(job, jobs.CANCELLED, str(e))
+        _finish_trace(video_id, jobs.CANCELLED, worker_url, token)
+
+    except Exception as e:
+        import traceback
+        print(f"[REDUB] Error: {e}\n{traceback.format_exc()}")
+        jobs.finish(job, jobs.FAILED, str(e))
+        _finish_trace(video_id, jobs.FAILED, worker_url, token)
+        if chat_id:
+            send_telegram(token, "sendMessage", {
+                "chat_id": chat_id,
+                "text": f"❌ พากย์เสียงใหม่ไม่สำเร็จ ({video_id})\n\n{str(e)[:150]}",
+            })
+
+    finally:
+        if ws:
+            ws.release()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _preflight(path, cancel=None):
+    """probe ไฟล์ต้นฉบับครั้งเดียว → ปฏิเสธ หรือแปลงทับ path เดิม — คืน (MediaInfo, normalized)"""
+    import mediainfo
+    import preflight
+    try:
+        info = mediainfo.probe(path, cancel)
+    except mediainfo.ProbeError as e:
+        raise preflight.PreflightRejected(f"ไฟล์วิดีโอเสียหรือไม่รองรับ ({e})")
+    reasons, remux_only = preflight.check(info)
+    if not reasons:
+        print(f"[PIPELINE] Preflight OK: {info.summary()}")
+        return info, False
+
+    print(f"[PIPELINE] Preflight: {'remux' if remux_only else 'normalize'} ({', '.join(reasons)})")
+    tmp = path + ".norm.mp4"
+    try:
+        preflight.normalize(path, tmp, info, remux_only, cancel)
+    except (ProcessFailed, ProcessTimeout) as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise preflight.PreflightRejected(f"แปลงไฟล์วิดีโอไม่สำเร็จ ({', '.join(reasons)})") from e
+    os.replace(tmp, path)
+    info = mediainfo.probe(path, cancel)
+    print(f"[PIPELINE] Preflight normalized: {info.summary()}")
+    return info, True
+
+
+def _finish_trace(video_id, status, worker_url, token):
+    """ปิด trace ของ job — TRACE_UPLOAD=1 จะเขียน Chrome trace ลง R2 ข้าง metadata ของวิดีโอ (_trace_key)"""
+    report = profiling.stop()
+    trace = tracing.finish(status)
+    if trace and report:
+        trace.meta["profile"] = report
+    if not trace or not TRACE_UPLOAD:
+        return
+    try:
+        _r2_put(worker_url, token, _trace_key(video_id),
+                json.dumps(trace.to_chrome()).encode(), "application/json")
+    except Exception as e:
+        print(f"[PIPELINE] Trace upload error: {e}")
+
+
+def _trace_key(video_id):
+    return f"videos/{video_id}_trace.json"
+
+
+def _sleep(seconds, cancel=None):
+    """time.sleep ที่ยกเลิกได้ — ถ้า job ถูก cancel ระหว่างรอจะ raise JobCancelled"""
+    if cancel is None:
+        import time
+        time.sleep(seconds)
+        return
+    cancel.wait(seconds)
+    cancel.check()
 
 
 def _r2_put(worker_url, token, key, data, content_type):
-    """อัพโหลดไฟล์ไป R2 ผ่าน Worker /api/r2-upload proxy"""
+    """อัพโหลดไฟล์ไป R2 — S3 API ตรง (multipart) ถ้าตั้ง R2 credentials ไว้, ไม่งั้น/ล้มเหลว → Worker /api/r2-upload proxy
+    data: bytes หรือ path ของไฟล์ (str) — path จะถูก stream จาก disk ไม่โหลดทั้งไฟล์เข้า memory"""
+    size = os.path.getsize(data) if isinstance(data, str) else len(data)
+    with _stage("r2_upload", key=key, bytes=size):
+        if storage.enabled():
+            try:
+                storage.upload(key, data, content_type, size=size)
+                metrics.R2_UPLOADS.inc(backend="s3", result="ok")
+                return
+            except Exception as e:
+                metrics.R2_UPLOADS.inc(backend="s3", result="error")
+                print(f"[R2] Direct upload {key} failed, falling back to Worker proxy: {str(e)[:200]}")
+        _r2_put_proxy(worker_url, token, key, data, content_type, size)
+
+
+def _r2_put_proxy(worker_url, token, key, data, content_type, size):
+    """อัพโหลดทั้งไฟล์ใน request เดียวผ่าน Worker /api/r2-upload proxy"""
     url = f"{worker_url}/api/r2-upload/{key}"
-    resp = http_requests.put(url, data=data, headers={
-        "x-auth-token": token,
-        "content-type": content_type,
-    }, timeout=120)
-    if resp.status_code not in (200, 201):
+    with _open_body(data) as body:
+        resp = http_requests.put(url, data=body, headers={
+            "x-auth-token": token,
+            "content-type": content_type,
+        }, timeout=120)
+    if resp.status_code in (200, 201):
+        metrics.bytes_moved(url, size, "up")
+        metrics.R2_UPLOADS.inc(backend="worker", result="ok")
+    else:
+        metrics.R2_UPLOADS.inc(backend="worker", result="error")
         raise Exception(f"R2 upload failed: {resp.status_code} {resp.text[:200]}")
 
 
-def _gemini_upload(video_bytes, api_key):
-    """Upload video ไป Gemini Files API"""
-    resp = http_requests.post(
-        f"https://generativelanguage.googleapis.com/upload/v1beta/files?uploadType=media&key={api_key}",
-        data=video_bytes,
-        headers={"Content-Type": "video/mp4", "X-Goog-Upload-Protocol": "raw"},
-        timeout=120,
-    )
+def _r2_get_json(worker_url, token, key):
+    """อ่าน JSON จาก R2 ผ่าน Worker proxy — None ถ้าไม่มี key นี้"""
+    resp = http_requests.get(f"{worker_url}/api/r2-proxy/{key}", headers={'x-auth-token': token}, timeout=15)
+    if resp.status_code == 404:
+        return None
+    if resp.status_code != 200:
+        raise Exception(f"R2 read {key} failed: {resp.status_code} {resp.text[:200]}")
+    return resp.json()
+
+
+@contextmanager
+def _open_body(data):
+    """body ของ request: path → file object (requests stream ทีละ chunk พร้อม Content-Length), bytes → ตามเดิม"""
+    if isinstance(data, str):
+        with open(data, "rb") as f:
+            yield f
+    else:
+        yield data
+
+
+def _gemini_upload(video, api_key):
+    """Upload video ไป Gemini Files API — video: path ของไฟล์ (stream จาก disk) หรือ bytes"""
+    url = f"{GEMINI_API_BASE}/upload/v1beta/files?uploadType=media&key={api_key}"
+    with _open_body(video) as body:
+        resp = http_requests.post(
+            url,
+            data=body,
+            headers={"Content-Type": "video/mp4", "X-Goog-Upload-Protocol": "raw"},
+            timeout=120,
+        )
+    metrics.bytes_moved(url, os.path.getsize(video) if isinstance(video, str) else len(video), "up")
     data = resp.json()
+    if "file" not in data:
+        raise Exception(f"Gemini upload failed: {resp.status_code} {data.get('error', {}).get('message', '')[:200]}")
     return data["file"]["uri"]
 
 
-def _gemini_wait(file_uri, api_key, max_wait=120):
+def _gemini_wait(file_uri, api_key, max_wait=120, cancel=None):
     """รอให้ Gemini ประมวลผลวิดีโอเสร็จ"""
-    import time
     file_name = file_uri.split("/files/")[-1]
     for _ in range(max_wait // 5):
+        if cancel:
+            cancel.check()
         r = http_requests.get(
-            f"https://generativelanguage.googleapis.com/v1beta/files/{file_name}?key={api_key}",
+            f"{GEMINI_API_BASE}/v1beta/files/{file_name}?key={api_key}",
             timeout=15
         ).json()
         if r.get("state") == "ACTIVE":
             return file_uri
-        time.sleep(5)
+        _sleep(5, cancel)
     return file_uri
 
 
-def _gemini_script(file_uri, api_key, model, video_duration=15.0):
+def _gemini_script(file_uri, api_key, model, video_duration=15.0, cancel=None):
     """สร้าง script ภาษาไทยจากวิดีโอ — ปรับความยาว script ตามความยาววิดีโอ"""
     # คำนวณความยาว script ที่เหมาะสม (~10 ตัวอักษร/วินาที สำหรับภาษาไทย TTS)
     max_chars = min(int(video_duration * 10), 800)
@@ -611,32 +979,39 @@ def _gemini_script(file_uri, api_key, model, video_duration=15.0):
   "category": "หมวดหมู่ (เครื่องมือช่าง/อาหาร/เครื่องครัว/ของใช้ในบ้าน/เฟอร์นิเจอร์/บิวตี้/แฟชั่น/อิเล็กทรอนิกส์/สุขภาพ/กีฬา/สัตว์เลี้ยง/ยานยนต์/อื่นๆ)"
 }}"""
 
-    import time
     for attempt in range(5):
+        if cancel:
+            cancel.check()
         try:
-            resp = http_requests.post(
-                f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}",
-                json={"contents": [{"parts": [
-                    {"file_data": {"mime_type": "video/mp4", "file_uri": file_uri}},
-                    {"text": prompt}
-                ]}]},
-                timeout=60,
-            ).json()
+            with tracing.span("script.attempt", cat="attempt", attempt=attempt + 1, model=model):
+                resp = http_requests.post(
+                    f"{GEMINI_API_BASE}/v1beta/models/{model}:generateContent?key={api_key}",
+                    json={"contents": [{"parts": [
+                        {"file_data": {"mime_type": "video/mp4", "file_uri": file_uri}},
+                        {"text": prompt}
+                    ]}]},
+                    timeout=60,
+                ).json()
 
             if resp.get("error"):
                 err_msg = resp['error'].get('message', '')
                 if "high demand" in err_msg.lower() or "503" in str(err_msg):
                     print(f"[PIPELINE] Gemini high demand, retrying... ({attempt+1}/5)")
-                    time.sleep(5)
+                    metrics.RETRIES.inc(op="script")
+                    _sleep(5, cancel)
                     if attempt >= 2 and model == "gemini-3-flash-preview":
                         model = "gemini-2.0-flash"
+                        metrics.MODEL_FALLBACKS.inc(op="script", to_model=model)
                         print(f"[PIPELINE] Fallback to {model}")
                     continue
                 raise Exception(f"Gemini error: {err_msg}")
             break
+        except JobCancelled:
+            raise
         except Exception as e:
             if attempt < 4 and "Gemini error" not in str(e):
-                time.sleep(5)
+                metrics.RETRIES.inc(op="script")
+                _sleep(5, cancel)
                 continue
             raise
 
@@ -654,112 +1029,105 @@ def _gemini_script(file_uri, api_key, model, video_duration=15.0):
         return (m.group(1) if m else text[:200]), (t.group(1) if t else ""), (c.group(1) if c else "อื่นๆ")
 
 
-def _gemini_tts(script, api_key):
-    """สร้างเสียงพากย์จาก script"""
-    import time
+def _gemini_tts(script, api_key, cancel=None, voice=None):
+    """สร้างเสียงพากย์จาก script (voice = ชื่อ prebuilt voice, default TTS_VOICE)"""
     for attempt in range(5):
+        if cancel:
+            cancel.check()
         try:
-            resp = http_requests.post(
-                f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-tts:generateContent?key={api_key}",
-                json={
-                    "contents": [{"parts": [{"text": script}]}],
-                    "generationConfig": {
-                        "responseModalities": ["AUDIO"],
-                        "speechConfig": {"voiceConfig": {"prebuiltVoiceConfig": {"voiceName": "Puck"}}}
-                    }
-                },
-                timeout=60,
-            ).json()
+            with tracing.span("tts.attempt", cat="attempt", attempt=attempt + 1):
+                resp = http_requests.post(
+                    f"{GEMINI_API_BASE}/v1beta/models/gemini-2.5-flash-preview-tts:generateContent?key={api_key}",
+                    json={
+                        "contents": [{"parts": [{"text": script}]}],
+                        "generationConfig": {
+                            "responseModalities": ["AUDIO"],
+                            "speechConfig": {"voiceConfig": {"prebuiltVoiceConfig": {"voiceName": voice or TTS_VOICE}}}
+                        }
+                    },
+                    timeout=60,
+                ).json()
 
             if resp.get("error"):
                 err_msg = resp['error'].get('message', '')
                 if "high demand" in err_msg.lower() or "503" in str(err_msg):
                     print(f"[PIPELINE] TTS high demand, retrying... ({attempt+1}/5)")
-                    time.sleep(5)
+                    metrics.RETRIES.inc(op="tts")
+                    _sleep(5, cancel)
                     continue
                 raise Exception(f"TTS error: {err_msg}")
             
             return resp["candidates"][0]["content"]["parts"][0]["inlineData"]["data"]
+        except JobCancelled:
+            raise
         except Exception as e:
             if attempt < 4 and "TTS error" not in str(e):
-                time.sleep(5)
+                metrics.RETRIES.inc(op="tts")
+                _sleep(5, cancel)
                 continue
             raise
 
     return resp["candidates"][0]["content"]["parts"][0]["inlineData"]["data"]
 
 
-def _ffmpeg_merge(video_url, audio_b64, script=None, api_key=None, progress_cb=None):
-    """FFmpeg merge — เหมือน /merge endpoint เดิม แต่มีการใส่ซับด้วย Whisper + Gemini + MoviePy"""
-    with tempfile.TemporaryDirectory() as tmpdir:
-        vr = http_requests.get(video_url, timeout=120)
-        video_path = os.path.join(tmpdir, "video.mp4")
-        with open(video_path, "wb") as f:
-            f.write(vr.content)
-
-        probe = subprocess.run([
-            "ffprobe", "-v", "error", "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1", video_path
-        ], capture_output=True, text=True)
-        duration = float(probe.stdout.strip()) if probe.stdout.strip() else 15.0
-
-        raw_audio = os.path.join(tmpdir, "audio.raw")
-        wav_audio = os.path.join(tmpdir, "audio.wav")
-        with open(raw_audio, "wb") as f:
-            f.write(base64.b64decode(audio_b64))
-        subprocess.run(["ffmpeg", "-y", "-f", "s16le", "-ar", "24000", "-ac", "1",
-                        "-i", raw_audio, wav_audio], check=True, capture_output=True)
-
-        ap = subprocess.run([
-            "ffprobe", "-v", "error", "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1", wav_audio
-        ], capture_output=True, text=True)
-        audio_dur = float(ap.stdout.strip()) if ap.stdout.strip() else 0
-
-        adjusted = os.path.join(tmpdir, "audio_adj.wav")
-        diff = duration - audio_dur
-        if abs(diff) < 0.5:
-            adjusted = wav_audio
-        elif diff > 0:
-            subprocess.run(["ffmpeg", "-y", "-i", wav_audio, "-af", f"apad=pad_dur={diff}", adjusted], capture_output=True)
+def _ffmpeg_merge(video_url, audio_b64, script=None, api_key=None, progress_cb=None, cancel=None,
+                  srt_cache=None, on_encode_time=None, source_info=None, source_path=None, workdir=None,
+                  scratch_dir=None):
+    """FFmpeg merge — เหมือน /merge endpoint เดิม แต่มีการใส่ซับด้วย Whisper + Gemini + MoviePy
+    srt_cache: path ของ SRT ที่แก้แล้ว — ถ้ามีอยู่แล้วจะข้าม Whisper + Gemini, ถ้ายังไม่มีจะเขียนเก็บไว้
+    on_encode_time(sec, duration): เรียกทุกบรรทัด out_time_us ของ ffmpeg ตอนฝังซับ
+    source_info: MediaInfo ของวิดีโอต้นฉบับจาก preflight — ไม่ต้อง probe duration / ขนาดซ้ำ
+    source_path: ไฟล์ต้นฉบับบน disk (มีแล้วไม่ต้องดาวน์โหลด video_url ซ้ำ)
+    workdir: โฟลเดอร์ทำงาน (default = temp dir ใหม่) — ผู้เรียกลบเองหลังอัปโหลด
+    scratch_dir: ที่เก็บเสียง / ซับ (tmpfs ของ workspace) — default = workdir
+    คืน (output_path, thumb_path หรือ None, duration) — ไฟล์อยู่ใน workdir, ไม่ได้อ่านเข้า memory"""
+    import mediainfo
+    tmpdir = workdir or tempfile.mkdtemp(prefix="merge-")
+    os.makedirs(tmpdir, exist_ok=True)
+    hot = scratch_dir or tmpdir
+    try:
+        if source_path and os.path.exists(source_path):
+            video_path = source_path
         else:
-            subprocess.run(["ffmpeg", "-y", "-i", wav_audio, "-t", str(duration), adjusted], capture_output=True)
+            video_path = os.path.join(tmpdir, "video.mp4")
+            sourcecache.fetch(video_url, video_path, cancel)
+
+        if not (source_info and source_info.duration):
+            source_info = mediainfo.probe(video_path, cancel)
+        duration = source_info.duration or 15.0
+        size = source_info.display_size
+
+        adjusted = _prepare_audio(base64.b64decode(audio_b64), duration, hot, cancel)
 
         merged_nosub = os.path.join(tmpdir, "merged_nosub.mp4")
-        mr = subprocess.run([
-            "ffmpeg", "-y", "-i", video_path, "-i", adjusted,
-            "-c:v", "copy", "-c:a", "aac",
-            "-map", "0:v:0", "-map", "1:a:0", "-t", str(duration), merged_nosub
-        ], capture_output=True, text=True)
-        if mr.returncode != 0:
-            raise Exception(f"FFmpeg failed: {mr.stderr[:300]}")
+        _mux_audio(video_path, adjusted, duration, merged_nosub, cancel, video_codec=source_info.video_codec)
             
         output_path = os.path.join(tmpdir, "output.mp4")
         
-        if script and api_key:
+        if script and api_key and srt_cache and os.path.exists(srt_cache):
+            print("[PIPELINE] Using checkpointed subtitles")
+            workspace.discard(adjusted)
+            srt_path = os.path.join(hot, "audio.srt")
+            shutil.copy(srt_cache, srt_path)
+            _burn_subtitles(merged_nosub, srt_path, output_path, duration, hot, progress_cb, cancel,
+                            on_encode_time, size=size)
+        elif script and api_key:
             if progress_cb:
                 progress_cb("📝 กำลังวิเคราะห์และแกะเวลาเสียงพูด (Word Sync)...", 4.3)
                 
             print("[PIPELINE] Transcribing with Whisper (Turbo model)...")
             try:
-                subprocess.run([
-                    "whisper-ctranslate2", adjusted,
-                    "--model", "turbo",
-                    "--language", "th",
-                    "--output_format", "srt",
-                    "--output_dir", tmpdir,
-                    "--compute_type", "int8",
-                    "--word_timestamps", "True",
-                    "--max_line_width", "20",
-                    "--max_line_count", "1"
-                ], check=True, timeout=300)  # 5 min timeout
-            except subprocess.TimeoutExpired:
-                raise Exception("Whisper transcription timed out (>300s)")
-            except subprocess.CalledProcessError as e:
+                with _stage("whisper"):
+                    run_media(warmup.whisper_cmd(adjusted, hot), "whisper",
+                              cancel=cancel, capture_stdout=False)
+            except ProcessTimeout as e:
+                raise Exception(f"Whisper transcription timed out (>{e.timeout:g}s)")
+            except ProcessFailed as e:
                 raise Exception(f"Whisper failed: {e}")
+            workspace.discard(adjusted)
             
             srt_name = os.path.splitext(os.path.basename(adjusted))[0] + ".srt"
-            srt_path = os.path.join(tmpdir, srt_name)
+            srt_path = os.path.join(hot, srt_name)
             
             with open(srt_path, "r", encoding="utf-8") as fs:
                 raw_srt_text = fs.read()
@@ -785,122 +1153,208 @@ def _ffmpeg_merge(video_url, audio_b64, script=None, api_key=None, progress_cb=N
 7. ตอบกลับมาแค่เนื้อหา SRT ล้วนๆ ห้ามตอบอย่างอื่น ห้ามมี markdown ```srt
 
 SRT ที่แก้ไขแล้ว:"""
-            import time
             sub_model = "gemini-3-flash-preview"
-            for attempt in range(5):
-                try:
-                    gemini_resp = http_requests.post(
-                        f"https://generativelanguage.googleapis.com/v1beta/models/{sub_model}:generateContent?key={api_key}",
-                        json={"contents": [{"parts": [{"text": prompt}]}]},
-                        timeout=60,
-                    ).json()
+            with _stage("subtitle_fix"):
+                for attempt in range(5):
+                    if cancel:
+                        cancel.check()
+                    try:
+                        with tracing.span("subtitle_fix.attempt", cat="attempt", attempt=attempt + 1, model=sub_model):
+                            gemini_resp = http_requests.post(
+                                f"{GEMINI_API_BASE}/v1beta/models/{sub_model}:generateContent?key={api_key}",
+                                json={"contents": [{"parts": [{"text": prompt}]}]},
+                                timeout=60,
+                            ).json()
                     
-                    if gemini_resp.get("error"):
-                        err_msg = gemini_resp['error'].get('message', '')
-                        if "high demand" in err_msg.lower() or "503" in str(err_msg):
-                            print(f"[PIPELINE] Subtitle Gemini high demand, retrying... ({attempt+1}/5)")
-                            time.sleep(5)
-                            if attempt >= 2 and sub_model == "gemini-3-flash-preview":
-                                sub_model = "gemini-2.0-flash"
-                                print(f"[PIPELINE] Fallback subtitle model to {sub_model}")
+                        if gemini_resp.get("error"):
+                            err_msg = gemini_resp['error'].get('message', '')
+                            if "high demand" in err_msg.lower() or "503" in str(err_msg):
+                                print(f"[PIPELINE] Subtitle Gemini high demand, retrying... ({attempt+1}/5)")
+                                metrics.RETRIES.inc(op="subtitle_fix")
+                                _sleep(5, cancel)
+                                if attempt >= 2 and sub_model == "gemini-3-flash-preview":
+                                    sub_model = "gemini-2.0-flash"
+                                    metrics.MODEL_FALLBACKS.inc(op="subtitle_fix", to_model=sub_model)
+                                    print(f"[PIPELINE] Fallback subtitle model to {sub_model}")
+                                continue
+                            print(f"[PIPELINE] Gemini Subtitling error: {err_msg}")
+                            fixed_srt_content = raw_srt_text
+                            break
+                        else:
+                            fixed_srt_content = gemini_resp.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+                            fixed_srt_content = fixed_srt_content.replace("```srt", "").replace("```", "").strip()
+                            break
+                    except JobCancelled:
+                        raise
+                    except Exception as e:
+                        if attempt < 4:
+                            metrics.RETRIES.inc(op="subtitle_fix")
+                            _sleep(5, cancel)
                             continue
-                        print(f"[PIPELINE] Gemini Subtitling error: {err_msg}")
+                        print(f"[PIPELINE] Gemini Subtitle Exception: {e}")
                         fixed_srt_content = raw_srt_text
                         break
-                    else:
-                        fixed_srt_content = gemini_resp.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-                        fixed_srt_content = fixed_srt_content.replace("```srt", "").replace("```", "").strip()
-                        break
-                except Exception as e:
-                    if attempt < 4:
-                        time.sleep(5)
-                        continue
-                    print(f"[PIPELINE] Gemini Subtitle Exception: {e}")
-                    fixed_srt_content = raw_srt_text
-                    break
                 
             with open(srt_path, "w", encoding="utf-8") as fs:
                 fs.write(fixed_srt_content)
                 
-            ass_path = os.path.join(tmpdir, "subtitles.ass")
-            
-            vp = subprocess.run([
-                "ffprobe", "-v", "error", "-show_entries", "stream=width,height",
-                "-of", "csv=p=0:s=x", merged_nosub
-            ], capture_output=True, text=True)
-            res = vp.stdout.strip().split('x')
-            vw = int(res[0]) if len(res) == 2 else 1080
-            vh = int(res[1]) if len(res) == 2 else 1920
-            
-            _convert_to_ass(srt_path, ass_path, vw, vh)
-            
-            print("[PIPELINE] Burning subtitles with FFmpeg Native...")
-            if progress_cb:
-                progress_cb("🎬 กำลังเตรียมซับไตเติ้ล...", 4.8)
-            
-            # Use Native FFmpeg ASS plugin, pointing fontsdir to /app where font.ttf resides
-            import re
-            
-            cmd = [
-                "ffmpeg", "-y", "-i", merged_nosub,
-                "-progress", "-", "-nostats",
-                "-vf", f"ass={ass_path}:fontsdir=/app",
-                "-c:v", "libx264", "-c:a", "copy", "-preset", "fast", output_path
-            ]
-            
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            
-            last_pct = 0
-            for line in p.stdout:
-                line = line.strip()
-                if line.startswith("out_time_us="):
-                    try:
-                        us_val = line.split("=")[1]
-                        if us_val != "N/A":
-                            current_sec = int(us_val) / 1000000.0
-                            if duration > 0:
-                                pct = min(1.0, current_sec / duration)
-                                if pct - last_pct > 0.05 or pct == 1.0:
-                                    if progress_cb:
-                                        # Map 0..1 to 4.8..4.99
-                                        progress_cb(f"🎬 กำลังฝังซับไตเติ้ล ({current_sec:.1f}s / {duration:.1f}s)", 4.8 + (pct * 0.19))
-                                    last_pct = pct
-                    except Exception:
-                        pass
-                        
-            p.wait()
-            
-            if p.returncode != 0:
-                print(f"[PIPELINE] FFmpeg sub error: returncode {p.returncode}")
-                # Fallback on merge_nosub if subtitle burning fails completely
-                import shutil
-                shutil.move(merged_nosub, output_path)
-                
+            if srt_cache:
+                tmp_cache = srt_cache + ".tmp"
+                with open(tmp_cache, "w", encoding="utf-8") as fs:
+                    fs.write(fixed_srt_content)
+                os.replace(tmp_cache, srt_cache)
+
+            _burn_subtitles(merged_nosub, srt_path, output_path, duration, hot, progress_cb, cancel,
+                            on_encode_time, size=size)
+
         else:
-            import shutil
+            workspace.discard(adjusted)
             shutil.move(merged_nosub, output_path)
 
-        op = subprocess.run([
-            "ffprobe", "-v", "error", "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1", output_path
-        ], capture_output=True, text=True)
-        out_dur = float(op.stdout.strip()) if op.stdout.strip() else duration
+        # mux ใช้ -t duration และฝังซับไม่เปลี่ยนความยาว → ไม่ต้อง probe output ซ้ำ
+        out_dur = duration
 
         thumb_path = os.path.join(tmpdir, "thumb.webp")
-        subprocess.run([
-            "ffmpeg", "-y", "-i", output_path, "-vframes", "1", "-ss", "0.1",
-            "-vf", "scale=270:480:force_original_aspect_ratio=increase,crop=270:480",
-            "-q:v", "80", thumb_path
-        ], capture_output=True)
-
-        with open(output_path, "rb") as f:
-            merged = f.read()
-        thumb = None
-        if os.path.exists(thumb_path) and os.path.getsize(thumb_path) > 0:
-            with open(thumb_path, "rb") as f:
-                thumb = f.read()
+        _make_thumbnail(output_path, thumb_path, cancel)
+        if not (os.path.exists(thumb_path) and os.path.getsize(thumb_path) > 0):
+            thumb_path = None
+
+        return output_path, thumb_path, out_dur
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+def _prepare_audio(pcm_bytes, duration, tmpdir, cancel=None, sample_rate=24000):
+    """PCM s16le mono → WAV แล้ว pad / ตัดให้ยาวเท่าวิดีโอ — คืน path ของ WAV ที่ใช้ mux"""
+    raw_audio = os.path.join(tmpdir, "audio.raw")
+    wav_audio = os.path.join(tmpdir, "audio.wav")
+    with open(raw_audio, "wb") as f:
+        f.write(pcm_bytes)
+    run_media(["ffmpeg", "-y", "-f", "s16le", "-ar", str(sample_rate), "-ac", "1",
+               "-i", raw_audio, wav_audio], "audio", cancel=cancel, capture_stdout=False)
+    workspace.discard(raw_audio)
+
+    # s16le mono = 2 byte ต่อ sample → คำนวณความยาวจากขนาด PCM ได้เลย
+    audio_dur = len(pcm_bytes) / (2.0 * sample_rate)
+
+    adjusted = os.path.join(tmpdir, "audio_adj.wav")
+    diff = duration - audio_dur
+    if abs(diff) < 0.5:
+        adjusted = wav_audio
+    elif diff > 0:
+        run_media(["ffmpeg", "-y", "-i", wav_audio, "-af", f"apad=pad_dur={diff}", adjusted],
+                  "audio", cancel=cancel, check=False, capture_stdout=False)
+    else:
+        run_media(["ffmpeg", "-y", "-i", wav_audio, "-t", str(duration), adjusted],
+                  "audio", cancel=cancel, check=False, capture_stdout=False)
+    if adjusted != wav_audio:
+        workspace.discard(wav_audio)
+    return adjusted
+
+
+def _mux_audio(video_path, audio_path, duration, output_path, cancel=None, video_codec=None):
+    """ใส่เสียงพากย์แทนเสียงเดิม (copy video stream, encode AAC)"""
+    import preflight
+    mr = run_media([
+        "ffmpeg", "-y", "-i", video_path, "-i", audio_path,
+        "-c:v", "copy", *preflight.hvc1_tag(video_codec), "-c:a", "aac",
+        "-map", "0:v:0", "-map", "1:a:0", "-t", str(duration), output_path
+    ], "mux", cancel=cancel, check=False, capture_stdout=False)
+    if mr.returncode != 0:
+        raise Exception(f"FFmpeg failed: {mr.stderr[-300:]}")
+
+
+def _make_thumbnail(video_path, thumb_path, cancel=None):
+    """thumbnail webp 270x480 จากเฟรมแรกๆ ของวิดีโอ"""
+    run_media([
+        "ffmpeg", "-y", "-i", video_path, "-vframes", "1", "-ss", "0.1",
+        "-vf", "scale=270:480:force_original_aspect_ratio=increase,crop=270:480",
+        "-q:v", "80", thumb_path
+    ], "thumb", cancel=cancel, check=False, capture_stdout=False)
+
+
+def _burn_subtitles(merged_nosub, srt_path, output_path, duration, tmpdir, progress_cb=None, cancel=None,
+                    on_encode_time=None, size=None):
+    """แปลง SRT → ASS แล้วฝังซับด้วย libx264 — ถ้าฝังไม่สำเร็จใช้ merged_nosub แทน
+    size: (กว้าง, สูง) ของภาพถ้ารู้อยู่แล้ว (video stream ของ merged_nosub copy มาจากต้นฉบับ)
+    คืน True ถ้าฝังซับสำเร็จ"""
+    import mediainfo
+    ass_path = os.path.join(tmpdir, "subtitles.ass")
+
+    if not (size and size[0] and size[1]):
+        try:
+            size = mediainfo.probe(merged_nosub, cancel).display_size
+        except mediainfo.ProbeError:
+            size = (None, None)
+    vw, vh = size[0] or 1080, size[1] or 1920
+
+    if not warmup.capabilities()["libass"]:
+        # ffmpeg ไม่มี ass filter — encode ไปก็ล้มแน่ ใช้ merged_nosub เลย
+        print("[PIPELINE] FFmpeg has no libass → skip subtitle burn")
+        shutil.move(merged_nosub, output_path)
+        return False
+
+    _convert_to_ass(srt_path, ass_path, vw, vh)
+
+    print("[PIPELINE] Burning subtitles with FFmpeg Native...")
+    if progress_cb:
+        progress_cb("🎬 กำลังเตรียมซับไตเติ้ล...", 4.8)
+
+    # Use Native FFmpeg ASS plugin, pointing fontsdir to FONTS_DIR (/app) where font.ttf resides
+    cmd = [
+        "ffmpeg", "-y", "-i", merged_nosub,
+        "-progress", "-", "-nostats",
+        "-vf", f"ass={ass_path}:fontsdir={FONTS_DIR}",
+        "-c:v", "libx264", "-c:a", "copy", "-preset", "fast", output_path
+    ]
+
+    last_pct = [0]
+    fps = [None]
+
+    def on_progress(line):
+        line = line.strip()
+        if line.startswith("fps="):
+            try:
+                fps[0] = float(line.split("=")[1])
+            except ValueError:
+                pass
+        elif line.startswith("out_time_us="):
+            try:
+                us_val = line.split("=")[1]
+                if us_val != "N/A":
+                    current_sec = int(us_val) / 1000000.0
+                    if on_encode_time:
+                        on_encode_time(current_sec, duration)
+                    if duration > 0:
+                        pct = min(1.0, current_sec / duration)
+                        if pct - last_pct[0] > 0.05 or pct == 1.0:
+                            if progress_cb:
+                                # Map 0..1 to 4.8..4.99
+                                progress_cb(f"🎬 กำลังฝังซับไตเติ้ล ({current_sec:.1f}s / {duration:.1f}s)", 4.8 + (pct * 0.19))
+                            last_pct[0] = pct
+            except Exception:
+                pass
 
-        return merged, thumb, out_dur
+    try:
+        with _stage("encode"):
+            p = run_media(cmd, "burn", cancel=cancel, check=False, on_stdout_line=on_progress)
+        burn_rc, burn_err = p.returncode, p.stderr
+    except ProcessTimeout as e:
+        burn_rc, burn_err = -1, f"timeout: {e.stderr_tail}"
+    if burn_rc == 0 and fps[0]:
+        # fps บรรทัดสุดท้ายของ -progress = ค่าเฉลี่ยทั้งไฟล์
+        metrics.ENCODE_FPS.observe(fps[0])
+
+    if burn_rc != 0:
+        print(f"[PIPELINE] FFmpeg sub error: returncode {burn_rc}\n{burn_err[-500:]}")
+        # Fallback on merge_nosub if subtitle burning fails completely
+        shutil.move(merged_nosub, output_path)
+    else:
+        # output มีซับแล้ว — ไม่ต้องเก็บ merged_nosub ไว้จนจบ job
+        workspace.discard(merged_nosub)
+    workspace.discard(ass_path, srt_path)
+    return burn_rc == 0
 
 
 def _convert_to_ass(srt_file, ass_file, vw, vh):
@@ -968,14 +1422,244 @@ def pipeline():
     data = request.get_json()
     if not data or not data.get("token"):
         return jsonify({"error": "token required"}), 400
+    capacity.declare(request.headers.get("X-Instance-Id") or data.get("instance_id"))
+
+    job, created, cancelled = _start_pipeline(data, data.get("cancel_previous", CANCEL_PREVIOUS_DEFAULT))
+    if not created:
+        # ส่งซ้ำ (Worker retry) → ผูกกับ job เดิม ไม่เริ่มงานใหม่
+        status = "attached" if job.active else job.status
+        return jsonify({"status": status, "video_id": job.video_id, "duplicate": True,
+                        "job": job.to_dict(), "cancelled": []})
+    return jsonify({"status": "started", "video_id": job.video_id, "cancelled": cancelled})
+
+
+@app.route("/redub", methods=["POST"])
+def redub():
+    """
+    พากย์เสียงใหม่ให้วิดีโอที่ทำเสร็จแล้ว: {"video_id", "script", "voice"?} + credentials แบบ /pipeline
+    ทำแค่ TTS → จับเวลาซับ → encode แล้วอัปโหลดทับ videos/{id}.mp4 + metadata — ติดตามที่ /jobs/<video_id>/events
+    """
+    data = request.get_json()
+    if not data or not data.get("token"):
+        return jsonify({"error": "token required"}), 400
+    missing = [k for k in ("video_id", "script", "api_key", "worker_url", "r2_public_url")
+               if not str(data.get(k) or "").strip()]
+    if missing:
+        return jsonify({"error": f"{', '.join(missing)} required"}), 400
+    voice = data.get("voice")
+    if voice is not None and not (isinstance(voice, str) and re.fullmatch(r"[A-Za-z]+", voice)):
+        return jsonify({"error": "invalid voice"}), 400
+    capacity.declare(request.headers.get("X-Instance-Id") or data.get("instance_id"))
+
+    video_id = data["video_id"]
+    try:
+        metadata = _r2_get_json(data["worker_url"], data["token"], f"videos/{video_id}.json")
+    except Exception as e:
+        return jsonify({"error": str(e)[:200]}), 502
+    if not metadata:
+        return jsonify({"error": "video not found", "video_id": video_id}), 404
+
+    data.update(kind=jobs.REDUB, script=data["script"].strip(), metadata=metadata,
+                chat_id=data.get("chat_id") or metadata.get("chatId"))
+    job, created = jobs.register_if_idle(video_id, data["chat_id"], kind=jobs.REDUB)
+    if not created:
+        # pipeline / redub ของวิดีโอนี้ยังรันอยู่ — ยกเลิกที่ /jobs/<id>/cancel ก่อนแล้วส่งใหม่
+        return jsonify({"error": "video is busy", "video_id": video_id, "job": job.to_dict()}), 409
+    scheduler.submit(data, job)
+    return jsonify({"status": "started", "video_id": video_id, "job": job.to_dict()})
+
+
+def _dedup_key(video_url):
+    """hash ของ video_url — ใช้จับ submission ซ้ำที่ได้ video_id ใหม่"""
+    if not video_url or not DEDUP_BY_URL:
+        return None
+    import hashlib
+    return hashlib.sha256(video_url.encode("utf-8")).hexdigest()[:16]
+
+
+def _start_pipeline(data, cancel_previous=False):
+    """ลงทะเบียน job + เริ่ม run_pipeline_bg thread — คืน (job, created, video_id ที่ถูกยกเลิก)
+    ถ้าเป็น submission ซ้ำของ job ที่รันอยู่จะคืน job เดิม (created=False) และไม่เริ่ม thread ใหม่"""
+    import uuid
+    video_id = data.get("video_id") or uuid.uuid4().hex[:8]
+    data["video_id"] = video_id
+    chat_id = data.get("chat_id")
+
+    job, created = jobs.register_or_attach(video_id, chat_id, _dedup_key(data.get("video_url")))
+    if not created:
+        print(f"[PIPELINE] Duplicate dispatch for videoId={video_id} → attached to {job.video_id} ({job.status})")
+        return job, False, []
+
+    # ส่งคลิปใหม่ (แก้แล้ว) มาแทน → ยกเลิกงานเก่าของ chat เดียวกัน
+    cancelled = []
+    if cancel_previous and chat_id is not None:
+        for old in jobs.active_for_chat(chat_id):
+            if old is not job:
+                old.cancel.cancel(f"replaced by {video_id}")
+                cancelled.append(old.video_id)
+        if cancelled:
+            print(f"[PIPELINE] Cancelled previous jobs for chat_id={chat_id}: {cancelled}")
+
+    # เข้าคิว fair ต่อ chat — เริ่มจริงเมื่อมี slot ว่าง (scheduler.py)
+    scheduler.submit(data, job)
+    return job, True, cancelled
+
+
+def _launch(data, job):
+    """เริ่ม job ที่ถึงคิวแล้ว (scheduler เรียก)"""
+    target = run_redub_bg if job.kind == jobs.REDUB else run_pipeline_bg
+    if runner.ENABLED:
+        # process แยกต่อ job — HTTP process ตอบ /health, /xhs/resolve ได้เร็วแม้มีหลาย job
+        runner.spawn(data, job)
+        print(f"[PIPELINE] Started runner process for chat_id={job.chat_id}")
+    else:
+        t = threading.Thread(target=target, args=(data, job), daemon=True)
+        t.start()
+        print(f"[PIPELINE] Started background thread for chat_id={job.chat_id}")
+
+
+def _queue_step_name(position):
+    return f"⏳ รอคิว (ลำดับที่ {position})"
+
+
+def _queued_status(job, position):
+    """ลำดับคิวของ job เปลี่ยน — แจ้งทาง SSE (/jobs/<id>/events) เท่านั้น ไม่เรียก network"""
+    job.update(step_name=_queue_step_name(position))
+
+
+def _touch_processing(data, video_id, step_name):
+    """ต่ออายุ _processing/{id}.json (stepName + updatedAt) ไม่ให้ watchdog ของ Worker ถือว่าค้างแล้ว redispatch"""
+    worker_url, token = data.get("worker_url"), data.get("token")
+    if not worker_url:
+        return
+    url = f"{worker_url}/api/r2-proxy/_processing/{video_id}.json"
+    get_req = http_requests.get(url, headers={'x-auth-token': token}, timeout=10)
+    if get_req.status_code != 200:
+        return
+    status = get_req.json()
+    status["stepName"] = step_name
+    status["updatedAt"] = time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    _r2_put(worker_url, token, f"_processing/{video_id}.json", json.dumps(status).encode(), "application/json")
+
+
+def _queued_heartbeat(job, data, position):
+    """job ยังรอคิวใน container — ต่ออายุ _processing (ทุก QUEUE_HEARTBEAT)"""
+    _touch_processing(data, job.video_id, _queue_step_name(position))
+
+
+def _cancelled_while_queued(job, data):
+    """job ถูกยกเลิกก่อนได้เริ่ม (scheduler จบ job ไปแล้ว) — เก็บกวาดแบบเดียวกับ run_pipeline_bg ตอน cancel"""
+    if job.kind == jobs.REDUB:
+        return
+    checkpoint.JobState(job.video_id).clear()
+    worker_url, token, chat_id = data.get("worker_url"), data.get("token"), data.get("chat_id")
+    if data.get("msg_id"):
+        try:
+            edit_status(token, chat_id, data["msg_id"], f"🛑 ยกเลิกงานแล้ว ({job.video_id})")
+        except Exception:
+            pass
+    if not worker_url:
+        return
+    # ทำเครื่องหมาย cancelled ใน _processing → Worker ปล่อยคิวถัดไปได้ทันที
+    try:
+        url = f"{worker_url}/api/r2-proxy/_processing/{job.video_id}.json"
+        get_req = http_requests.get(url, headers={'x-auth-token': token}, timeout=15)
+        status = get_req.json() if get_req.status_code == 200 else {"id": job.video_id, "chatId": chat_id}
+        status["status"] = "cancelled"
+        status["error"] = (job.error or "cancelled")[:200]
+        status["updatedAt"] = time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        _r2_put(worker_url, token, f"_processing/{job.video_id}.json", json.dumps(status).encode(), "application/json")
+    except Exception as e:
+        print(f"[PIPELINE] Error updating cancelled status: {e}")
+    try:
+        http_requests.post(f"{worker_url}/api/queue/next", headers={'x-auth-token': token}, timeout=15)
+    except Exception as e:
+        print(f"[PIPELINE] Queue next error: {e}")
+
+
+scheduler.configure(_launch, _queued_status, _queued_heartbeat, _cancelled_while_queued)
+
+
+def resume_pending_jobs():
+    """container เพิ่ง start → ทำ job ที่ค้างจาก process ก่อนหน้าต่อจาก checkpoint"""
+    for state in checkpoint.pending_jobs():
+        print(f"[PIPELINE] Resuming interrupted job {state.video_id} (last stage: {state.last_stage()})")
+        _start_pipeline(state.get("payload"))
+
+
+@app.route("/scheduler", methods=["GET"])
+def scheduler_stats():
+    """คิว fair ต่อ chat_id — ลำดับที่จะได้เริ่ม และเวลารอคิวต่อ chat"""
+    return jsonify(scheduler.stats())
+
+
+@app.route("/capacity", methods=["GET"])
+def get_capacity():
+    """load ของ container นี้ — Worker ใช้เลือก instance ที่ว่างที่สุด (?instance_id= ประกาศชื่อ instance)"""
+    capacity.declare(request.headers.get("X-Instance-Id") or request.args.get("instance_id"))
+    return jsonify(capacity.report())
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus text exposition — latency ต่อ stage, retries, jobs, bytes, encode fps"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/jobs", methods=["GET"])
+def list_jobs():
+    """job ที่กำลังรัน + ที่เพิ่งจบใน container นี้"""
+    return jsonify({"jobs": [j.to_dict() for j in jobs.all_jobs()]})
+
+
+@app.route("/jobs/<video_id>", methods=["GET"])
+def get_job(video_id):
+    job = jobs.get(video_id)
+    if not job:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<video_id>/events", methods=["GET"])
+def job_events(video_id):
+    """Server-Sent Events: stage / percent / encode progress ของ job แบบ real-time"""
+    job = jobs.get(video_id)
+    if not job:
+        return jsonify({"error": "job not found"}), 404
+    return Response(jobs.events(job), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+@app.route("/jobs/<video_id>/trace", methods=["GET"])
+def job_trace(video_id):
+    """Chrome trace-event JSON ของ job (เปิดใน chrome://tracing หรือ ui.perfetto.dev)"""
+    trace = tracing.get(video_id)
+    if not trace:
+        return jsonify({"error": "trace not found"}), 404
+    return jsonify(trace.to_chrome())
+
+
+@app.route("/jobs/<video_id>/cancel", methods=["POST"])
+def cancel_job(video_id):
+    """ยกเลิก job — kill ffmpeg/whisper ที่รันอยู่ทันที, Gemini หยุดที่ checkpoint ถัดไป"""
+    job = jobs.get(video_id)
+    if not job:
+        return jsonify({"error": "job not found"}), 404
+    if not job.active:
+        return jsonify({"error": f"job already {job.status}", "job": job.to_dict()}), 409
 
-    t = threading.Thread(target=run_pipeline_bg, args=(data,), daemon=True)
-    t.start()
-    print(f"[PIPELINE] Started background thread for chat_id={data.get('chat_id')}")
-    return jsonify({"status": "started"})
+    data = request.get_json(silent=True) or {}
+    jobs.cancel(video_id, data.get("reason") or "cancelled by request")
+    print(f"[PIPELINE] Cancel requested: videoId={video_id}")
+    return jsonify({"status": "cancelling", "job": job.to_dict()})
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     print(f"[CONTAINER] Starting dubbing container on port {port}")
+    warmup.start()
+    if os.environ.get("RESUME_ON_STARTUP", "1") == "1":
+        resume_pending_jobs()
     app.run(host="0.0.0.0", port=port, debug=False)
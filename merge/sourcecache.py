@@ -0,0 +1,245 @@
+"""
+Cache วิดีโอต้นฉบับบน disk — job ที่ถูก redispatch / ส่งลิงก์ XHS เดิมซ้ำ ไม่ต้องโหลดจาก CDN ใหม่
+key 2 ชั้น: URL → sha256 ของเนื้อไฟล์ → blob (URL ต่างกันแต่ไฟล์เดียวกันใช้ blob เดียว)
+จำกัดขนาดรวม (SOURCE_CACHE_MAX_MB) ไล่ blob ที่ไม่ได้ใช้นานสุดออกก่อน (LRU) และหมดอายุตาม SOURCE_CACHE_TTL
+ไฟล์ที่ส่งให้ผู้เรียกเป็น hard link ของ blob — ถูก evict ทีหลังก็ไม่กระทบไฟล์ของ job
+index ใช้ร่วมกันได้หลาย process (runner.py) — อ่านใหม่จาก disk ทุกครั้งภายใต้ flock
+ดาวน์โหลด url เดียวกันพร้อมกันหลาย job / process → flock ต่อ url, โหลดครั้งเดียว ที่เหลือรอแล้วได้ hit
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import downloader
+import metrics
+
+CACHE_DIR = os.environ.get("SOURCE_CACHE_DIR", "/app/cache/sources")
+MAX_BYTES = int(float(os.environ.get("SOURCE_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+TTL = int(os.environ.get("SOURCE_CACHE_TTL", str(24 * 3600)))
+
+INDEX = "index.json"
+
+_lock = threading.Lock()
+_url_locks = {}
+# {"urls": {url: sha256}, "blobs": {sha256: {"size", "stored", "used"}}, "lookups": {"hit", "miss"}}
+# ใช้ได้เฉพาะใน _locked() — จำนวน hit / miss อยู่ใน index ด้วย ให้ทุก process นับรวมกัน
+_index = None
+
+
+def enabled():
+    return MAX_BYTES > 0
+
+
+def _blob_path(digest):
+    return os.path.join(CACHE_DIR, "blobs", digest + ".mp4")
+
+
+@contextmanager
+def _locked():
+    """lock ระหว่าง thread + ระหว่าง process แล้วโหลด index ล่าสุดจาก disk"""
+    global _index
+    with _lock:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(os.path.join(CACHE_DIR, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(os.path.join(CACHE_DIR, INDEX), encoding="utf-8") as f:
+                        _index = json.load(f)
+                except (OSError, ValueError):
+                    _index = {}
+                _index.setdefault("urls", {})
+                _index.setdefault("blobs", {})
+                _index.setdefault("lookups", {"hit": 0, "miss": 0})
+                # blob ที่ไฟล์หายไป (ลบมือ / disk ถูกล้าง) ไม่นับ
+                for digest in [d for d in _index["blobs"] if not os.path.exists(_blob_path(d))]:
+                    _drop_blob(digest)
+                yield _index
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _save():
+    path = os.path.join(CACHE_DIR, INDEX)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(_index, f)
+    os.replace(path + ".tmp", path)
+
+
+def _drop_blob(digest):
+    _index["blobs"].pop(digest, None)
+    for url in [u for u, d in _index["urls"].items() if d == digest]:
+        del _index["urls"][url]
+    try:
+        os.remove(_blob_path(digest))
+    except OSError:
+        pass
+
+
+def _evict(now):
+    """ลบ blob ที่หมดอายุ แล้วไล่ LRU จนขนาดรวมไม่เกิน MAX_BYTES"""
+    blobs = _index["blobs"]
+    for digest in [d for d, b in blobs.items() if now - b["stored"] > TTL]:
+        metrics.SOURCE_CACHE.inc(result="expired")
+        _drop_blob(digest)
+    total = sum(b["size"] for b in blobs.values())
+    for digest in sorted(blobs, key=lambda d: blobs[d]["used"]):
+        if total <= MAX_BYTES:
+            break
+        total -= blobs[digest]["size"]
+        metrics.SOURCE_CACHE.inc(result="evicted")
+        _drop_blob(digest)
+
+
+def _link(src, dest):
+    """hard link (ไม่ copy) ถ้าอยู่ filesystem เดียวกัน"""
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    tmp = dest + ".link"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _lookup(url, dest, now):
+    """url อยู่ใน cache และยังไม่หมดอายุ → link blob ไปที่ dest แล้วคืน (digest, size)
+    นับ hit / miss ลง index ด้วย"""
+    with _locked() as index:
+        digest = index["urls"].get(url)
+        blob = index["blobs"].get(digest) if digest else None
+        if blob and (now - blob["stored"] > TTL or not os.path.exists(_blob_path(digest))):
+            metrics.SOURCE_CACHE.inc(result="expired")
+            _drop_blob(digest)
+            blob = None
+        result = "hit" if blob else "miss"
+        index["lookups"][result] += 1
+        metrics.SOURCE_CACHE.inc(result=result)
+        if blob:
+            blob["used"] = now
+            _link(_blob_path(digest), dest)
+        _save()
+        return (digest, blob["size"]) if blob else None
+
+
+@contextmanager
+def _url_locked(url, cancel=None):
+    """lock ต่อ url ระหว่าง thread + ระหว่าง process (flock) — ยกเลิก job ได้ระหว่างรอ"""
+    with _lock:
+        url_lock = _url_locks.setdefault(url, threading.Lock())
+    try:
+        with url_lock:
+            lock_dir = os.path.join(CACHE_DIR, "locks")
+            os.makedirs(lock_dir, exist_ok=True)
+            with open(os.path.join(lock_dir, _url_hash(url) + ".lock"), "a") as lock_file:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if cancel is not None:
+                            cancel.wait(0.5)
+                            cancel.check()
+                        else:
+                            time.sleep(0.5)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+        with _lock:
+            if _url_locks.get(url) is url_lock and not url_lock.locked():
+                del _url_locks[url]
+
+
+def _url_hash(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+def fetch(url, dest, cancel=None, on_progress=None, headers=None):
+    """ได้ไฟล์ของ url ที่ dest — จาก cache ถ้ามี, ไม่งั้นดาวน์โหลด (downloader) แล้วเก็บเข้า cache
+    คืนจำนวน byte"""
+    if not enabled():
+        return downloader.download(url, dest, cancel, on_progress, headers)
+
+    # job พร้อมกันของ url เดียวกัน (คนละ process ก็ได้) → โหลดครั้งเดียว ตัวที่รอ lookup ใหม่แล้วได้ hit
+    with _url_locked(url, cancel):
+        return _fetch(url, dest, cancel, on_progress, headers)
+
+
+def _fetch(url, dest, cancel, on_progress, headers):
+    now = time.time()
+    hit = _lookup(url, dest, now)
+    if hit:
+        digest, size = hit
+        print(f"[CACHE] Source hit {digest[:12]} ({size/1024/1024:.1f} MB): {url[:80]}")
+        if on_progress:
+            on_progress(1.0, size)
+        return size
+
+    incoming = os.path.join(CACHE_DIR, "incoming", _url_hash(url))
+    # ดาวน์โหลดเข้า cache dir ตรงๆ ภายใต้ lock ของ url — .part ค้างจากรอบก่อนยัง resume ได้ (downloader)
+    size = downloader.download(url, incoming, cancel, on_progress, headers)
+    digest = _sha256(incoming)
+    blob = _blob_path(digest)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    with _locked() as index:
+        if digest in index["blobs"] and os.path.exists(blob):
+            os.remove(incoming)   # เนื้อไฟล์เดียวกับที่มีอยู่แล้ว (URL อื่น)
+        else:
+            os.replace(incoming, blob)
+            index["blobs"][digest] = {"size": size, "stored": now, "used": now}
+        index["urls"][url] = digest
+        index["blobs"][digest]["used"] = now
+        _link(blob, dest)
+        _evict(now)
+        _save()
+    return size
+
+
+def store(url, path):
+    """ไฟล์ที่มีอยู่บน disk แล้ว (เช่น original ที่เพิ่งอัปโหลด R2) → เก็บเข้า cache ภายใต้ url
+    fetch(url) ครั้งถัดไป (/redub) ได้ hit ไม่ต้องดาวน์โหลดกลับมา"""
+    if not enabled() or not os.path.exists(path):
+        return
+    now = time.time()
+    digest = _sha256(path)
+    blob = _blob_path(digest)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    with _locked() as index:
+        if digest not in index["blobs"] or not os.path.exists(blob):
+            _link(path, blob)
+            index["blobs"][digest] = {"size": os.path.getsize(blob), "stored": now, "used": now}
+        index["urls"][url] = digest
+        index["blobs"][digest]["used"] = now
+        _evict(now)
+        _save()
+
+
+def stats():
+    with _locked() as index:
+        hits, misses = index["lookups"]["hit"], index["lookups"]["miss"]
+        return {
+            "entries": len(index["blobs"]),
+            "urls": len(index["urls"]),
+            "bytes": sum(b["size"] for b in index["blobs"].values()),
+            "max_bytes": MAX_BYTES,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / max(1, hits + misses), 3),
+        }
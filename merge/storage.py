@@ -0,0 +1,191 @@
+"""
+อัปโหลดไฟล์ขึ้น R2 ตรงผ่าน S3-compatible API (ไม่ผ่าน Worker /api/r2-upload)
+ไฟล์ใหญ่ใช้ multipart upload — part ละ R2_PART_SIZE อ่านจาก disk / memory ทีละ part,
+อัปโหลดขนานกัน R2_UPLOAD_CONCURRENCY part และ retry เฉพาะ part ที่พัง
+ไม่ได้ตั้ง R2_ACCESS_KEY_ID / R2_SECRET_ACCESS_KEY → enabled() = False (ใช้ Worker proxy ตามเดิม)
+
+เซ็น request ด้วย AWS SigV4 เอง (hmac + hashlib) — ไม่ต้องลง boto3 ใน image
+ทดสอบ local: R2_ENDPOINT=http://localhost:9000/s3 (scripts/mock_services.py) หรือ MinIO
+"""
+import os
+import time
+import hmac
+import hashlib
+import datetime
+import xml.etree.ElementTree as ET
+from urllib.parse import quote, urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests as http_requests
+
+import metrics
+
+ACCOUNT_ID = os.environ.get("R2_ACCOUNT_ID", "")
+# endpoint เต็ม (path-style) — override ได้สำหรับ MinIO / mock; ไม่ตั้ง = https://<account>.r2.cloudflarestorage.com
+ENDPOINT = os.environ.get("R2_ENDPOINT", "").rstrip("/") or (
+    f"https://{ACCOUNT_ID}.r2.cloudflarestorage.com" if ACCOUNT_ID else "")
+BUCKET = os.environ.get("R2_BUCKET", "dubbing-videos")
+ACCESS_KEY_ID = os.environ.get("R2_ACCESS_KEY_ID", "")
+SECRET_ACCESS_KEY = os.environ.get("R2_SECRET_ACCESS_KEY", "")
+REGION = os.environ.get("R2_REGION", "auto")
+
+# S3 กำหนด part ขั้นต่ำ 5 MiB (ยกเว้น part สุดท้าย)
+PART_SIZE = max(5 * 1024 * 1024, int(os.environ.get("R2_PART_SIZE", str(8 * 1024 * 1024))))
+# ไฟล์เล็กกว่านี้ใช้ PutObject ครั้งเดียว
+MULTIPART_THRESHOLD = int(os.environ.get("R2_MULTIPART_THRESHOLD", str(PART_SIZE)))
+CONCURRENCY = max(1, int(os.environ.get("R2_UPLOAD_CONCURRENCY", "4")))
+PART_RETRIES = max(1, int(os.environ.get("R2_PART_RETRIES", "4")))
+PART_TIMEOUT = float(os.environ.get("R2_PART_TIMEOUT", "120"))
+
+_endpoint = urlparse(ENDPOINT)
+_session = http_requests.Session()
+
+
+class StorageError(Exception):
+    """S3 API ตอบ error — ผู้เรียก fallback ไป Worker proxy ได้"""
+
+
+def enabled():
+    return bool(ENDPOINT and ACCESS_KEY_ID and SECRET_ACCESS_KEY)
+
+
+# ==================== SigV4 ====================
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _sign(method, url_path, query, headers, payload_hash):
+    """คืน headers ที่เซ็นแล้ว (Authorization + x-amz-*) สำหรับ request นี้"""
+    now = datetime.datetime.utcnow()
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date = now.strftime("%Y%m%d")
+    headers = dict(headers)
+    headers["host"] = _endpoint.netloc
+    headers["x-amz-date"] = amz_date
+    headers["x-amz-content-sha256"] = payload_hash
+    signed = sorted(k.lower() for k in headers)
+    lower = {k.lower(): str(v).strip() for k, v in headers.items()}
+    canonical_headers = "".join(f"{k}:{lower[k]}\n" for k in signed)
+    canonical_query = "&".join(
+        f"{quote(k, safe='-_.~')}={quote(str(v), safe='-_.~')}" for k, v in sorted(query.items()))
+    canonical = "\n".join([method, quote(url_path, safe="/-_.~"), canonical_query,
+                           canonical_headers, ";".join(signed), payload_hash])
+
+    scope = f"{date}/{REGION}/s3/aws4_request"
+    to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                         hashlib.sha256(canonical.encode("utf-8")).hexdigest()])
+    key = _hmac(_hmac(_hmac(_hmac(("AWS4" + SECRET_ACCESS_KEY).encode("utf-8"), date), REGION), "s3"), "aws4_request")
+    signature = hmac.new(key, to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    headers["Authorization"] = (f"AWS4-HMAC-SHA256 Credential={ACCESS_KEY_ID}/{scope}, "
+                                f"SignedHeaders={';'.join(signed)}, Signature={signature}")
+    headers.pop("host")  # requests ใส่ Host เอง
+    return headers
+
+
+def _request(method, key, query=None, body=b"", headers=None, timeout=PART_TIMEOUT):
+    query = query or {}
+    # path-style: <endpoint path>/<bucket>/<key>
+    url_path = "/" + "/".join(p for p in (_endpoint.path.strip("/"), BUCKET, key) if p)
+    signed = _sign(method, url_path, query, headers or {}, hashlib.sha256(body).hexdigest())
+    url = f"{_endpoint.scheme}://{_endpoint.netloc}{quote(url_path, safe='/-_.~')}"
+    resp = _session.request(method, url, params=query or None, data=body, headers=signed, timeout=timeout)
+    if resp.status_code >= 300:
+        raise StorageError(f"S3 {method} {key}: {resp.status_code} {resp.text[:200]}")
+    metrics.bytes_moved(url, len(body), "up")
+    return resp
+
+
+def _xml_find(text, tag):
+    """อ่านค่า element แรกที่ชื่อ tag (ไม่สน namespace ของ S3)"""
+    for el in ET.fromstring(text).iter():
+        if el.tag.rsplit("}", 1)[-1] == tag:
+            return el.text
+    return None
+
+
+def warm():
+    """เปิด connection (DNS + TLS) ไป endpoint ไว้ใน pool ก่อนอัปโหลดแรก (warmup.py)
+    ไม่เซ็น — สถานะที่ตอบกลับไม่สำคัญ ขอแค่ connection"""
+    _session.head(ENDPOINT, timeout=5).close()
+
+
+# ==================== upload ====================
+
+def _read_part(source, offset, length):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[offset:offset + length])
+    with open(source, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _with_retry(op, fn):
+    """retry ด้วย backoff เฉพาะ error ชั่วคราว (network / 5xx / 429)"""
+    for attempt in range(PART_RETRIES):
+        try:
+            return fn()
+        except (http_requests.RequestException, StorageError) as e:
+            transient = not isinstance(e, StorageError) or any(
+                f": {code}" in str(e) for code in ("429", "500", "502", "503", "504"))
+            if not transient or attempt == PART_RETRIES - 1:
+                raise
+            metrics.RETRIES.inc(op=op)
+            print(f"[R2] {op} retry {attempt + 1}/{PART_RETRIES - 1}: {str(e)[:120]}")
+            time.sleep(min(2 ** attempt, 10))
+
+
+def upload(key, source, content_type="application/octet-stream", size=None):
+    """อัปโหลด bytes หรือ path ของไฟล์ไปที่ key — คืนจำนวน byte ที่อัปโหลด
+    raise StorageError / RequestException ถ้าไม่สำเร็จ (multipart ที่ค้างถูก abort แล้ว)"""
+    if size is None:
+        size = len(source) if isinstance(source, (bytes, bytearray, memoryview)) else os.path.getsize(source)
+
+    if size < MULTIPART_THRESHOLD:
+        body = _read_part(source, 0, size)
+        _with_retry("r2_put", lambda: _request("PUT", key, body=body, headers={"content-type": content_type}))
+        return size
+
+    upload_id = _xml_find(_with_retry("r2_create", lambda: _request(
+        "POST", key, query={"uploads": ""}, headers={"content-type": content_type})).text, "UploadId")
+    if not upload_id:
+        raise StorageError(f"S3 CreateMultipartUpload {key}: no UploadId")
+
+    n_parts = (size + PART_SIZE - 1) // PART_SIZE
+
+    def put_part(number):
+        offset = (number - 1) * PART_SIZE
+        length = min(PART_SIZE, size - offset)
+
+        def attempt():
+            # อ่านใหม่ทุกครั้งที่ retry — ไม่ถือ part ไว้ใน memory ระหว่างรอ backoff
+            body = _read_part(source, offset, length)
+            resp = _request("PUT", key, query={"partNumber": number, "uploadId": upload_id}, body=body)
+            return resp.headers.get("ETag", "")
+
+        return number, _with_retry("r2_part", attempt)
+
+    t0 = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=min(CONCURRENCY, n_parts)) as pool:
+            etags = dict(pool.map(put_part, range(1, n_parts + 1)))
+        body = "<CompleteMultipartUpload>" + "".join(
+            f"<Part><PartNumber>{n}</PartNumber><ETag>{etags[n]}</ETag></Part>" for n in sorted(etags)
+        ) + "</CompleteMultipartUpload>"
+        resp = _with_retry("r2_complete", lambda: _request(
+            "POST", key, query={"uploadId": upload_id}, body=body.encode("utf-8"),
+            headers={"content-type": "application/xml"}))
+        # S3 ตอบ 200 พร้อม <Error> ได้ถ้า complete ล้มระหว่างทาง
+        if "<Error>" in resp.text:
+            raise StorageError(f"S3 CompleteMultipartUpload {key}: {resp.text[:200]}")
+    except Exception:
+        try:
+            _request("DELETE", key, query={"uploadId": upload_id}, timeout=30)
+        except Exception as e:
+            print(f"[R2] Abort multipart {key} failed: {e}")
+        raise
+
+    elapsed = time.monotonic() - t0
+    print(f"[R2] {key}: {size/1024/1024:.1f} MB in {n_parts} parts, {elapsed:.1f}s "
+          f"({size/1024/1024/max(elapsed, 1e-6):.1f} MB/s)")
+    return size
@@ -0,0 +1,185 @@
+"""
+Trace timeline ต่อ job — span ของทุก stage / retry / subprocess / R2 call
+export เป็น Chrome trace-event format (เปิดใน chrome://tracing หรือ Perfetto ได้เลย)
+
+trace ผูกกับ thread ที่เรียก start() — span ที่เปิดใน thread อื่นหรือนอก job จะเป็น no-op
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# เก็บ trace ของ job ล่าสุดกี่ตัว
+MAX_TRACES = int(os.environ.get("TRACE_KEEP", "50"))
+
+_lock = threading.Lock()
+_traces = OrderedDict()   # video_id → Trace
+_local = threading.local()
+
+
+def _now_us():
+    return int(time.time() * 1_000_000)
+
+
+class Trace:
+    def __init__(self, video_id):
+        self.video_id = video_id
+        self.status = "running"
+        self.started_us = _now_us()
+        self._lock = threading.Lock()
+        self._spans = []
+        self._next_id = 1
+        self._threads = {}
+        self.meta = {}   # ข้อมูลเพิ่มเติมใน otherData เช่น profile report
+
+    def _tid(self):
+        ident = threading.get_ident()
+        with self._lock:
+            if ident not in self._threads:
+                self._threads[ident] = (len(self._threads) + 1, threading.current_thread().name)
+            return self._threads[ident][0]
+
+    def begin(self, name, cat, args, parent=None):
+        tid = self._tid()
+        with self._lock:
+            span = {
+                "id": self._next_id, "parent": parent, "name": name, "cat": cat,
+                "ts": _now_us(), "t0": time.perf_counter(), "dur": None,
+                "tid": tid, "args": dict(args),
+            }
+            self._next_id += 1
+            self._spans.append(span)
+        return span
+
+    def end(self, span, **args):
+        span["dur"] = int((time.perf_counter() - span["t0"]) * 1_000_000)
+        span["args"].update(args)
+
+    def add(self, name, cat, duration, args, parent=None):
+        """เพิ่ม span ที่จบไปแล้ว (เช่น subprocess ที่รู้แค่ wall time ตอนจบ)"""
+        dur = int(duration * 1_000_000)
+        tid = self._tid()
+        with self._lock:
+            self._spans.append({
+                "id": self._next_id, "parent": parent, "name": name, "cat": cat,
+                "ts": _now_us() - dur, "t0": None, "dur": dur, "tid": tid, "args": dict(args),
+            })
+            self._next_id += 1
+
+    def to_chrome(self):
+        now = time.perf_counter()
+        events = []
+        with self._lock:
+            spans = list(self._spans)
+            threads = list(self._threads.values())
+        for tid, tname in threads:
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": tname}})
+        for s in spans:
+            args = dict(s["args"], span_id=s["id"])
+            if s["parent"]:
+                args["parent_id"] = s["parent"]
+            dur = s["dur"]
+            if dur is None:
+                # span ที่ยังไม่จบ (job กำลังรัน) → ตัดที่เวลาปัจจุบัน
+                dur = int((now - s["t0"]) * 1_000_000)
+                args["open"] = True
+            events.append({
+                "name": s["name"], "cat": s["cat"], "ph": "X",
+                "ts": s["ts"], "dur": dur, "pid": 1, "tid": s["tid"], "args": args,
+            })
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": dict(self.meta, video_id=self.video_id, status=self.status),
+        }
+
+
+def start(video_id):
+    """เริ่ม trace ของ job ใน thread ปัจจุบัน — span ระดับบนสุดชื่อ "job" """
+    trace = Trace(video_id)
+    with _lock:
+        _traces.pop(video_id, None)
+        _traces[video_id] = trace
+        while len(_traces) > MAX_TRACES:
+            _traces.popitem(last=False)
+    _local.trace = trace
+    _local.stack = [trace.begin("job", "job", {"video_id": video_id})]
+    return trace
+
+
+def finish(status):
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return None
+    for span in reversed(_local.stack):
+        if span["dur"] is None:
+            trace.end(span)
+    trace.status = status
+    _local.trace = None
+    _local.stack = []
+    return trace
+
+
+def current():
+    return getattr(_local, "trace", None)
+
+
+class Snapshot:
+    """trace ที่ได้มาเป็น Chrome JSON แล้ว (จาก job ที่รันใน process อื่น)"""
+
+    def __init__(self, video_id, chrome):
+        self.video_id = video_id
+        self.chrome = chrome
+
+    def to_chrome(self):
+        return self.chrome
+
+
+def store(video_id, chrome):
+    """เก็บ trace ของ job ที่รันใน runner process — /jobs/<id>/trace อ่านได้เหมือน trace ใน process นี้"""
+    with _lock:
+        _traces.pop(video_id, None)
+        _traces[video_id] = Snapshot(video_id, chrome)
+        while len(_traces) > MAX_TRACES:
+            _traces.popitem(last=False)
+
+
+def get(video_id):
+    with _lock:
+        return _traces.get(video_id)
+
+
+@contextmanager
+def span(name, cat="stage", **args):
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        yield None
+        return
+    stack = _local.stack
+    s = trace.begin(name, cat, args, parent=stack[-1]["id"] if stack else None)
+    stack.append(s)
+    try:
+        yield s
+    except BaseException as e:
+        s["args"]["error"] = str(e)[:200]
+        raise
+    finally:
+        trace.end(s)
+        if stack and stack[-1] is s:
+            stack.pop()
+
+
+def record(name, cat, duration, **args):
+    """span ที่จบไปแล้ว — เวลาเริ่มคำนวณย้อนจาก duration"""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return
+    stack = _local.stack
+    trace.add(name, cat, duration, args, parent=stack[-1]["id"] if stack else None)
+
+
+def observe_process(result):
+    """observer ของ mediaproc.run_media"""
+    record(result.cmd[0], "process", result.wall, stage=result.stage,
+           cpu_s=round(result.cpu, 3), returncode=result.returncode)
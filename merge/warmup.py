@@ -0,0 +1,195 @@
+"""
+Startup warmup — ทำของที่แพงครั้งเดียวตอน container boot แทนที่ job แรกจะต้องจ่าย
+- probe ffmpeg / ffprobe / libass / whisper-ctranslate2 ครั้งเดียวแล้ว cache (/health ไม่ต้อง spawn ffmpeg ทุก probe)
+- สร้าง fontconfig cache ของ FONTS_DIR (render ซับ 1 frame ผ่าน libass)
+- โหลด Whisper weights ล่วงหน้า (WARMUP_WHISPER=1) — ถอดเสียงเงียบ 1 วินาทีด้วย model เดียวกับ pipeline
+- เปิด connection pool ของ XHS / R2 S3 ไว้ก่อน
+
+start() รันทั้งหมดใน background thread — /ready ตอบ 200 เมื่อเสร็จและ ffmpeg ใช้ได้
+runner process (runner.py) ได้ capabilities จาก parent ผ่าน load() ไม่ต้อง probe ซ้ำทุก job
+"""
+import os
+import time
+import wave
+import shutil
+import tempfile
+import threading
+
+import storage
+import xhs
+from mediaproc import run_media
+
+FONTS_DIR = os.environ.get("FONTS_DIR", "/app")
+WARMUP_FONTS = os.environ.get("WARMUP_FONTS", "1") == "1"
+WARMUP_WHISPER = os.environ.get("WARMUP_WHISPER", "1") == "1"
+WARMUP_HTTP = os.environ.get("WARMUP_HTTP", "1") == "1"
+
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "turbo")
+WHISPER_COMPUTE_TYPE = os.environ.get("WHISPER_COMPUTE_TYPE", "int8")
+
+_caps = None
+_caps_lock = threading.Lock()    # อ่าน / เขียน _caps เท่านั้น — cached_capabilities() ไม่รอ probe
+_probe_lock = threading.Lock()   # probe ทีละครั้ง
+_state = {"phase": "pending", "started_at": None, "finished_at": None, "checks": {}}
+_state_lock = threading.Lock()
+
+
+def whisper_cmd(audio_path, output_dir, language="th"):
+    """คำสั่ง whisper-ctranslate2 ของ pipeline — warmup ใช้ตัวเดียวกันเพื่อโหลด model เดียวกัน"""
+    return [
+        "whisper-ctranslate2", audio_path,
+        "--model", WHISPER_MODEL,
+        "--language", language,
+        "--output_format", "srt",
+        "--output_dir", output_dir,
+        "--compute_type", WHISPER_COMPUTE_TYPE,
+        "--word_timestamps", "True",
+        "--max_line_width", "20",
+        "--max_line_count", "1",
+    ]
+
+
+# ==================== capabilities ====================
+
+def _probe_caps():
+    caps = {"ffmpeg": False, "ffprobe": False, "version": None, "libass": False,
+            "libx264": False, "whisper": bool(shutil.which("whisper-ctranslate2"))}
+    try:
+        r = run_media(["ffmpeg", "-hide_banner", "-version"], "version", check=False)
+        if r.returncode == 0:
+            caps["ffmpeg"] = True
+            caps["version"] = (r.stdout.splitlines() or [""])[0].replace("ffmpeg version ", "").split(" ")[0]
+            filters = run_media(["ffmpeg", "-hide_banner", "-filters"], "version", check=False).stdout
+            caps["libass"] = " ass " in filters
+            encoders = run_media(["ffmpeg", "-hide_banner", "-encoders"], "version", check=False).stdout
+            caps["libx264"] = " libx264 " in encoders
+    except Exception as e:
+        print(f"[WARMUP] ffmpeg probe failed: {e}")
+    try:
+        caps["ffprobe"] = run_media(["ffprobe", "-version"], "version", check=False).returncode == 0
+    except Exception:
+        pass
+    return caps
+
+
+def capabilities():
+    """ความสามารถของ ffmpeg / whisper ในเครื่องนี้ — probe ครั้งแรกครั้งเดียว"""
+    global _caps
+    with _probe_lock:
+        with _caps_lock:
+            if _caps is not None:
+                return dict(_caps)
+        t0 = time.monotonic()
+        caps = _probe_caps()
+        print(f"[WARMUP] Capabilities ({time.monotonic() - t0:.2f}s): {caps}")
+        with _caps_lock:
+            if _caps is None:
+                _caps = caps
+            return dict(_caps)
+
+
+def load(caps):
+    """ใช้ capabilities ที่ probe ไว้แล้ว (จาก parent process)"""
+    global _caps
+    if caps:
+        with _caps_lock:
+            _caps = dict(caps)
+
+
+def cached_capabilities():
+    """capabilities ถ้า probe แล้ว, ไม่งั้น None — ไม่ spawn อะไร"""
+    with _caps_lock:
+        return dict(_caps) if _caps is not None else None
+
+
+# ==================== warmup tasks ====================
+
+def _warm_fonts(tmpdir):
+    """render ซับ 1 frame ผ่าน libass + fontsdir → fontconfig scan / cache font ไว้ก่อน job แรก"""
+    if shutil.which("fc-cache"):
+        run_media(["fc-cache", FONTS_DIR], "warmup", check=False)
+    ass_path = os.path.join(tmpdir, "warmup.ass")
+    with open(ass_path, "w", encoding="utf-8") as f:
+        f.write("""[Script Info]
+ScriptType: v4.00+
+PlayResX: 320
+PlayResY: 240
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,FC Iconic,40,&H00FFFFFF,&H00000000,&H00000000,&H80000000,-1,0,0,0,100,100,0,0,1,4,0,2,10,10,20,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+Dialogue: 0,0:00:00.00,0:00:01.00,Default,,0,0,0,,สวัสดี warmup
+""")
+    run_media([
+        "ffmpeg", "-hide_banner", "-y", "-f", "lavfi", "-i", "color=c=black:s=320x240:d=0.1",
+        "-vf", f"ass={ass_path}:fontsdir={FONTS_DIR}", "-frames:v", "1", "-f", "null", "-",
+    ], "warmup")
+
+
+def _warm_whisper(tmpdir):
+    """ถอดเสียงเงียบ 1 วินาที — ดาวน์โหลด weights (ครั้งแรก) + อ่านเข้า page cache"""
+    wav_path = os.path.join(tmpdir, "silence.wav")
+    with wave.open(wav_path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(b"\x00\x00" * 16000)
+    run_media(whisper_cmd(wav_path, tmpdir), "warmup", capture_stdout=False)
+
+
+def _warm_http():
+    xhs.warm()
+    if storage.enabled():
+        storage.warm()
+
+
+def _run_check(name, fn, *args):
+    t0 = time.monotonic()
+    try:
+        fn(*args)
+        result = {"ok": True}
+    except Exception as e:
+        result = {"ok": False, "error": str(e)[:200]}
+    result["seconds"] = round(time.monotonic() - t0, 2)
+    print(f"[WARMUP] {name}: {'ok' if result['ok'] else 'failed — ' + result['error']} ({result['seconds']}s)")
+    with _state_lock:
+        _state["checks"][name] = result
+
+
+def _run():
+    caps = capabilities()
+    with tempfile.TemporaryDirectory(prefix="warmup_") as tmpdir:
+        if WARMUP_HTTP:
+            _run_check("http", _warm_http)
+        if WARMUP_FONTS and caps["libass"]:
+            _run_check("fonts", _warm_fonts, tmpdir)
+        if WARMUP_WHISPER and caps["whisper"]:
+            _run_check("whisper", _warm_whisper, tmpdir)
+    with _state_lock:
+        _state["phase"] = "done"
+        _state["finished_at"] = time.time()
+    print(f"[WARMUP] Done in {_state['finished_at'] - _state['started_at']:.1f}s")
+
+
+def start():
+    """เริ่ม warmup ใน background (เรียกซ้ำได้ — ทำครั้งเดียว)"""
+    with _state_lock:
+        if _state["phase"] != "pending":
+            return
+        _state["phase"] = "running"
+        _state["started_at"] = time.time()
+    threading.Thread(target=_run, daemon=True, name="warmup").start()
+
+
+def status():
+    """(ready, รายละเอียด) สำหรับ /ready — ต้อง warmup เสร็จ และมี ffmpeg + ffprobe"""
+    caps = cached_capabilities()
+    with _state_lock:
+        detail = {"phase": _state["phase"], "checks": dict(_state["checks"]), "capabilities": caps}
+        if _state["finished_at"]:
+            detail["warmup_seconds"] = round(_state["finished_at"] - _state["started_at"], 2)
+    ready = detail["phase"] == "done" and bool(caps and caps["ffmpeg"] and caps["ffprobe"])
+    return ready, detail
@@ -0,0 +1,208 @@
+"""
+Disk workspace ของ pipeline job — ประเมินพื้นที่ที่ job จะใช้จากขนาดวิดีโอต้นฉบับ แล้วรับงานเมื่อ disk พอเท่านั้น
+- footprint ≈ ต้นฉบับ × WORKSPACE_FOOTPRINT_FACTOR (original + merged_nosub + output + ไฟล์ชั่วคราวของ normalize)
+- job ที่รับแล้วจองพื้นที่ส่วนที่ยังไม่ได้เขียน (ประมาณการ − ขนาด job directory จริง) ไว้ — job ใหม่เห็นพื้นที่ที่เหลือจริง
+- disk ไม่พอ → รอจน job อื่นคืนพื้นที่ (ยกเลิกได้) หรือ fail ถ้าต่อให้ว่างทั้ง disk ก็ไม่พอ
+- SCRATCH_DIR (เช่น /dev/shm) → ไฟล์เล็กที่ใช้บ่อย (เสียง / ซับ) อยู่บน tmpfs แทน disk
+การจองเป็นไฟล์ใน WORKSPACE_LEDGER_DIR ใต้ flock — runner process ทุกตัว (runner.py) เห็นกันหมด
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import threading
+from contextlib import contextmanager
+
+import checkpoint
+
+ROOT = checkpoint.STATE_DIR
+LEDGER_DIR = os.environ.get("WORKSPACE_LEDGER_DIR", "/tmp/dubbing-workspace")
+FOOTPRINT_FACTOR = float(os.environ.get("WORKSPACE_FOOTPRINT_FACTOR", "3.0"))
+# เสียง PCM / WAV / SRT / ASS / thumbnail
+FOOTPRINT_EXTRA = int(float(os.environ.get("WORKSPACE_EXTRA_MB", "32")) * 1024 * 1024)
+# ไม่รู้ขนาดต้นฉบับ (server ไม่ส่ง Content-Length) → ถือว่าเท่านี้
+DEFAULT_SOURCE = int(float(os.environ.get("WORKSPACE_DEFAULT_SOURCE_MB", "100")) * 1024 * 1024)
+# เหลือ disk ว่างไว้เสมอ (log, source cache, checkpoint ของ job ที่ fail)
+RESERVE = int(float(os.environ.get("WORKSPACE_RESERVE_MB", "512")) * 1024 * 1024)
+ADMIT_TIMEOUT = float(os.environ.get("WORKSPACE_ADMIT_TIMEOUT", "1800"))
+
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", "")
+SCRATCH_MAX = int(float(os.environ.get("SCRATCH_MAX_MB", "256")) * 1024 * 1024)
+# ต่อ job: เสียงยาว 60 วินาทีที่ 24 kHz ≈ 3 MB × (raw + wav + padded)
+SCRATCH_PER_JOB = int(float(os.environ.get("SCRATCH_PER_JOB_MB", "24")) * 1024 * 1024)
+
+_lock = threading.Lock()
+
+
+class NoSpace(Exception):
+    """disk ไม่พอสำหรับ job นี้ (หรือรอนานเกิน WORKSPACE_ADMIT_TIMEOUT)"""
+
+
+@contextmanager
+def _locked():
+    with _lock:
+        os.makedirs(LEDGER_DIR, exist_ok=True)
+        with open(os.path.join(LEDGER_DIR, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _du(path):
+    total = 0
+    for dirpath, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _free(path):
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def _reservations():
+    """การจองที่เจ้าของยังอยู่ (ลบของ process ที่ตายไปแล้ว)"""
+    out = []
+    for name in os.listdir(LEDGER_DIR):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(LEDGER_DIR, name)
+        try:
+            with open(path, encoding="utf-8") as f:
+                r = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not _alive(r["owner"]):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        out.append(r)
+    return out
+
+
+def _outstanding(reservations):
+    """พื้นที่ที่ job ที่รับแล้วจะเขียนเพิ่ม (ส่วนที่เขียนไปแล้วถูกหักจาก disk free อยู่แล้ว)"""
+    return sum(max(0, r["estimate"] - _du(r["dir"])) for r in reservations)
+
+
+def estimate(source_bytes):
+    return int((source_bytes or DEFAULT_SOURCE) * FOOTPRINT_FACTOR) + FOOTPRINT_EXTRA
+
+
+class Workspace:
+    """พื้นที่ที่ job หนึ่งจองไว้ — release() เมื่อ job จบ"""
+
+    def __init__(self, video_id, job_dir, estimate_bytes, scratch=None):
+        self.video_id = video_id
+        self.dir = job_dir
+        self.estimate = estimate_bytes
+        self.scratch = scratch   # โฟลเดอร์บน tmpfs ของ job นี้ (หรือ None)
+
+    def hot_dir(self, fallback):
+        """ที่เก็บไฟล์เล็กที่ใช้บ่อย — tmpfs ถ้าตั้ง SCRATCH_DIR ไว้ ไม่งั้น fallback"""
+        if self.scratch:
+            os.makedirs(self.scratch, exist_ok=True)
+            return self.scratch
+        return fallback
+
+    def release(self):
+        with _locked():
+            try:
+                os.remove(os.path.join(LEDGER_DIR, self.video_id + ".json"))
+            except OSError:
+                pass
+        if self.scratch:
+            shutil.rmtree(self.scratch, ignore_errors=True)
+
+
+def _claim_scratch(video_id, reservations):
+    if not SCRATCH_DIR or not os.path.isdir(SCRATCH_DIR):
+        return None
+    used = sum(SCRATCH_PER_JOB for r in reservations if r.get("scratch"))
+    if used + SCRATCH_PER_JOB > SCRATCH_MAX or _free(SCRATCH_DIR) < SCRATCH_PER_JOB:
+        return None
+    return os.path.join(SCRATCH_DIR, f"dubbing-{video_id}")
+
+
+def admit(video_id, job_dir, source_bytes, cancel=None, on_wait=None):
+    """จองพื้นที่ให้ job — รอจน disk พอ (on_wait(need, available) ทุกครั้งที่ต้องรอ) คืน Workspace
+    raise NoSpace ถ้าต่อให้ไม่มี job อื่นก็ไม่พอ หรือรอนานเกิน ADMIT_TIMEOUT"""
+    need = estimate(source_bytes)
+    deadline = time.monotonic() + ADMIT_TIMEOUT
+    # job ที่ resume มีไฟล์อยู่แล้วบางส่วน — ต้องการเพิ่มแค่ส่วนที่เหลือ
+    have = _du(job_dir) if os.path.isdir(job_dir) else 0
+    while True:
+        with _locked():
+            others = [r for r in _reservations() if r["video_id"] != video_id]
+            available = _free(ROOT) - RESERVE - _outstanding(others)
+            if need - have <= available:
+                scratch = _claim_scratch(video_id, others)
+                record = {"video_id": video_id, "owner": os.getpid(), "dir": job_dir,
+                          "estimate": need, "scratch": bool(scratch), "admitted": time.time()}
+                path = os.path.join(LEDGER_DIR, video_id + ".json")
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(record, f)
+                os.replace(path + ".tmp", path)
+                print(f"[WORKSPACE] {video_id}: admitted {need/1024/1024:.0f} MB "
+                      f"(available {available/1024/1024:.0f} MB{', scratch on ' + SCRATCH_DIR if scratch else ''})")
+                return Workspace(video_id, job_dir, need, scratch)
+            # ต่อให้ job อื่นจบและลบไฟล์หมด ก็ยังไม่พอ → ไม่ต้องรอ
+            best_case = _free(ROOT) - RESERVE + sum(_du(r["dir"]) for r in others)
+            if need - have > best_case:
+                raise NoSpace(f"พื้นที่ดิสก์ไม่พอ: ต้องการ {need/1024/1024:.0f} MB, "
+                              f"ว่างได้สูงสุด {max(0, best_case)/1024/1024:.0f} MB")
+        if time.monotonic() > deadline:
+            raise NoSpace(f"รอพื้นที่ดิสก์นานเกิน {ADMIT_TIMEOUT:.0f}s (ต้องการ {need/1024/1024:.0f} MB)")
+        if on_wait:
+            on_wait(need, available)
+        if cancel is not None:
+            if cancel.wait(5):
+                cancel.check()
+        else:
+            time.sleep(5)
+
+
+def discard(*paths):
+    """ลบไฟล์ชั่วคราวที่ stage ถัดไปไม่ใช้แล้วทันที (ไม่รอลบทั้ง workdir ตอนจบ)"""
+    for path in paths:
+        if not path:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def status():
+    """การจองทั้ง container (ทุก process) — สำหรับ /capacity"""
+    with _locked():
+        reservations = _reservations()
+        outstanding = _outstanding(reservations)
+    return {
+        "reserved_bytes": sum(r["estimate"] for r in reservations),
+        "outstanding_bytes": outstanding,
+        "available_bytes": max(0, _free(ROOT) - RESERVE - outstanding),
+        "reserve_bytes": RESERVE,
+        "scratch_dir": SCRATCH_DIR or None,
+        "jobs": {r["video_id"]: r["estimate"] for r in reservations},
+    }
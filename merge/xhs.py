@@ -0,0 +1,201 @@
+"""
+XHS link → direct video URL
+- session เดียวใช้ร่วมกัน (connection pool) แทนการสร้าง Session ใหม่ทุก request
+- อ่าน HTML แบบ stream แล้วหยุดทันทีที่เจอ masterUrl ของ sns-video (ไม่ต้องโหลดทั้งหน้า)
+- cache ผลตาม link ที่ส่งมา และ note id ของ URL ปลายทาง (TTL) — link เดียวกันที่หลายคนแชร์ resolve ครั้งเดียว
+"""
+import os
+import re
+import time
+import codecs
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests as http_requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+CACHE_TTL = int(os.environ.get("XHS_CACHE_TTL", "1800"))
+CACHE_SIZE = int(os.environ.get("XHS_CACHE_SIZE", "1024"))
+BATCH_WORKERS = int(os.environ.get("XHS_BATCH_WORKERS", "8"))
+BATCH_MAX = int(os.environ.get("XHS_BATCH_MAX", "50"))
+
+XHS_HEADERS = {
+    # Desktop UA เพื่อให้ได้ clean URL เหมือน Playwright
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
+    "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+    "Cache-Control": "max-age=0",
+    "Sec-Ch-Ua": '"Not_A Brand";v="8", "Chromium";v="120", "Google Chrome";v="120"',
+    "Sec-Ch-Ua-Mobile": "?0",
+    "Sec-Ch-Ua-Platform": '"macOS"',
+}
+
+# Pattern 1: masterUrl (H264 stream - usually clean)
+MASTER_RE = re.compile(r'"masterUrl"\s*:\s*"([^"]+)"')
+# Pattern 2: originVideoKey (Backup)
+ORIGIN_KEY_RE = re.compile(r'"originVideoKey"\s*:\s*"([^"]+)"')
+# Pattern 3: video src / url
+URL_RE = re.compile(r'"url"\s*:\s*"(https?://sns-video[^"]+)"')
+NOTE_ID_RE = re.compile(r'/(?:explore|discovery/item)/([0-9a-fA-F]{24})')
+
+CHUNK = 16 * 1024
+# ข้อความท้าย buffer ที่เก็บไว้ต่อกับ chunk ถัดไป — match ที่คร่อมรอยต่อ chunk ยังเจอ
+OVERLAP = 4096
+
+_session = http_requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=BATCH_WORKERS))
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=BATCH_WORKERS))
+_session.headers.update(XHS_HEADERS)
+
+_cache = OrderedDict()   # key → (expires_at, video_url)
+_cache_lock = threading.Lock()
+_inflight = {}           # key → Lock — link เดียวกันที่เข้ามาพร้อมกัน resolve ครั้งเดียว
+
+
+class VideoNotFound(Exception):
+    """โหลดหน้าได้ แต่ไม่เจอ video URL ในหน้า"""
+
+
+def _note_key(url):
+    m = NOTE_ID_RE.search(url or "")
+    return f"note:{m.group(1).lower()}" if m else None
+
+
+def _cache_get(key):
+    if not key:
+        return None
+    with _cache_lock:
+        hit = _cache.get(key)
+        if not hit:
+            return None
+        if hit[0] < time.time():
+            del _cache[key]
+            return None
+        _cache.move_to_end(key)
+        return hit[1]
+
+
+def _cache_put(keys, video_url):
+    expires = time.time() + CACHE_TTL
+    with _cache_lock:
+        for key in keys:
+            if key:
+                _cache[key] = (expires, video_url)
+                _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _unescape(url):
+    return url.replace("\\u002F", "/")
+
+
+def scan(chunks):
+    """หา video URL จาก HTML ทีละ chunk — คืน (video_url, how, chars_read)
+    masterUrl ที่มี sns-video → คืนทันที, pattern สำรองจำตัวแรกไว้จนจบหน้า"""
+    tail, read = "", 0
+    fallback_key = fallback_url = None
+    for text in chunks:
+        read += len(text)
+        buf = tail + text
+        for m in MASTER_RE.finditer(buf):
+            cand = _unescape(m.group(1))
+            if "sns-video" in cand:
+                return cand, "masterUrl", read
+        if fallback_key is None:
+            m = ORIGIN_KEY_RE.search(buf)
+            if m:
+                fallback_key = m.group(1)
+        if fallback_url is None:
+            m = URL_RE.search(buf)
+            if m:
+                fallback_url = _unescape(m.group(1))
+        tail = buf[-OVERLAP:]
+    if fallback_key:
+        return f"https://sns-video-bd.xhscdn.com/{fallback_key}", "originVideoKey", read
+    if fallback_url:
+        return fallback_url, "url", read
+    return None, None, read
+
+
+def _iter_text(resp):
+    decoder = codecs.getincrementaldecoder(resp.encoding or "utf-8")(errors="replace")
+    for chunk in resp.iter_content(chunk_size=CHUNK):
+        if chunk:
+            yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def resolve(url):
+    """คืน (video_url, cached) — raise VideoNotFound ถ้าหน้านั้นไม่มีวิดีโอ"""
+    url = url.strip()
+    keys = [url, _note_key(url)]
+    for key in keys:
+        video_url = _cache_get(key)
+        if video_url:
+            metrics.XHS_CACHE.inc(result="hit")
+            print(f"[XHS] Cache hit: {url}")
+            return video_url, True
+
+    with _cache_lock:
+        lock = _inflight.setdefault(url, threading.Lock())
+    try:
+        with lock:
+            # อีก request ของ link เดียวกันอาจ resolve เสร็จระหว่างรอ
+            video_url = _cache_get(url)
+            if video_url:
+                metrics.XHS_CACHE.inc(result="hit")
+                return video_url, True
+            metrics.XHS_CACHE.inc(result="miss")
+            return _fetch(url, keys), False
+    finally:
+        with _cache_lock:
+            if _inflight.get(url) is lock and not lock.locked():
+                del _inflight[url]
+
+
+def _fetch(url, keys):
+    print(f"[XHS] Resolving: {url}")
+    # Follow redirects เพื่อได้ URL จริง
+    with _session.get(url, allow_redirects=True, timeout=15, stream=True) as resp:
+        final_url = resp.url
+        print(f"[XHS] Final URL: {final_url}")
+        note_key = _note_key(final_url)
+        video_url = _cache_get(note_key)
+        if video_url:
+            # link คนละตัวแต่ note เดียวกับที่ resolve ไว้แล้ว — ไม่ต้องอ่าน HTML
+            how, read = "note cache", 0
+        else:
+            video_url, how, read = scan(_iter_text(resp))
+    if not video_url:
+        print(f"[XHS] No video found in HTML (length={read})")
+        raise VideoNotFound("ไม่พบวิดีโอใน XHS link นี้")
+    print(f"[XHS] Found via {how} after {read} chars: {video_url}")
+    _cache_put(keys + [final_url, note_key], video_url)
+    return video_url
+
+
+def warm():
+    """เปิด connection ไป XHS ไว้ใน pool ก่อน request แรก (warmup.py)"""
+    _session.head("https://www.xiaohongshu.com", timeout=5, allow_redirects=False).close()
+
+
+def resolve_many(urls, workers=None):
+    """resolve หลาย link พร้อมกัน — คืน list ตามลำดับเดิม: {"url", "video_url", "cached"} หรือ {"url", "error"}"""
+    def one(url):
+        try:
+            video_url, cached = resolve(url)
+            return {"url": url, "video_url": video_url, "cached": cached}
+        except VideoNotFound as e:
+            return {"url": url, "error": str(e)}
+        except Exception as e:
+            print(f"[XHS] Error resolving {url}: {e}")
+            return {"url": url, "error": str(e)}
+
+    if not urls:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers or BATCH_WORKERS, len(urls)))) as pool:
+        return list(pool.map(one, urls))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Benchmark stage ของ _ffmpeg_merge แบบ offline — ไม่ต้องมีคลิป XHS / Gemini key
+สร้าง input สังเคราะห์ด้วย ffmpeg lavfi (testsrc2 แนวตั้ง + sine PCM แทนเสียงพากย์)
+แล้วจับเวลา audio prep / mux / ASS conversion / subtitle burn / thumbnail
+
+ใช้:
+  python scripts/bench_media.py                                   # 720p + 1080p × 10/30/60/120s
+  python scripts/bench_media.py --sizes 1080x1920 --durations 10,30 --repeat 3 -o bench.json
+  python scripts/bench_media.py --save-baseline bench_baseline.json
+  python scripts/bench_media.py --baseline bench_baseline.json     # exit 1 ถ้าช้าลงเกิน threshold
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import tempfile
+from contextlib import contextmanager
+
+MERGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "merge")
+sys.path.insert(0, MERGE_DIR)
+os.environ.setdefault("FONTS_DIR", MERGE_DIR)
+
+import mediaproc  # noqa: E402
+import server     # noqa: E402
+from mediaproc import run_media  # noqa: E402
+
+STAGES = ("audio_prep", "mux", "ass_convert", "burn", "thumbnail")
+DEFAULT_SIZES = "720x1280,1080x1920"
+DEFAULT_DURATIONS = "10,30,60,120"
+FPS = 30
+
+# ซับสังเคราะห์ — ยาวพอๆ กับ block ที่ Gemini จัดให้จริง (15-20 ตัวอักษร)
+SUB_LINES = [
+    "แม่จ๋าา ของดีมาแล้วค่า",
+    "ใครยังไม่มี เชยระเบิด",
+    "เห็นปุ๊บหัวใจแม่สั่นเลย",
+    "ใช้ง่าย ไม่ต้องคิดเยอะ",
+    "กดซื้อเลยค่ะ ไม่งั้นแม่โกรธ",
+]
+
+_proc_results = []
+
+
+def _collect(result):
+    _proc_results.append(result)
+
+
+mediaproc.add_observer(_collect)
+
+# input สังเคราะห์ — bitexact + thread เดียว → ไฟล์เหมือนเดิมทุกครั้งบนเครื่องเดียวกัน
+_BITEXACT = ["-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact"]
+
+
+def make_video(path, width, height, duration):
+    run_media([
+        "ffmpeg", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={FPS}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=220:sample_rate=44100:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-threads", "1",
+        "-c:a", "aac", "-shortest", *_BITEXACT, path
+    ], "bench_input", timeout=1800, capture_stdout=False)
+
+
+def make_voice(path, duration):
+    """sine PCM s16le 24kHz mono — สั้นกว่าวิดีโอ 10% เหมือน TTS ส่วนใหญ่ (ได้ทดสอบ apad ด้วย)"""
+    run_media([
+        "ffmpeg", "-y",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=24000:duration={duration * 0.9:.3f}",
+        "-f", "s16le", "-ar", "24000", "-ac", "1", path
+    ], "bench_input", timeout=300, capture_stdout=False)
+
+
+def make_srt(path, duration, block=1.5):
+    def ts(sec):
+        ms = int(round(sec * 1000))
+        return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}"
+
+    blocks = []
+    t, i = 0.0, 0
+    while t < duration:
+        end = min(duration, t + block)
+        blocks.append(f"{i + 1}\n{ts(t)} --> {ts(end)}\n{SUB_LINES[i % len(SUB_LINES)]}")
+        t, i = end, i + 1
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(blocks) + "\n")
+
+
+def prepare_inputs(cache_dir, width, height, duration):
+    """สร้าง input ครั้งเดียวแล้วเก็บไว้ใน cache_dir — รอบถัดไปใช้ไฟล์เดิม"""
+    os.makedirs(cache_dir, exist_ok=True)
+    video = os.path.join(cache_dir, f"testsrc_{width}x{height}_{duration}s.mp4")
+    voice = os.path.join(cache_dir, f"voice_{duration}s.pcm")
+    srt = os.path.join(cache_dir, f"subs_{duration}s.srt")
+    if not os.path.exists(video):
+        print(f"[BENCH] Generating {os.path.basename(video)}...")
+        make_video(video + ".tmp.mp4", width, height, duration)
+        os.replace(video + ".tmp.mp4", video)
+    if not os.path.exists(voice):
+        make_voice(voice + ".tmp", duration)
+        os.replace(voice + ".tmp", voice)
+    if not os.path.exists(srt):
+        make_srt(srt, duration)
+    return video, voice, srt
+
+
+@contextmanager
+def _timed(name, timings):
+    """wall time + CPU (Python ใน process นี้ + subprocess ทุกตัวที่รันระหว่าง stage)"""
+    _proc_results.clear()
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    entry = {"ok": True}
+    try:
+        yield entry
+    finally:
+        entry["wall"] = time.perf_counter() - t0
+        entry["cpu"] = (time.process_time() - cpu0) + sum(r.cpu for r in _proc_results)
+        timings[name] = entry
+
+
+def run_case(video, voice, srt, width, height, duration):
+    timings = {}
+    with open(voice, "rb") as f:
+        pcm = f.read()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        merged = os.path.join(tmpdir, "merged_nosub.mp4")
+        output = os.path.join(tmpdir, "output.mp4")
+        srt_copy = os.path.join(tmpdir, "audio.srt")
+        shutil.copy(srt, srt_copy)
+
+        with _timed("audio_prep", timings):
+            adjusted = server._prepare_audio(pcm, duration, tmpdir)
+        with _timed("mux", timings):
+            server._mux_audio(video, adjusted, duration, merged)
+        with _timed("ass_convert", timings):
+            server._convert_to_ass(srt_copy, os.path.join(tmpdir, "bench.ass"), width, height)
+        with _timed("burn", timings) as entry:
+            entry["ok"] = server._burn_subtitles(merged, srt_copy, output, duration, tmpdir)
+        with _timed("thumbnail", timings) as entry:
+            thumb = os.path.join(tmpdir, "thumb.webp")
+            server._make_thumbnail(output, thumb)
+            entry["ok"] = os.path.exists(thumb) and os.path.getsize(thumb) > 0
+    return timings
+
+
+def summarize(runs):
+    stages = {}
+    for name in STAGES:
+        walls = [r[name]["wall"] for r in runs if name in r]
+        cpus = [r[name]["cpu"] for r in runs if name in r]
+        if not walls:
+            continue
+        stages[name] = {
+            "wall_median": round(statistics.median(walls), 4),
+            "wall_min": round(min(walls), 4),
+            "cpu_median": round(statistics.median(cpus), 4),
+            "ok": all(r[name]["ok"] for r in runs if name in r),
+            "runs": [round(w, 4) for w in walls],
+        }
+    return stages
+
+
+def ffmpeg_version():
+    try:
+        r = run_media(["ffmpeg", "-version"], "version", check=False)
+        return (r.stdout or "").splitlines()[0] if r.stdout else ""
+    except Exception:
+        return ""
+
+
+def compare(result, baseline, threshold, min_delta):
+    """คืน list ของ regression — stage ที่ wall_median ช้ากว่า baseline เกิน threshold (และเกิน min_delta วินาที)"""
+    regressions = []
+    if baseline.get("env", {}) != result["env"]:
+        print(f"[BENCH] ⚠️ environment ต่างจาก baseline: {baseline.get('env')} → {result['env']}")
+    print(f"\n{'case':<20}{'stage':<14}{'base':>9}{'now':>9}{'ratio':>8}")
+    for case, data in result["cases"].items():
+        base_case = baseline.get("cases", {}).get(case)
+        if not base_case:
+            continue
+        for stage, s in data["stages"].items():
+            b = base_case["stages"].get(stage)
+            if not b or not b.get("wall_median"):
+                continue
+            ratio = s["wall_median"] / b["wall_median"]
+            slower = ratio > 1 + threshold and s["wall_median"] - b["wall_median"] > min_delta
+            flag = " ❌" if slower else ""
+            print(f"{case:<20}{stage:<14}{b['wall_median']:>9.3f}{s['wall_median']:>9.3f}{ratio:>8.2f}{flag}")
+            if slower:
+                regressions.append({"case": case, "stage": stage, "baseline": b["wall_median"],
+                                    "current": s["wall_median"], "ratio": round(ratio, 3)})
+            elif b.get("ok") and not s["ok"]:
+                regressions.append({"case": case, "stage": stage, "error": "stage failed"})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark ของ media stages (lavfi input)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="WxH คั่นด้วย comma (แนวตั้ง)")
+    parser.add_argument("--durations", default=DEFAULT_DURATIONS, help="วินาที คั่นด้วย comma")
+    parser.add_argument("--repeat", type=int, default=1, help="รันแต่ละ case กี่รอบ (ใช้ median)")
+    parser.add_argument("--cache-dir", default=os.path.join(tempfile.gettempdir(), "dubbing-bench"))
+    parser.add_argument("-o", "--output", help="เขียนผล JSON ลงไฟล์นี้")
+    parser.add_argument("--baseline", help="เทียบกับ baseline JSON — exit 1 ถ้ามี regression")
+    parser.add_argument("--save-baseline", help="เขียนผลเป็น baseline ใหม่")
+    parser.add_argument("--threshold", type=float, default=0.15, help="ช้าลงเกินกี่เท่า (0.15 = 15%%)")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="ไม่นับ regression ที่ต่างน้อยกว่านี้ (วินาที)")
+    args = parser.parse_args()
+
+    if not shutil.which("ffmpeg"):
+        print("❌ ไม่พบ ffmpeg ใน PATH")
+        sys.exit(2)
+
+    sizes = [tuple(int(x) for x in s.lower().split("x")) for s in args.sizes.split(",") if s]
+    durations = [int(d) for d in args.durations.split(",") if d]
+
+    result = {
+        "version": 1,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "env": {
+            "ffmpeg": ffmpeg_version(),
+            "cpus": os.cpu_count(),
+            "machine": platform.machine(),
+            "python": platform.python_version(),
+        },
+        "params": {"repeat": args.repeat, "fps": FPS},
+        "cases": {},
+    }
+
+    for width, height in sizes:
+        for duration in durations:
+            case = f"{width}x{height}_{duration}s"
+            video, voice, srt = prepare_inputs(args.cache_dir, width, height, duration)
+            runs = []
+            for i in range(args.repeat):
+                print(f"[BENCH] {case} run {i + 1}/{args.repeat}")
+                runs.append(run_case(video, voice, srt, width, height, duration))
+            stages = summarize(runs)
+            burn = stages.get("burn", {})
+            result["cases"][case] = {
+                "width": width, "height": height, "duration": duration,
+                "encode_fps": round(duration * FPS / burn["wall_median"], 1) if burn.get("wall_median") else None,
+                "total_wall": round(sum(s["wall_median"] for s in stages.values()), 4),
+                "stages": stages,
+            }
+            print(f"[BENCH] {case}: " + ", ".join(f"{k}={v['wall_median']:.2f}s" for k, v in stages.items()))
+
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"[BENCH] Results → {args.output}")
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"[BENCH] Baseline → {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.threshold, args.min_delta)
+        if regressions:
+            print(f"\n❌ {len(regressions)} regression(s)")
+            for r in regressions:
+                print(f"   {r}")
+            sys.exit(1)
+        print("\n✅ ไม่มี regression")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Load generator ของ /pipeline — ยิง N job พร้อมกันเข้า container แล้ววัด
+throughput, latency ต่อ job (p50/p95/p99) และ peak RSS (จาก /metrics ของ container)
+
+ใช้คู่กับ scripts/mock_services.py:
+  python scripts/mock_services.py --port 9000 --media-dir /tmp/dubbing-bench --gemini-latency 1
+  GEMINI_API_BASE=http://localhost:9000 TELEGRAM_API_BASE=http://localhost:9000 python merge/server.py
+  python scripts/load_pipeline.py -n 20 -c 5 --video-url http://localhost:9000/media/testsrc_1080x1920_30s.mp4
+"""
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+_rss = {"current_max": 0, "peak_self": 0, "peak_children": 0}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def scrape_rss(container):
+    try:
+        text = requests.get(f"{container}/metrics", timeout=5).text
+    except requests.RequestException:
+        return
+    for line in text.splitlines():
+        if line.startswith("#") or " " not in line:
+            continue
+        name, value = line.rsplit(" ", 1)
+        value = float(value)
+        if name == "process_resident_memory_bytes":
+            _rss["current_max"] = max(_rss["current_max"], value)
+        elif name == 'dubbing_peak_rss_bytes{process="self"}':
+            _rss["peak_self"] = max(_rss["peak_self"], value)
+        elif name == 'dubbing_peak_rss_bytes{process="children"}':
+            _rss["peak_children"] = max(_rss["peak_children"], value)
+
+
+def run_job(i, args):
+    """dispatch 1 job แล้ว poll /jobs/<id> จนจบ — คืน dict ผลลัพธ์"""
+    video_id = f"load{uuid.uuid4().hex[:8]}"
+    payload = {
+        "video_id": video_id,
+        "video_url": args.video_url,
+        # chat_id คนละตัว → ไม่โดน dedup ของ video_url เดียวกัน
+        "chat_id": args.chat_base + i,
+        "msg_id": 1,
+        "token": "mock-token",
+        "api_key": "mock-key",
+        "model": args.model,
+        "worker_url": args.mock,
+        "r2_public_url": f"{args.mock}/r2",
+    }
+    t0 = time.monotonic()
+    try:
+        r = requests.post(f"{args.container}/pipeline", json=payload, timeout=30)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        return {"video_id": video_id, "status": "dispatch_error", "error": str(e)[:200], "latency": None}
+    dispatch = time.monotonic() - t0
+
+    status, error = "timeout", ""
+    while time.monotonic() - t0 < args.timeout:
+        time.sleep(args.poll)
+        try:
+            job = requests.get(f"{args.container}/jobs/{video_id}", timeout=10).json()
+        except (requests.RequestException, ValueError):
+            continue
+        if job.get("status") and job["status"] != "running":
+            status, error = job["status"], job.get("error", "")
+            break
+    latency = time.monotonic() - t0
+    print(f"[LOAD] {video_id}: {status} in {latency:.1f}s" + (f" ({error})" if error else ""))
+    return {"video_id": video_id, "status": status, "error": error,
+            "latency": round(latency, 3), "dispatch": round(dispatch, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /pipeline")
+    parser.add_argument("--container", default="http://localhost:8080")
+    parser.add_argument("--mock", default="http://localhost:9000", help="base URL ของ mock_services.py")
+    parser.add_argument("--video-url", help="วิดีโอต้นฉบับ (default: <mock>/media/sample.mp4)")
+    parser.add_argument("-n", "--jobs", type=int, default=10)
+    parser.add_argument("-c", "--concurrency", type=int, help="job พร้อมกันสูงสุด (default = --jobs)")
+    parser.add_argument("--model", default="gemini-3-flash-preview")
+    parser.add_argument("--chat-base", type=int, default=900000000)
+    parser.add_argument("--timeout", type=float, default=1800, help="timeout ต่อ job (วินาที)")
+    parser.add_argument("--poll", type=float, default=1.0)
+    parser.add_argument("-o", "--output", help="เขียนผล JSON ลงไฟล์นี้")
+    args = parser.parse_args()
+    args.container = args.container.rstrip("/")
+    args.mock = args.mock.rstrip("/")
+    args.video_url = args.video_url or f"{args.mock}/media/sample.mp4"
+    concurrency = args.concurrency or args.jobs
+
+    try:
+        requests.get(f"{args.container}/health", timeout=10).raise_for_status()
+        requests.get(f"{args.mock}/_mock/config", timeout=5).raise_for_status()
+    except requests.RequestException as e:
+        print(f"❌ container / mock ไม่พร้อม: {e}")
+        sys.exit(2)
+
+    stop = threading.Event()
+
+    def sampler():
+        while not stop.is_set():
+            scrape_rss(args.container)
+            stop.wait(0.5)
+
+    threading.Thread(target=sampler, daemon=True).start()
+
+    print(f"[LOAD] {args.jobs} jobs, concurrency={concurrency} → {args.container}")
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda i: run_job(i, args), range(args.jobs)))
+    wall = time.monotonic() - t0
+    stop.set()
+    scrape_rss(args.container)
+
+    latencies = [r["latency"] for r in results if r["status"] == "done"]
+    statuses = {}
+    for r in results:
+        statuses[r["status"]] = statuses.get(r["status"], 0) + 1
+    try:
+        mock_stats = requests.get(f"{args.mock}/_mock/stats", timeout=5).json()
+    except (requests.RequestException, ValueError):
+        mock_stats = {}
+
+    report = {
+        "jobs": args.jobs,
+        "concurrency": concurrency,
+        "wall": round(wall, 2),
+        "statuses": statuses,
+        "throughput_per_min": round(len(latencies) / wall * 60, 2) if wall else 0,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "mean": round(statistics.mean(latencies), 3) if latencies else None,
+            "max": max(latencies) if latencies else None,
+        },
+        "rss_bytes": {
+            "max_sampled": int(_rss["current_max"]),
+            "peak_server": int(_rss["peak_self"]),
+            "peak_child": int(_rss["peak_children"]),
+        },
+        "mock_requests": mock_stats,
+        "results": results,
+    }
+
+    lat = report["latency"]
+    fmt = lambda v: f"{v:.1f}s" if v is not None else "-"
+    print(f"\n{'='*50}")
+    print(f"jobs: {statuses}  wall={wall:.1f}s  throughput={report['throughput_per_min']} jobs/min")
+    print(f"latency: p50={fmt(lat['p50'])} p95={fmt(lat['p95'])} p99={fmt(lat['p99'])} max={fmt(lat['max'])}")
+    print(f"peak RSS: server={_rss['peak_self']/1024/1024:.0f} MB, "
+          f"largest child={_rss['peak_children']/1024/1024:.0f} MB")
+    print(f"{'='*50}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"[LOAD] Report → {args.output}")
+    sys.exit(0 if statuses.get("done", 0) == args.jobs else 1)
+
+
+if __name__ == "__main__":
+    main()
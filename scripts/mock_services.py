@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Mock ของ Gemini / Telegram / Worker R2 proxy / R2 S3 API สำหรับ load test /pipeline แบบ offline
+
+ใช้:
+  python scripts/mock_services.py --port 9000 --gemini-latency 1.5 --gemini-overload 0.2
+  แล้วรัน container ด้วย:
+    GEMINI_API_BASE=http://localhost:9000 TELEGRAM_API_BASE=http://localhost:9000 python merge/server.py
+  payload ของ /pipeline ใช้ worker_url=http://localhost:9000, r2_public_url=http://localhost:9000/r2
+  (scripts/load_pipeline.py ตั้งให้เอง)
+  ทดสอบ direct S3 upload (merge/storage.py) เพิ่ม:
+    R2_ENDPOINT=http://localhost:9000/s3 R2_ACCESS_KEY_ID=mock R2_SECRET_ACCESS_KEY=mock
+  (ไม่ตรวจ signature — object ลงที่เดียวกับ r2-upload จึงอ่านผ่าน /r2/<key> ได้เหมือนกัน)
+
+ทุก service ตั้งค่า latency (วินาที ± jitter), error rate (HTTP 500) และ overload rate
+(HTTP 503 "high demand" แบบที่ Gemini ตอบจริง) แยกกันได้ — เปลี่ยนตอนรันผ่าน POST /_mock/config
+GET /_mock/stats = จำนวน request / error ที่ inject ต่อ route
+"""
+import os
+import sys
+import json
+import math
+import time
+import array
+import base64
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+from collections import Counter
+
+from flask import Flask, request, jsonify, send_file
+
+app = Flask(__name__)
+
+SERVICES = ("gemini", "telegram", "worker", "s3")
+
+CONFIG = {name: {"latency": 0.0, "jitter": 0.0, "error_rate": 0.0, "overload_rate": 0.0} for name in SERVICES}
+CONFIG["gemini"]["processing_polls"] = 1   # files.get ตอบ PROCESSING กี่ครั้งก่อน ACTIVE
+
+STORE_DIR = os.path.join(tempfile.gettempdir(), "dubbing-mock-r2")
+MEDIA_DIR = None
+
+_stats = Counter()
+_lock = threading.Lock()
+_file_polls = Counter()
+_msg_id = [1000]
+
+CANNED_SCRIPT = {
+    "thai_script": "แม่จ๋าา ของดีมาแล้วค่า! ใครยังไม่มีอันนี้ เชยระเบิดเลยนะคะ "
+                   "ใช้ง่าย ไม่ต้องคิดเยอะ เห็นปุ๊บหัวใจแม่สั่นเลยค่ะ กดซื้อเลยค่ะ ไม่งั้นแม่จะโกรธ!",
+    "title": "ของมันต้องมี! (mock)",
+    "category": "ของใช้ในบ้าน",
+}
+
+HIGH_DEMAND = "This model is currently experiencing high demand. Spikes in demand are usually temporary. " \
+              "Please try again later."
+
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+
+
+def _inject(service, route):
+    """หน่วงเวลา + สุ่ม error ตาม CONFIG — คืน Response ถ้าต้องตอบ error แทน"""
+    cfg = CONFIG[service]
+    delay = cfg["latency"] + random.uniform(-cfg["jitter"], cfg["jitter"])
+    if delay > 0:
+        time.sleep(delay)
+    _count(f"{service}:{route}")
+    roll = random.random()
+    if roll < cfg["overload_rate"]:
+        _count(f"{service}:{route}:503")
+        return jsonify({"error": {"code": 503, "message": HIGH_DEMAND, "status": "UNAVAILABLE"}}), 503
+    if roll < cfg["overload_rate"] + cfg["error_rate"]:
+        _count(f"{service}:{route}:500")
+        return jsonify({"error": {"code": 500, "message": "Internal error (mock)", "status": "INTERNAL"}}), 500
+    return None
+
+
+def synth_pcm(seconds, rate=24000, freq=440.0):
+    """sine PCM s16le mono แทนเสียงพากย์จาก TTS"""
+    n = int(seconds * rate)
+    step = 2 * math.pi * freq / rate
+    return array.array("h", (int(8000 * math.sin(i * step)) for i in range(n))).tobytes()
+
+
+# ==================== Gemini ====================
+
+@app.route("/upload/v1beta/files", methods=["POST"])
+def gemini_upload():
+    err = _inject("gemini", "upload")
+    if err:
+        return err
+    request.get_data()  # อ่าน body ให้หมดเหมือน API จริง
+    name = f"files/mock{random.getrandbits(40):010x}"
+    return jsonify({"file": {"name": name, "uri": f"{request.host_url.rstrip('/')}/v1beta/{name}",
+                             "state": "PROCESSING"}})
+
+
+@app.route("/v1beta/files/<name>", methods=["GET"])
+def gemini_file(name):
+    err = _inject("gemini", "files.get")
+    if err:
+        return err
+    with _lock:
+        _file_polls[name] += 1
+        polls = _file_polls[name]
+    state = "ACTIVE" if polls > CONFIG["gemini"]["processing_polls"] else "PROCESSING"
+    return jsonify({"name": f"files/{name}", "state": state})
+
+
+@app.route("/v1beta/models/<path:model_method>", methods=["POST"])
+def gemini_generate(model_method):
+    model = model_method.split(":")[0]
+    err = _inject("gemini", "tts" if "tts" in model else "generateContent")
+    if err:
+        return err
+    body = request.get_json(silent=True) or {}
+    parts = (body.get("contents") or [{}])[0].get("parts", [])
+
+    if "tts" in model:
+        text = "".join(p.get("text", "") for p in parts)
+        # ~10 ตัวอักษร/วินาที เท่ากับที่ prompt ของ script คำนวณไว้
+        pcm = synth_pcm(max(1.0, len(text) / 10.0))
+        return jsonify({"candidates": [{"content": {"parts": [{"inlineData": {
+            "mimeType": "audio/L16;codec=pcm;rate=24000",
+            "data": base64.b64encode(pcm).decode("ascii"),
+        }}]}}]})
+
+    if any("file_data" in p for p in parts):
+        text = "```json\n" + json.dumps(CANNED_SCRIPT, ensure_ascii=False) + "\n```"
+    else:
+        # subtitle fix — ส่ง SRT ที่อยู่ใน prompt กลับไปตามเดิม
+        prompt = "".join(p.get("text", "") for p in parts)
+        marker = "SRT ที่ได้จากเสียงพูด:\n"
+        srt = prompt.split(marker, 1)[-1].split("\n\nคำสั่งบังคับ", 1)[0] if marker in prompt else ""
+        text = srt or "1\n00:00:00,000 --> 00:00:02,000\nของดีมาแล้วค่า"
+    return jsonify({"candidates": [{"content": {"parts": [{"text": text}]}}]})
+
+
+# ==================== Telegram ====================
+
+@app.route("/bot<token>/<method>", methods=["POST"])
+def telegram(token, method):
+    err = _inject("telegram", method)
+    if err:
+        return err
+    with _lock:
+        _msg_id[0] += 1
+        msg_id = _msg_id[0]
+    return jsonify({"ok": True, "result": {"message_id": msg_id, "date": int(time.time())}})
+
+
+# ==================== Worker R2 proxy ====================
+
+def _store_path(key):
+    path = os.path.normpath(os.path.join(STORE_DIR, key))
+    if not path.startswith(os.path.normpath(STORE_DIR) + os.sep):
+        return None
+    return path
+
+
+def _read_body(path):
+    with open(path, "wb") as f:
+        while True:
+            chunk = request.stream.read(1024 * 1024)
+            if not chunk:
+                break
+            f.write(chunk)
+
+
+@app.route("/api/r2-upload/<path:key>", methods=["PUT", "POST"])
+def r2_upload(key):
+    err = _inject("worker", "r2-upload")
+    if err:
+        return err
+    path = _store_path(key)
+    if not path:
+        return jsonify({"error": "bad key"}), 400
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    _read_body(tmp)
+    os.replace(tmp, path)
+    return jsonify({"ok": True, "key": key, "size": os.path.getsize(path)})
+
+
+@app.route("/api/r2-proxy/<path:key>", methods=["GET", "DELETE"])
+def r2_proxy(key):
+    err = _inject("worker", "r2-proxy")
+    if err:
+        return err
+    path = _store_path(key)
+    if not path or not os.path.exists(path):
+        return jsonify({"error": "not found"}), 404
+    if request.method == "DELETE":
+        os.remove(path)
+        return jsonify({"ok": True})
+    return send_file(path, mimetype="application/json" if key.endswith(".json") else None)
+
+
+# ==================== R2 S3-compatible API (path-style /s3/<bucket>/<key>) ====================
+
+S3_NS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+def _s3_xml(body, status=200):
+    return app.response_class(f'<?xml version="1.0" encoding="UTF-8"?>{body}', status=status,
+                              mimetype="application/xml")
+
+
+@app.route("/s3/<bucket>/<path:key>", methods=["PUT", "POST", "DELETE"])
+def s3_object(bucket, key):
+    """PutObject / CreateMultipartUpload / UploadPart / CompleteMultipartUpload / AbortMultipartUpload"""
+    upload_id = request.args.get("uploadId")
+    route = ("create" if "uploads" in request.args else
+             "part" if request.args.get("partNumber") else
+             "complete" if request.method == "POST" else
+             "abort" if request.method == "DELETE" else "put")
+    err = _inject("s3", route)
+    if err:
+        return err
+    path = _store_path(key)
+    if not path:
+        return _s3_xml("<Error><Code>InvalidKey</Code></Error>", 400)
+    parts_dir = os.path.join(STORE_DIR, "_multipart", upload_id or "")
+    if upload_id and not os.path.isdir(parts_dir):
+        return _s3_xml("<Error><Code>NoSuchUpload</Code></Error>", 404)
+
+    if route == "create":
+        upload_id = f"mock{random.getrandbits(64):016x}"
+        os.makedirs(os.path.join(STORE_DIR, "_multipart", upload_id))
+        return _s3_xml(f'<InitiateMultipartUploadResult xmlns="{S3_NS}"><Bucket>{bucket}</Bucket>'
+                       f'<Key>{key}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>')
+    if route == "part":
+        part = os.path.join(parts_dir, "%05d" % int(request.args["partNumber"]))
+        _read_body(part)
+        with open(part, "rb") as f:
+            etag = hashlib.md5(f.read()).hexdigest()
+        return "", 200, {"ETag": f'"{etag}"'}
+    if route == "abort":
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        return "", 204
+    if route == "complete":
+        request.get_data()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as out:
+            for name in sorted(os.listdir(parts_dir)):
+                with open(os.path.join(parts_dir, name), "rb") as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(tmp, path)
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        return _s3_xml(f'<CompleteMultipartUploadResult xmlns="{S3_NS}"><Bucket>{bucket}</Bucket>'
+                       f'<Key>{key}</Key><ETag>"mock"</ETag></CompleteMultipartUploadResult>')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    _read_body(tmp)
+    os.replace(tmp, path)
+    return "", 200, {"ETag": '"mock"'}
+
+
+@app.route("/r2/<path:key>", methods=["GET"])
+def r2_public(key):
+    """r2_public_url — ไม่ inject error (เป็น CDN ของ R2 ไม่ผ่าน Worker)"""
+    _count("r2:public")
+    path = _store_path(key)
+    if not path or not os.path.exists(path):
+        return "not found", 404
+    return send_file(path, conditional=True)
+
+
+@app.route("/api/gallery/refresh/<video_id>", methods=["POST"])
+def gallery_refresh(video_id):
+    err = _inject("worker", "gallery-refresh")
+    return err or jsonify({"ok": True})
+
+
+@app.route("/api/queue/next", methods=["POST"])
+def queue_next():
+    err = _inject("worker", "queue-next")
+    return err or jsonify({"ok": True, "started": False})
+
+
+# ==================== source video + control ====================
+
+@app.route("/media/<path:name>", methods=["GET"])
+def media(name):
+    """วิดีโอต้นฉบับให้ pipeline ดาวน์โหลด (แทนลิงก์ XHS)"""
+    _count("media")
+    if not MEDIA_DIR:
+        return "no --media-dir", 404
+    path = os.path.normpath(os.path.join(MEDIA_DIR, name))
+    if not path.startswith(os.path.normpath(MEDIA_DIR) + os.sep) or not os.path.exists(path):
+        return "not found", 404
+    return send_file(path, conditional=True)
+
+
+@app.route("/_mock/config", methods=["GET", "POST"])
+def mock_config():
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        for service, values in data.items():
+            if service in CONFIG and isinstance(values, dict):
+                CONFIG[service].update({k: float(v) for k, v in values.items() if k in CONFIG[service]})
+    return jsonify(CONFIG)
+
+
+@app.route("/_mock/stats", methods=["GET"])
+def mock_stats():
+    with _lock:
+        return jsonify(dict(_stats))
+
+
+@app.route("/_mock/reset", methods=["POST"])
+def mock_reset():
+    with _lock:
+        _stats.clear()
+        _file_polls.clear()
+    return jsonify({"ok": True})
+
+
+def main():
+    global STORE_DIR, MEDIA_DIR
+    parser = argparse.ArgumentParser(description="Mock Gemini / Telegram / Worker สำหรับ load test")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--store-dir", default=STORE_DIR, help="ที่เก็บไฟล์ที่อัปโหลดเข้า mock R2")
+    parser.add_argument("--media-dir", help="โฟลเดอร์วิดีโอต้นฉบับ เสิร์ฟที่ /media/<file>")
+    parser.add_argument("--seed", type=int, help="random seed (error injection ซ้ำได้)")
+    for service in SERVICES:
+        parser.add_argument(f"--{service}-latency", type=float, default=0.0)
+        parser.add_argument(f"--{service}-jitter", type=float, default=0.0)
+        parser.add_argument(f"--{service}-error-rate", type=float, default=0.0)
+        parser.add_argument(f"--{service}-overload", type=float, default=0.0, help="สัดส่วน 503 high demand")
+    args = parser.parse_args()
+
+    for service in SERVICES:
+        CONFIG[service].update(
+            latency=getattr(args, f"{service}_latency"),
+            jitter=getattr(args, f"{service}_jitter"),
+            error_rate=getattr(args, f"{service}_error_rate"),
+            overload_rate=getattr(args, f"{service}_overload"),
+        )
+    if args.seed is not None:
+        random.seed(args.seed)
+    STORE_DIR = os.path.abspath(args.store_dir)
+    MEDIA_DIR = os.path.abspath(args.media_dir) if args.media_dir else None
+    os.makedirs(STORE_DIR, exist_ok=True)
+
+    print(f"[MOCK] Listening on http://{args.host}:{args.port} (store={STORE_DIR})")
+    print(f"[MOCK] Config: {json.dumps(CONFIG)}")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
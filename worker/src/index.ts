@@ -1,7 +1,7 @@
 import { Hono } from 'hono'
 import { cors } from 'hono/cors'
 import { Container } from '@cloudflare/containers'
-import { type Env, rebuildGalleryCache, updateGalleryCache, sendTelegram, runPipeline, processNextInQueue } from './pipeline'
+import { type Env, rebuildGalleryCache, updateGalleryCache, sendTelegram, runPipeline, processNextInQueue, countActiveProcessing } from './pipeline'
 
 const app = new Hono<{ Bindings: Env }>()
 
@@ -155,9 +155,8 @@ app.post('/api/telegram', async (c) => {
 
                 const videoId = crypto.randomUUID().replace(/-/g, '').slice(0, 8)
 
-                // เช็คว่ามี pipeline กำลังรันอยู่ไหม
-                const processingList = await c.env.BUCKET.list({ prefix: '_processing/' })
-                const isRunning = processingList.objects.length > 0
+                // เช็คว่ามี pipeline กำลังรันอยู่ไหม — container ที่จัดคิว fair ต่อ chat เองรับงานได้ทันที
+                const isRunning = c.env.CONTAINER_SCHEDULER !== '1' && await countActiveProcessing(c.env.BUCKET) > 0
 
                 if (isRunning) {
                     // มีอันกำลังทำอยู่ → เข้าคิวรอ
@@ -361,6 +360,26 @@ app.delete('/api/processing/:id', async (c) => {
     }
 })
 
+// ยกเลิก job ที่กำลังรันใน container (kill ffmpeg/whisper ทันที)
+app.post('/api/processing/:id/cancel', async (c) => {
+    try {
+        const containerId = c.env.MERGE_CONTAINER.idFromName('merge-worker')
+        const containerStub = c.env.MERGE_CONTAINER.get(containerId)
+        const resp = await containerStub.fetch(`http://container/jobs/${c.req.param('id')}/cancel`, { method: 'POST' })
+        const body = await resp.json().catch(() => ({})) as Record<string, unknown>
+        return c.json(body, resp.status as 200)
+    } catch (e) {
+        return c.json({ error: String(e) }, 500)
+    }
+})
+
+// Progress แบบ real-time (SSE) จาก container — แทนการ poll _processing/ ใน R2
+app.get('/api/processing/:id/events', async (c) => {
+    const containerId = c.env.MERGE_CONTAINER.idFromName('merge-worker')
+    const containerStub = c.env.MERGE_CONTAINER.get(containerId)
+    return containerStub.fetch(`http://container/jobs/${c.req.param('id')}/events`)
+})
+
 // Refresh gallery cache for a specific video (called by container after pipeline completes)
 app.post('/api/gallery/refresh/:id', async (c) => {
     try {
@@ -1661,7 +1680,13 @@ async function watchdogStuckJobs(env: Env) {
             const job = await data.json() as {
                 id: string; videoUrl: string; chatId: number;
                 shopeeLink?: string; updatedAt?: string; createdAt?: string;
-                retryCount?: number; step?: number; stepName?: string;
+                retryCount?: number; step?: number; stepName?: string; status?: string;
+            }
+
+            // ผู้ใช้ยกเลิกเอง → ไม่ต้อง retry
+            if (job.status === 'cancelled') {
+                await env.BUCKET.delete(obj.key)
+                continue
             }
 
             // เช็คว่าค้างหรือยัง
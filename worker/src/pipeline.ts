@@ -15,6 +15,8 @@ export type Env = {
     R2_SECRET_ACCESS_KEY: string
     GEMINI_MODEL: string
     CORS_ORIGIN: string
+    // "1" = container มีคิว fair ต่อ chat เอง → ส่งงานเข้า container ทันที ไม่ต้องรอคิวใน R2 ทีละงาน
+    CONTAINER_SCHEDULER?: string
 }
 
 // ==================== Telegram Helpers ====================
@@ -509,11 +511,26 @@ export async function runPipeline(
 }
 
 
+/** นับ job ใน _processing/ ที่ยังรันอยู่ — entry ที่ container ทำเครื่องหมาย cancelled แล้วจะถูกลบทิ้ง */
+export async function countActiveProcessing(bucket: R2Bucket): Promise<number> {
+    const list = await bucket.list({ prefix: '_processing/' })
+    let active = 0
+    for (const obj of list.objects) {
+        const data = await bucket.get(obj.key)
+        const job = data ? await data.json().catch(() => null) as { status?: string } | null : null
+        if (job?.status === 'cancelled') {
+            await bucket.delete(obj.key)
+            continue
+        }
+        active++
+    }
+    return active
+}
+
 /** เช็คคิวและเริ่มทำอันถัดไป (ถ้ามี) */
 export async function processNextInQueue(env: Env): Promise<boolean> {
-    // เช็คว่ายังมี pipeline กำลังรันอยู่ไหม
-    const processingList = await env.BUCKET.list({ prefix: '_processing/' })
-    if (processingList.objects.length > 0) {
+    // เช็คว่ายังมี pipeline กำลังรันอยู่ไหม (container จัดคิวเองได้ → ส่งต่อเลย)
+    if (env.CONTAINER_SCHEDULER !== '1' && await countActiveProcessing(env.BUCKET) > 0) {
         console.log('[QUEUE] Pipeline still running, skip')
         return false
     }